@@ -2,9 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import logging.handlers
+import queue
+import uuid
 import os
 import sys
 import traceback
+import fnmatch
+import collections
+import threading
+import functools
+import time
+import signal
+import concurrent.futures
 import datetime
 import dateutil
 import dateutil.tz
@@ -16,12 +26,23 @@ from . import backend_types
 from . import logging_handlers
 from . import archive_specifiers
 from . import pruning_engine
+from . import contents_index
+from . import prune_plan
+from . import profiling
+from . import change_tracking
 
 def pretty_archive(archive):
     local_time = archive.datetime.astimezone(dateutil.tz.tzlocal())
     human_time = local_time.strftime("%Y-%m-%d %H:%M:%S")
     return "{} ({})".format(human_time, archive.timestamp)
 
+class PruneFailedError(error.Error):
+    """Pruning a backend failed, after planning and pruning what is given."""
+    def __init__(self, message, planned, pruned):
+        super(PruneFailedError, self).__init__(message)
+        self.planned = planned
+        self.pruned = pruned
+
 class Application(object):
     @property
     def logger(self):
@@ -29,6 +50,11 @@ class Application(object):
 
     def __init__(self, argv):
         self.argv = argv
+        self.run_id = uuid.uuid4().hex
+        self.log_queue = None
+        self.log_handlers = []
+        self.log_listener = None
+        self.profiler = None
 
     def configure_logging(self):
         logging.basicConfig()
@@ -38,8 +64,24 @@ class Application(object):
         self.email_handler = logging_handlers.EmailHandler("root", "root")
         self.stderr_handler = logging_handlers.SwitchableStreamHandler()
         self.stderr_handler.formatter = logging.Formatter('%(levelname)s: %(name)s: %(message)s')
-        l.addHandler(self.email_handler)
-        l.addHandler(self.stderr_handler)
+        # Handlers run on the listener's thread so that a slow terminal or
+        # handler never stalls a thread draining a child's output.
+        # Records queue up until start_logging, once the configuration has
+        # named every handler.
+        self.log_queue = queue.Queue()
+        queue_handler = logging_handlers.ContextQueueHandler(self.log_queue)
+        queue_handler.addFilter(logging_handlers.LogContextFilter(self.run_id))
+        l.addHandler(queue_handler)
+        self.log_handlers = [self.email_handler, self.stderr_handler]
+
+    def add_log_handler(self, handler):
+        self.log_handlers.append(handler)
+
+    def start_logging(self):
+        if self.log_listener is None:
+            self.log_listener = logging.handlers.QueueListener(
+                self.log_queue, *self.log_handlers, respect_handler_level=True)
+            self.log_listener.start()
 
     def bootstrap(self):
         self.configure_logging()
@@ -50,6 +92,8 @@ class Application(object):
         self.email_handler.toaddr = self.config.notification_address
         if self.config.config_options.quiet:
             self.stderr_handler.disable()
+        if self.config.log_file is not None:
+            self.add_log_handler(logging_handlers.JSONLinesFileHandler(self.config.log_file))
 
     def get_due_backups(self):
         backups = self.config.configured_backup_set().backups_due()
@@ -60,24 +104,28 @@ class Application(object):
         return self.config.all_configured_backups()
 
     def get_backup_by_name(self, name):
-        for backup in self.get_all_backups():
-            if backup.name == name:
-                return backup
-        else:
+        backup = self.config.configured_backup_by_name(name)
+        if backup is None:
             raise error.Error("Couldn't find backup with name {}".format(name))
+        return backup
 
     def get_all_backends(self):
         return self.config.all_configured_backends()
 
     def get_backend_by_name(self, name):
-        for backend in self.get_all_backends():
-            if backend.name == name:
-                return backend
-        else:
+        backend = self.config.configured_backend_by_name(name)
+        if backend is None:
             raise error.Error("Couldn't find backend with name {}".format(name))
+        return backend
 
-    def note_successful_backups(self, backups):
-        self.config.save_state_given_new_backups(backups)
+    def note_backup_results(self, results):
+        self.config.save_state_given_results(results)
+
+    def journal_backup_result(self, backup, result):
+        try:
+            self.config.journal_backup_result(backup, result)
+        except OSError as e:
+            self.logger.error("Couldn't journal the result of {}: {}".format(backup.name, e))
 
     def should_send_email(self):
         return not os.isatty(0)
@@ -92,23 +140,181 @@ class Application(object):
             return False
         return True
 
+    def start_profiling(self, config_start, config_wall):
+        options = self.config.config_options
+        if options.profile is None:
+            return
+        self.profiler = profiling.Profiler(use_cprofile=options.profile_python,
+                                           use_tracemalloc=options.profile_memory,
+                                           started=config_start)
+        self.profiler.record("load config", config_start, config_wall)
+        profiling.activate(self.profiler)
+        self.profiler.start()
+
+    def finish_profiling(self):
+        if self.profiler is None:
+            return
+        profiler, self.profiler = self.profiler, None
+        profiler.stop()
+        profiling.activate(None)
+        for line in profiler.summary_lines():
+            self.logger.info(line)
+        report_path = self.config.config_options.profile
+        try:
+            profiler.write_report(report_path)
+        except OSError as e:
+            self.logger.error("Couldn't write profile report to {}: {}".format(report_path, e))
+        else:
+            self.logger.info("Wrote profile report to {}".format(report_path))
+
     def finalize(self):
+        if self.log_queue is not None:
+            # Also drains whatever was logged before the configuration loaded.
+            self.start_logging()
+            self.log_listener.stop()
+            self.log_listener = None
         if self.should_send_email():
             self.email_handler.finalize()
 
-    def perform_backups(self):
-        backups = self.get_due_backups()
-        backup_successes = []
+    def order_backups(self, backups):
+        backup_set = self.config.configured_backup_set()
+        estimated_sizes = {}
+        if self.config.config_options.estimate and backup_set.observed_throughput() is None:
+            self.logger.info("No throughput history yet; not estimating backup sizes")
+        elif self.config.config_options.estimate:
+            for backup in backups:
+                if backup_set.expected_duration(backup) is None:
+                    estimated_sizes[backup.name] = backup.estimate_size()
+        ordered = backup_set.order_longest_first(backups, estimated_sizes)
+        self.logger.info("Running backups in order: {}".format(", ".join(b.name for b in ordered)))
+        return ordered
+
+    def perform_backup(self, backup, backends):
+        if len(backends) < len(backup.backends):
+            self.logger.info("Backing up {} only to {}".format(
+                backup.name, ", ".join(backend.name for backend in backends)))
+        result = backup.perform(datetime.datetime.now(dateutil.tz.tzlocal()), backends)
+        self.journal_backup_result(backup, result)
+        return result
+
+    def claim_backups(self, backups, locks):
+        """Lock the backups no other backupmgr process is running.
+
+        A backup another process finished after we loaded the state is no
+        longer due, so it's dropped as well.
+        """
+        claimed = []
         for backup in backups:
-            if backup.perform(datetime.datetime.now(dateutil.tz.tzlocal())):
-                backup_successes.append(backup)
-        self.note_successful_backups(backup_successes)
+            if locks.try_acquire(backup.name):
+                claimed.append(backup)
+            else:
+                self.logger.info("Skipping {}: another backupmgr is running it".format(backup.name))
+        if not claimed:
+            return claimed
+        current_state = self.config.load_state()
+        backup_set = self.config.configured_backup_set()
+        for backup in list(claimed):
+            if backup_set.ran_since_loaded(backup, current_state):
+                self.logger.info("Skipping {}: another backupmgr just ran it".format(backup.name))
+                locks.release(backup.name)
+                claimed.remove(backup)
+        return claimed
+
+    def run_backups(self, backups, select_backends):
+        """Run the backups no other process is running, each on the backends
+        select_backends picks for it; returns (backup, result) pairs."""
+        locks = self.config.backup_locks()
+        try:
+            backups = self.order_backups(self.claim_backups(backups, locks))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.config_options.jobs) as executor:
+                futures = [(backup, logging_handlers.submit_with_context(
+                    executor, self.perform_backup, backup, select_backends(backup)))
+                           for backup in backups]
+                results = [(backup, future.result()) for backup, future in futures]
+            self.note_backup_results(results)
+        finally:
+            locks.release_all()
+        backup_successes = [backup for backup, result in results if result]
         self.logger.info("Successfully completed {}/{} backups.".format(len(backup_successes), len(backups)))
+        return results
 
-    def get_backend_to_primed_list_token_map(self):
-        backend_to_primed_list_token_map = {}
+    def perform_backups(self):
+        self.run_backups(self.get_due_backups(), self.config.configured_backup_set().backends_due)
+
+    def send_report(self):
+        """Mail what was logged since the last report, for long-running verbs."""
+        self.log_listener.stop()
+        try:
+            if self.email_handler.body and self.should_send_email():
+                self.email_handler.finalize()
+        finally:
+            self.log_listener.start()
+
+    def run_daemon(self):
+        """Back up each selected backup after its paths change, within the
+        daemon min_interval and max_interval, until terminated."""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        selection = {backup.name: (backup, backends)
+                     for backup, backends in self.get_selected_backups_and_backends()}
+        if not selection:
+            raise error.Error("No backups to watch")
+        backup_set = self.config.configured_backup_set()
+        triggers = {}
+        for name, (backup, _) in selection.items():
+            last_run = backup_set.last_run_of_backup(backup).timestamp()
+            triggers[name] = change_tracking.BackupTrigger(self.config.daemon_settings_for(backup), last_run)
+        tracker = change_tracking.ChangeTracker(
+            {name: list(backup.paths) for name, (backup, _) in selection.items()},
+            {name: self.config.daemon_settings_for(backup).scan_interval
+             for name, (backup, _) in selection.items()},
+            self.config.max_watches)
+        tracker.start()
+        self.logger.info("Watching {}".format(", ".join(sorted(selection))))
+        try:
+            while True:
+                now = time.time()
+                due = [backup for name, (backup, _) in selection.items() if triggers[name].due(now)]
+                if due:
+                    for backup in due:
+                        # Changes made while it runs must trigger another run.
+                        triggers[backup.name].note_run(now)
+                    self.config.refresh_state()
+                    results = self.run_backups(due, lambda backup: selection[backup.name][1])
+                    for backup, result in results:
+                        if not result:
+                            triggers[backup.name].note_change(time.time())
+                    self.send_report()
+                    continue
+                next_due = min(trigger.due_at() for trigger in triggers.values())
+                for name in tracker.wait(max(0, next_due - now)):
+                    self.logger.debug("{} changed".format(name))
+                    triggers[name].note_change(time.time())
+        finally:
+            tracker.close()
+
+    def get_selected_backups_and_backends(self):
+        """Pairs of (backup, backends) picked by the --backup/--backend filters."""
+        def selected(name, patterns):
+            return not patterns or any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+        backup_patterns = self.config.config_options.backup_filters
+        backend_patterns = self.config.config_options.backend_filters
+        pairs = []
         for backup in self.get_all_backups():
-            for backend in backup.backends:
+            if not selected(backup.name, backup_patterns):
+                continue
+            backends = [backend for backend in backup.backends
+                        if selected(backend.name, backend_patterns)]
+            if backends:
+                pairs.append((backup, backends))
+        if not pairs and (backup_patterns or backend_patterns):
+            raise error.Error("No configured backups and backends match the given filters")
+        return pairs
+
+    def get_backend_to_primed_list_token_map(self, selection):
+        backend_to_primed_list_token_map = {}
+        for _, backends in selection:
+            for backend in backends:
                 if backend not in backend_to_primed_list_token_map:
                     token = backend.get_primed_list_token()
                     backend_to_primed_list_token_map[backend] = token
@@ -116,16 +322,22 @@ class Application(object):
 
 
     def list_archives(self):
-        backend_to_primed_list_token_map = self.get_backend_to_primed_list_token_map()
+        selection = self.get_selected_backups_and_backends()
+        backend_to_primed_list_token_map = self.get_backend_to_primed_list_token_map(selection)
 
-        for backup in self.get_all_backups():
+        for backup, backends in selection:
             sys.stdout.write("{}:\n".format(backup.name))
-            for backend, archives in backup.get_all_archives(backend_to_primed_list_token_map=backend_to_primed_list_token_map):
-                sorted_archives = sorted(archives, key=lambda x: x.datetime)
+            for backend, archives in backup.get_all_archives(backends=backends, backend_to_primed_list_token_map=backend_to_primed_list_token_map):
+                # Only complete archives are numbered, as restore specs count them.
+                sorted_archives = sorted((a for a in archives if a.complete), key=lambda x: x.datetime)
                 enumerated_archives = ((i, archive) for i, archive in enumerate(sorted_archives) if self.within_timespec(archive))
                 sys.stdout.write("\t{}:\n".format(backend.name))
                 for i, archive in enumerated_archives:
                     sys.stdout.write("\t\t{}: {}\n".format(i, pretty_archive(archive)))
+                for archive in sorted(archives, key=lambda x: x.datetime):
+                    if not archive.complete and self.within_timespec(archive):
+                        sys.stdout.write("\t\t-: {} (only {} of {} shards)\n".format(
+                            pretty_archive(archive), len(archive.shards), archive.count))
 
     def list_configured_backups(self):
         for backup in self.get_all_backups():
@@ -137,7 +349,18 @@ class Application(object):
         for backend in self.get_all_backends():
             sys.stdout.write("{}\n".format(backend))
 
-    def restore_backup(self):
+    def restore_members(self, backup):
+        members = [member.lstrip("/") for member in self.config.config_options.members]
+        names = list(backup.paths.values()) + list(backup.commands)
+        for member in members:
+            top = member.split("/", 1)[0]
+            if not fnmatch.filter(names, top):
+                raise error.Error(
+                    "{} is not within any path of backup {} ({})".format(
+                        member, backup.name, ", ".join(sorted(names))))
+        return members
+
+    def get_backup_and_backend(self):
         backup_name = self.config.config_options.backup
         backup = self.get_backup_by_name(backup_name)
         backend_name = self.config.config_options.backend
@@ -146,33 +369,364 @@ class Application(object):
             raise error.Error(
                 "backend {} not configured for backup {}".format(backend_name,
                                                                  backup_name))
-        spec_str = self.config.config_options.archive_spec
-        spec = archive_specifiers.ArchiveSpecifier(spec_str)
+        return backup, backend
+
+    def archive_specifier(self):
+        try:
+            return archive_specifiers.ArchiveSpecifier(self.config.config_options.archive_spec)
+        except ValueError as e:
+            raise error.Error(str(e))
+
+    def select_archives(self, backup, backend):
+        spec = self.archive_specifier()
         matches = []
         for _, archives in backup.get_all_archives(backends=[backend]):
-            for i, archive in enumerate(sorted(archives, key=lambda x: x.datetime)):
-                if spec.evaluate(archive, i):
-                    matches.append(archive)
+            matches += spec.select(sorted((a for a in archives if a.complete),
+                                          key=lambda x: x.datetime))
+        if len(matches) == 0:
+            raise error.Error("Spec {} matched no archives!".format(
+                self.config.config_options.archive_spec))
+        return matches
+
+    def rank_restore_sources(self, backends):
+        """Order backends cheapest first: by configured restore_cost, then by
+        the throughput of their past backups, then as configured."""
+        backup_set = self.config.configured_backup_set()
+        def key(item):
+            i, backend = item
+            throughput = backup_set.observed_throughput(backend)
+            return (backend.restore_cost is None, backend.restore_cost or 0,
+                    throughput is None, -(throughput or 0), i)
+        return [backend for _, backend in sorted(enumerate(backends), key=key)]
+
+    def select_archive_copies(self, backup):
+        """Resolve the spec over the archives of all of backup's backends.
+
+        Returns, for each matching archive time, the copies of that archive
+        cheapest first.
+        """
+        spec = self.archive_specifier()
+        if spec.uses_ordinals:
+            # list numbers each backend's archives separately, so an ordinal
+            # names different archives on different backends.
+            raise error.Error("Ordinals don't name one archive across backends; "
+                              "give a timestamp or date to restore-cheapest")
+        ranked = self.rank_restore_sources(backup.backends)
+        copies_by_timestamp = collections.defaultdict(list)
+        for backend in ranked:
+            try:
+                archives = backend.existing_archives_for_name(backup.name)
+            except error.Error as e:
+                self.logger.warning("Not restoring from {}: {}".format(backend.name, e))
+                continue
+            for archive in archives:
+                if archive.complete:
+                    copies_by_timestamp[archive.timestamp].append(archive)
+
+        representatives = sorted((copies[0] for copies in copies_by_timestamp.values()),
+                                 key=lambda x: x.datetime)
+        matches = spec.select(representatives)
+        if len(matches) == 0:
+            raise error.Error("Spec {} matched no archives!".format(
+                self.config.config_options.archive_spec))
+        return [copies_by_timestamp[archive.timestamp] for archive in matches]
+
+    def restore_first_available(self, copies, destination, members):
+        for i, archive in enumerate(copies):
+            if len(copies) > 1:
+                self.logger.info("Restoring {} from {}".format(pretty_archive(archive),
+                                                               archive.backend.name))
+            try:
+                if archive.restore(destination, members):
+                    return True
+            except backend_types.BackendOperationError as e:
+                self.logger.error(str(e))
+            if i + 1 < len(copies):
+                self.logger.warning("Restoring from {} failed; falling back to {}".format(
+                    archive.backend.name, copies[i + 1].backend.name))
+        return False
+
+    def restore_backup(self):
+        if self.config.config_options.cheapest:
+            backup = self.get_backup_by_name(self.config.config_options.backup)
+            matches = self.select_archive_copies(backup)
+        else:
+            backup, backend = self.get_backup_and_backend()
+            matches = [[archive] for archive in self.select_archives(backup, backend)]
+        members = self.restore_members(backup)
+        destination = self.config.config_options.destination
+
+        if self.config.config_options.all_matches:
+            success = True
+            for copies in matches:
+                archive_destination = os.path.join(destination, str(copies[0].timestamp))
+                os.makedirs(archive_destination, exist_ok=True)
+                self.logger.info("Restoring {} into {}".format(pretty_archive(copies[0]),
+                                                               archive_destination))
+                success = self.restore_first_available(copies, archive_destination, members) and success
+            return success
 
         if len(matches) > 1:
-            msg = "Spec {} matched more than one archive!".format(spec_str)
-            for match in matches:
-                msg += "\n\t{}".format(pretty_archive(match))
+            msg = "Spec {} matched more than one archive!".format(
+                self.config.config_options.archive_spec)
+            for copies in matches:
+                msg += "\n\t{}".format(pretty_archive(copies[0]))
             raise error.Error(msg)
-        if len(matches) == 0:
-            raise error.Error("Spec {} matched no archives!".format(spec_str))
 
-        archive = matches[0]
-        return archive.restore(self.config.config_options.destination)
+        return self.restore_first_available(matches[0], destination, members)
+
+    def delete_archives(self):
+        backup, backend = self.get_backup_and_backend()
+        matches = self.select_archives(backup, backend)
+        for archive in matches:
+            sys.stdout.write("{}\n".format(pretty_archive(archive)))
+        if self.config.config_options.dry_run:
+            return True
+        self.logger.info("Deleting {} archives of {} from {}".format(
+            len(matches), backup.name, backend.name))
+        return backend.destroy_archives(matches)
+
+    def prune_backend(self, backend, backups, deletion_slots, dry_run):
+        """List one backend, then plan and delete for each of its backups.
+
+        Returns the planned (archive, reason) pairs and the pruned archives;
+        failures are logged and reported by raising, with PruneFailedError
+        once some backups may have been pruned.
+        """
+        with logging_handlers.log_context(phase="prune", backend=backend.name):
+            token = backend.get_primed_list_token()
+            plans = []
+            for backup in backups:
+                with logging_handlers.log_context(backup=backup.name):
+                    pruning_config = self.config.pruning_configuration.get_backup_pruning_config(backup.name)
+                    engine = pruning_engine.PruningEngine(pruning_config)
+                    archives = backend.existing_archives_for_name(backup.name, primed_list_token=token)
+                    with profiling.span("plan pruning {} on {}".format(backup.name, backend.name)):
+                        plan = engine.prunable_archives_with_reasons(archives)
+                    plans.append((backup, engine, archives, plan))
+            plans = self.plan_storage_budgets(backend, plans)
+
+            planned = []
+            pruned = []
+            success = True
+            for backup, engine, _, plan in plans:
+                planned += plan
+                if not plan or dry_run:
+                    continue
+                archives_to_prune = [archive for archive, _ in plan]
+                with logging_handlers.log_context(backup=backup.name), deletion_slots, \
+                        profiling.span("prune {} on {}".format(backup.name, backend.name)):
+                    if engine.prune_archives(archives_to_prune):
+                        pruned += archives_to_prune
+                    else:
+                        success = False
+            if not success:
+                raise PruneFailedError("Failed to prune some archives from {}".format(backend.name),
+                                       planned, pruned)
+            return planned, pruned
+
+    def plan_storage_budgets(self, backend, plans):
+        """Extend the (backup, engine, archives, plan) tuples in plans with the
+        archives to delete to meet the max_size of each backup and of backend."""
+        budgeted = [engine.pruning_config.max_size is not None for _, engine, _, _ in plans]
+        if backend.max_size is None and not any(budgeted):
+            return plans
+        with profiling.span("measure archives on {}".format(backend.name)):
+            usage = backend.storage_usage([a for _, _, archives, _ in plans for a in archives])
+
+        def kept(archives, plan):
+            doomed = {archive for archive, _ in plan}
+            return [archive for archive in archives if archive not in doomed]
+
+        extended = []
+        for backup, engine, archives, plan in plans:
+            with logging_handlers.log_context(backup=backup.name):
+                plan = plan + engine.budget_prunable_with_reasons(kept(archives, plan), usage.sizes)
+            extended.append((backup, engine, archives, plan))
+        if backend.max_size is None or usage.total is None:
+            return extended
+
+        freed = sum(usage.sizes[archive].unique
+                    for _, _, _, plan in extended for archive, _ in plan)
+        excess = usage.total - freed - backend.max_size
+        if excess <= 0:
+            return extended
+        timelines = [kept(archives, plan) for _, _, archives, plan in extended]
+        protected = set()
+        for (_, engine, _, _), timeline in zip(extended, timelines):
+            protected |= engine.protected_archives(timeline)
+        chosen = set(pruning_engine.choose_for_budget(timelines, usage.sizes, excess, protected))
+        if sum(usage.sizes[archive].unique for archive in chosen) < excess:
+            self.logger.warning("Can't fit {} within {} bytes without deleting the newest archives"
+                                .format(backend.name, backend.max_size))
+        reason = "{} holds {} bytes, over its budget of {}".format(
+            backend.name, usage.total - freed, backend.max_size)
+        return [(backup, engine, archives,
+                 plan + [(archive, reason) for archive in timeline if archive in chosen])
+                for (backup, engine, archives, plan), timeline in zip(extended, timelines)]
+
+    def apply_to_backend(self, backend, archives, deletion_slots):
+        with logging_handlers.log_context(phase="prune", backend=backend.name):
+            with deletion_slots:
+                if not backend.destroy_archives(archives):
+                    raise error.Error("Failed to prune some archives from {}".format(backend.name))
+            return [], archives
+
+    def run_per_backend(self, work):
+        """Run work[backend]() for every backend concurrently.
+
+        Each returns (planned, pruned); the combined lists are returned with
+        the names of the backends that failed.
+        """
+        failed = []
+        planned = []
+        pruned = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(work) or 1) as executor:
+            futures = collections.OrderedDict(
+                (logging_handlers.submit_with_context(executor, job), backend)
+                for backend, job in work.items())
+            for future in concurrent.futures.as_completed(futures):
+                backend = futures[future]
+                try:
+                    backend_planned, backend_pruned = future.result()
+                except PruneFailedError as e:
+                    self.logger.error("Pruning {} failed: {}".format(backend.name, e))
+                    failed.append(backend.name)
+                    backend_planned, backend_pruned = e.planned, e.pruned
+                except error.Error as e:
+                    self.logger.error("Pruning {} failed: {}".format(backend.name, e))
+                    failed.append(backend.name)
+                    continue
+                planned += backend_planned
+                pruned += backend_pruned
+        return failed, planned, pruned
+
+    def load_prune_plan(self, path):
+        if self.config.config_options.backup_filters or self.config.config_options.backend_filters:
+            raise error.Error("--apply cannot be combined with --backup or --backend")
+        backend_to_archives = collections.OrderedDict()
+        for entry in prune_plan.read_plan(path):
+            backend = self.get_backend_by_name(entry.backend)
+            archive = backend.archive_for_name(entry.backup, entry.timestamp, entry.archive)
+            backend_to_archives.setdefault(backend, []).append(archive)
+        return backend_to_archives
 
     def prune_archives(self):
-        backend_to_primed_list_token_map = self.get_backend_to_primed_list_token_map()
-        for backup in self.get_all_backups():
-            pruning_config = self.config.pruning_configuration.get_backup_pruning_config(backup.name)
-            for backend, archives in backup.get_all_archives(backend_to_primed_list_token_map=backend_to_primed_list_token_map):
-                engine = pruning_engine.PruningEngine(pruning_config)
-                archives_to_prune = engine.prunable_archives(archives)
-                engine.prune_archives(archives_to_prune)
+        options = self.config.config_options
+        # Each backend is listed, planned and pruned independently; only the
+        # number of simultaneous destructive operations is bounded globally.
+        deletion_slots = threading.BoundedSemaphore(options.max_concurrent_deletes)
+
+        if options.apply is not None:
+            backend_to_archives = self.load_prune_plan(options.apply)
+            if options.dry_run:
+                planned = [(archive, "from plan {}".format(options.apply))
+                           for archives in backend_to_archives.values() for archive in archives]
+                failed, pruned = [], []
+            else:
+                work = collections.OrderedDict(
+                    (backend, functools.partial(self.apply_to_backend, backend, archives, deletion_slots))
+                    for backend, archives in backend_to_archives.items())
+                failed, planned, pruned = self.run_per_backend(work)
+        else:
+            backend_to_backups = collections.OrderedDict()
+            for backup, backends in self.get_selected_backups_and_backends():
+                for backend in backends:
+                    backend_to_backups.setdefault(backend, []).append(backup)
+            work = collections.OrderedDict(
+                (backend, functools.partial(self.prune_backend, backend, backups,
+                                            deletion_slots, options.dry_run))
+                for backend, backups in backend_to_backups.items())
+            failed, planned, pruned = self.run_per_backend(work)
+
+        if options.plan_out is not None:
+            prune_plan.write_plan(options.plan_out,
+                                  [prune_plan.entry_for_archive(a, r) for a, r in planned],
+                                  self.run_id)
+        if options.dry_run:
+            for archive, reason in planned:
+                sys.stdout.write("{}\t{}\t{}\t{}\n".format(
+                    archive.backend.name, archive.backup_name, pretty_archive(archive), reason))
+
+        if options.dry_run:
+            pruned = [archive for archive, _ in planned]
+        counts = collections.Counter((a.backup_name, a.backend.name) for a in pruned)
+        self.logger.info("{} {} archives{}{}".format(
+            "Would prune" if options.dry_run else "Pruned",
+            len(pruned),
+            " (failed on {})".format(", ".join(sorted(failed))) if failed else "",
+            "".join("\n\t{} from {}: {}".format(backup_name, backend_name, count)
+                    for (backup_name, backend_name), count in sorted(counts.items()))))
+        return not failed
+
+    def archives_to_replicate(self, source, target):
+        """Archives of backups kept on both source and target that target lacks."""
+        patterns = self.config.config_options.backup_filters
+        backups = [backup for backup in self.get_all_backups()
+                   if source in backup.backends and target in backup.backends
+                   and (not patterns or any(fnmatch.fnmatchcase(backup.name, p) for p in patterns))]
+        if not backups:
+            raise error.Error("No selected backups are kept on both {} and {}".format(
+                source.name, target.name))
+        source_token = source.get_primed_list_token()
+        target_token = target.get_primed_list_token()
+        pending = []
+        for backup in backups:
+            present = {archive.timestamp for archive in
+                       target.existing_archives_for_name(backup.name, primed_list_token=target_token)
+                       if archive.complete}
+            archives = source.existing_archives_for_name(backup.name, primed_list_token=source_token)
+            pending += [archive for archive in sorted(archives, key=lambda x: x.datetime)
+                        if archive.complete and archive.timestamp not in present]
+        return pending
+
+    def replicate_archive(self, archive, target):
+        with logging_handlers.log_context(phase="replicate", backup=archive.backup_name,
+                                          backend=target.name), \
+                profiling.span("replicate {} to {}".format(archive.backup_name, target.name)):
+            self.logger.info("Replicating {} to {}".format(archive, target.name))
+            try:
+                return bool(target.store_archive(archive.backup_name, archive.datetime,
+                                                 archive.write_tar))
+            except error.Error as e:
+                self.logger.error("Failed to replicate {}: {}".format(archive, e))
+                return False
+
+    def replicate_archives(self):
+        source = self.get_backend_by_name(self.config.config_options.source)
+        target = self.get_backend_by_name(self.config.config_options.target)
+        if source is target:
+            raise error.Error("Can't replicate {} to itself".format(source.name))
+        pending = self.archives_to_replicate(source, target)
+        if self.config.config_options.dry_run:
+            for archive in pending:
+                sys.stdout.write("{}: {}\n".format(archive.backup_name, pretty_archive(archive)))
+            return True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.config_options.jobs) as executor:
+            results = list(executor.map(logging_handlers.with_current_context(
+                lambda archive: self.replicate_archive(archive, target)), pending))
+        self.logger.info("Replicated {}/{} archives from {} to {}.".format(
+            sum(results), len(pending), source.name, target.name))
+        return all(results)
+
+    def find_in_archives(self):
+        backup = self.get_backup_by_name(self.config.config_options.backup)
+        pattern = self.config.config_options.pattern
+        index = contents_index.ContentsIndex(self.config.index_dir)
+
+        found = False
+        sys.stdout.write("{}:\n".format(backup.name))
+        for backend, archives in backup.get_all_archives():
+            sorted_archives = sorted(archives, key=lambda x: x.datetime)
+            candidates = [archive for archive in sorted_archives
+                          if archive.complete and self.within_timespec(archive)]
+            sys.stdout.write("\t{}:\n".format(backend.name))
+            for archive, members in index.search(candidates, pattern):
+                found = True
+                sys.stdout.write("\t\t{}:\n".format(pretty_archive(archive)))
+                for member in members:
+                    sys.stdout.write("\t\t\t{}\n".format(member))
+        return found
 
     def print_version(self):
         from . import _metadata
@@ -189,16 +743,25 @@ class Application(object):
             "list-backends": self.list_backends,
             "restore": self.restore_backup,
             "prune": self.prune_archives,
+            "find": self.find_in_archives,
+            "delete": self.delete_archives,
+            "replicate": self.replicate_archives,
+            "daemon": self.run_daemon,
             "version": self.print_version,
         }
         try:
             self.bootstrap()
+            config_start = time.monotonic()
             self.load_config()
+            self.start_logging()
+            self.start_profiling(config_start, time.monotonic() - config_start)
             if self.config.config_options.verb is None:
                 self.logger.fatal("No verb provided.")
                 ok = False
             else:
-                ok = verbs.get(self.config.config_options.verb, self.unknown_verb)()
+                verb = self.config.config_options.verb
+                with logging_handlers.log_context(phase=verb), profiling.span(verb):
+                    ok = verbs.get(verb, self.unknown_verb)()
             sys.exit(0 if ok or ok is None else 1)
         except error.Error as e:
             self.logger.fatal(str(e))
@@ -208,4 +771,5 @@ class Application(object):
             self.logger.fatal(traceback.format_exc())
             sys.exit(1)
         finally:
+            self.finish_profiling()
             self.finalize()
@@ -3,11 +3,16 @@
 
 import dateutil.parser
 import dateutil.tz
+import dateutil.relativedelta
 import datetime
 import itertools
 
 CONCRETE_SPECIFIERS = set()
 
+def _specifier_types(base):
+    return sorted((t for t in CONCRETE_SPECIFIERS if issubclass(t, base)),
+                  key=lambda t: (t.PRIORITY, t.__name__))
+
 class ArchiveSpecifierMeta(type):
     def __init__(cls, *args, **kwargs):
         super(ArchiveSpecifierMeta, cls).__init__(*args, **kwargs)
@@ -18,7 +23,9 @@ class ArchiveSpecifierMeta(type):
         if cls in CONCRETE_SPECIFIERS:
             return super(ArchiveSpecifierMeta, cls).__call__(specifier_str, *args, **kwargs)
 
-        for specifier_type in CONCRETE_SPECIFIERS:
+        # dateutil will parse almost anything, so the order in which the
+        # specifier types are tried matters.
+        for specifier_type in _specifier_types(cls):
             if specifier_type.acceptable_specifier(specifier_str):
                 return specifier_type(specifier_str)
 
@@ -31,9 +38,37 @@ class ArchiveSpecifierMeta(type):
 
 class ArchiveSpecifier(object, metaclass=ArchiveSpecifierMeta):
     ABSTRACT = True
+    PRIORITY = 50
+    # Whether what matches depends on the archive's position in the list.
+    uses_ordinals = False
+
+    @classmethod
+    def acceptable_specifier(cls, specifier_str):
+        for specifier_type in _specifier_types(cls):
+            if specifier_type.acceptable_specifier(specifier_str):
+                return True
+        return False
+
+    def select(self, sorted_archives):
+        """Return the matching archives from a list sorted oldest first."""
+        return [archive for ordinal, archive in enumerate(sorted_archives)
+                if self.evaluate(archive, ordinal)]
+
+
+class SingleArchiveSpecifier(ArchiveSpecifier):
+    """A specifier naming one point in the archive sequence.
+
+    Besides matching, single specifiers can say whether an archive lies
+    entirely before (precedes) or after (follows) what they name, which is
+    what range bounds need.
+    """
+    ABSTRACT = True
+
 
+class OrdinalArchiveSpecifier(SingleArchiveSpecifier):
+    PRIORITY = 30
+    uses_ordinals = True
 
-class OrdinalArchiveSpecifier(ArchiveSpecifier):
     @classmethod
     def acceptable_specifier(cls, specifier_str):
         try:
@@ -48,8 +83,16 @@ class OrdinalArchiveSpecifier(ArchiveSpecifier):
     def evaluate(self, archive, ordinal):
         return ordinal == self.ordinal
 
+    def precedes(self, archive, ordinal):
+        return ordinal < self.ordinal
+
+    def follows(self, archive, ordinal):
+        return ordinal > self.ordinal
+
+
+class TimestampArchiveSpecifier(SingleArchiveSpecifier):
+    PRIORITY = 30
 
-class TimestampArchiveSpecifier(ArchiveSpecifier):
     @classmethod
     def acceptable_specifier(cls, specifier_str):
         try:
@@ -65,8 +108,16 @@ class TimestampArchiveSpecifier(ArchiveSpecifier):
     def evaluate(self, archive, ordinal):
         return archive.timestamp == self.timestamp
 
+    def precedes(self, archive, ordinal):
+        return archive.timestamp < self.timestamp
+
+    def follows(self, archive, ordinal):
+        return archive.timestamp > self.timestamp
+
+
+class FuzzyDatetimeArchiveSpecifier(SingleArchiveSpecifier):
+    PRIORITY = 40
 
-class FuzzyDatetimeArchiveSpecifier(ArchiveSpecifier):
     @classmethod
     def acceptable_specifier(cls, specifier_str):
         try:
@@ -82,9 +133,76 @@ class FuzzyDatetimeArchiveSpecifier(ArchiveSpecifier):
             dt = dt.replace(tzinfo=dateutil.tz.tzlocal())
         self.datetime = dt
 
+        check = ["year", "month", "day", "hour", "minute", "second"]
+        self.checked_fields = list(reversed(list(itertools.dropwhile(lambda k: getattr(self.datetime, k) == 0 and k != "day", reversed(check)))))
+        # The spec names the whole period of its least significant field
+        period = dateutil.relativedelta.relativedelta(**{self.checked_fields[-1] + "s": 1})
+        self.period_end = self.datetime + period
+
     def evaluate(self, archive, ordinal):
         timezone_corrected_archive_time = archive.datetime.astimezone(self.datetime.tzinfo)
+        return all((getattr(self.datetime, k) == getattr(timezone_corrected_archive_time, k) for k in self.checked_fields))
 
-        check = ["year", "month", "day", "hour", "minute", "second"]
-        check = reversed(list(itertools.dropwhile(lambda k: getattr(self.datetime, k) == 0 and k != "day", reversed(check))))
-        return all((getattr(self.datetime, k) == getattr(timezone_corrected_archive_time, k) for k in check))
+    def precedes(self, archive, ordinal):
+        return archive.datetime < self.datetime
+
+    def follows(self, archive, ordinal):
+        return archive.datetime >= self.period_end
+
+
+class RangeArchiveSpecifier(ArchiveSpecifier):
+    """START..END, inclusive; either bound may be omitted."""
+    PRIORITY = 20
+
+    @classmethod
+    def acceptable_specifier(cls, specifier_str):
+        parts = specifier_str.split("..")
+        if len(parts) != 2 or not any(part.strip() for part in parts):
+            return False
+        return all(not part.strip() or SingleArchiveSpecifier.acceptable_specifier(part.strip())
+                   for part in parts)
+
+    def __init__(self, specifier_str):
+        start, end = (part.strip() for part in specifier_str.split(".."))
+        self.start = SingleArchiveSpecifier(start) if start else None
+        self.end = SingleArchiveSpecifier(end) if end else None
+        self.uses_ordinals = any(bound.uses_ordinals for bound in [self.start, self.end]
+                                 if bound is not None)
+
+    def evaluate(self, archive, ordinal):
+        if self.start is not None and self.start.precedes(archive, ordinal):
+            return False
+        if self.end is not None and self.end.follows(archive, ordinal):
+            return False
+        return True
+
+
+class MultiArchiveSpecifier(ArchiveSpecifier):
+    """Comma separated single or range specifiers; matches any of them."""
+    PRIORITY = 10
+
+    @classmethod
+    def _acceptable_part(cls, part):
+        if RangeArchiveSpecifier.acceptable_specifier(part):
+            return True
+        # Whitespace is only allowed around parts, so that dates such as
+        # "Nov 17, 2014" are not mistaken for a list.
+        return (not any(c.isspace() for c in part)
+                and SingleArchiveSpecifier.acceptable_specifier(part))
+
+    @classmethod
+    def acceptable_specifier(cls, specifier_str):
+        parts = [part.strip() for part in specifier_str.split(",")]
+        return len(parts) > 1 and all(part and cls._acceptable_part(part) for part in parts)
+
+    def __init__(self, specifier_str):
+        self.specifiers = []
+        for part in (part.strip() for part in specifier_str.split(",")):
+            if RangeArchiveSpecifier.acceptable_specifier(part):
+                self.specifiers.append(RangeArchiveSpecifier(part))
+            else:
+                self.specifiers.append(SingleArchiveSpecifier(part))
+        self.uses_ordinals = any(specifier.uses_ordinals for specifier in self.specifiers)
+
+    def evaluate(self, archive, ordinal):
+        return any(specifier.evaluate(archive, ordinal) for specifier in self.specifiers)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import pkgutil
 import inspect
+import tarfile
+import fnmatch
 import datetime
+import threading
+import collections
 import dateutil.tz
 
 from . import error
@@ -10,6 +16,9 @@ from . import error
 class BackendConfigurationError(error.Error):
     pass
 
+class BackendOperationError(error.Error):
+    pass
+
 _BACKEND_TYPES = {}
 
 def register_backend_type(type, name):
@@ -24,6 +33,56 @@ def backend_type(name):
     return _BACKEND_TYPES.get(name, None)
 
 
+Shard = collections.namedtuple("Shard", ["index", "count", "members"])
+Shard.__doc__ = """One of the count archives a backup run is split into.
+
+members are the top-level archive paths the shard holds ("home" or
+"home/projects"); the first shard also holds any command output.
+"""
+
+# Archive names of shards end in .partIofN; a group of them is named with
+# * in place of I.
+SHARD_NAME_PATTERN = r"(?:\.part(?P<shard>\d+|\*)of(?P<shards>\d+))?"
+_SHARD_NUMBER = re.compile(r"\.part\d+of(?=\d+)")
+
+def shard_suffix(shard):
+    if shard is None:
+        return ""
+    return ".part{}of{}".format(shard.index + 1, shard.count)
+
+def shard_from_match(m):
+    """The (index, count) of an archive name matched with SHARD_NAME_PATTERN."""
+    if m.group("shard") is None or m.group("shard") == "*":
+        return None
+    return (int(m.group("shard")) - 1, int(m.group("shards")))
+
+def shard_group_names(group_name, count):
+    return [group_name.replace(".part*of", ".part{}of".format(i + 1), 1) for i in range(count)]
+
+
+ArchiveSize = collections.namedtuple("ArchiveSize", ["stored", "unique"])
+ArchiveSize.__doc__ = """Bytes an archive takes on its backend, and the bytes only it
+references, which deleting it alone would free."""
+
+StorageUsage = collections.namedtuple("StorageUsage", ["total", "sizes"])
+StorageUsage.__doc__ = """Bytes a backend stores in all, and an ArchiveSize per archive."""
+
+
+class PerformResult(object):
+    """Outcome of BackupBackend.perform; true if the backup succeeded.
+
+    size is the number of bytes the archive holds and uploaded the number of
+    bytes that had to be stored, when the backend can tell.
+    """
+    def __init__(self, success, size=None, uploaded=None):
+        self.success = success
+        self.size = size
+        self.uploaded = uploaded
+
+    def __bool__(self):
+        return bool(self.success)
+
+
 class BackendType(type):
     def __init__(self, *args, **kwargs):
         super(BackendType, self).__init__(*args, **kwargs)
@@ -39,11 +98,103 @@ class BackupBackend(object, metaclass=BackendType):
         self.name = config.pop("name")
         if self.name is None:
             raise BackendConfigurationError("Missing name for backend")
+        # Relative cost of restoring from this backend; lower is preferred.
+        self.restore_cost = config.pop("restore_cost", None)
+        if self.restore_cost is not None and not isinstance(self.restore_cost, (int, float)):
+            raise BackendConfigurationError(
+                "restore_cost of backend {} must be a number".format(self.name))
+        # Bytes pruning keeps the backend's archives within, if set.
+        self.max_size = config.pop("max_size", None)
+        if self.max_size is not None and (isinstance(self.max_size, bool)
+                                          or not isinstance(self.max_size, int)
+                                          or self.max_size < 0):
+            raise BackendConfigurationError(
+                "max_size of backend {} must be a number of bytes".format(self.name))
 
     def __str__(self):
         return "{}: {}".format(self.__class__.__name__, self.name)
 
+    def estimate_size(self, paths, backup_name, excludes=None):
+        """Return the bytes a backup of paths would upload, or None if unknown."""
+        return None
+
+    def archive_for_name(self, backup_name, timestamp, fullname):
+        """Return the archive called fullname without listing the backend."""
+        raise BackendOperationError("{} can't look up archives by name".format(self.name))
+
+    def storage_usage(self, archives):
+        """Return the StorageUsage of the backend and of each of archives."""
+        raise BackendOperationError("{} can't report storage usage".format(self.name))
+
+    def shard_archive(self, backup_name, timestamp, shard):
+        """Return the archive perform(..., shard=shard) creates at timestamp."""
+        raise BackendOperationError("{} can't shard backups".format(self.name))
+
+    def store_archive(self, backup_name, timestamp, write_tar):
+        """Store the tar stream write_tar(fileobj) writes as an archive of
+        backup_name taken at timestamp, returning a PerformResult.
+
+        write_tar returns whether it wrote the whole archive, and may be
+        called again if the backend retries.
+        """
+        raise BackendOperationError("{} can't store archive streams".format(self.name))
+
+    def destroy_archives(self, archives):
+        """Destroy several archives of this backend, returning overall success.
+
+        Backends that can delete many archives in one operation override this.
+        """
+        success = True
+        for archive in archives:
+            success = archive.destroy() and success
+        return success
+
+def group_shards(archives):
+    """archives, with the shards of each sharded backup replaced by a
+    ShardedArchive."""
+    grouped = []
+    groups = collections.OrderedDict()
+    for archive in archives:
+        if archive.shard is None:
+            grouped.append(archive)
+        else:
+            groups.setdefault((archive.timestamp, archive.shard[1]), []).append(archive)
+    for (timestamp, count), shards in groups.items():
+        first = shards[0]
+        grouped.append(ShardedArchive(first.backend, timestamp,
+                                      _SHARD_NUMBER.sub(".part*of", first.fullname),
+                                      first.backup_name, shards, count))
+    return grouped
+
+def expand_shards(archives):
+    """archives, with each ShardedArchive replaced by its shards."""
+    expanded = []
+    for archive in archives:
+        expanded.extend(getattr(archive, "shards", [archive]))
+    return expanded
+
+def group_sizes(archives, shard_sizes):
+    """Sizes of archives, some of them ShardedArchives, given the sizes of
+    the plain archives and shards in shard_sizes."""
+    sizes = {}
+    for archive in archives:
+        parts = [shard_sizes[shard] for shard in getattr(archive, "shards", [archive])]
+        sizes[archive] = ArchiveSize(sum(size.stored for size in parts),
+                                     sum(size.unique for size in parts))
+    return sizes
+
+def _member_matches(pattern, name):
+    parts = name.rstrip("/").split("/")
+    pattern = pattern.rstrip("/")
+    return any(fnmatch.fnmatchcase("/".join(parts[:i]), pattern) for i in range(1, len(parts) + 1))
+
+
 class Archive(object):
+    # (index, count) of a shard of a sharded backup.
+    shard = None
+    # False for a sharded backup some of whose shards are missing.
+    complete = True
+
     @property
     def datetime(self):
         dt = datetime.datetime.fromtimestamp(self.timestamp)
@@ -53,5 +204,91 @@ class Archive(object):
     def __str__(self):
         return "'{}' with {} at {}".format(self.backup_name, self.backend.name, self.datetime)
 
+    def write_tar(self, fileobj):
+        """Write the archive as a tar stream to fileobj, returning success."""
+        raise BackendOperationError("{} can't stream archives".format(self.backend.name))
+
+class ShardedArchive(Archive):
+    """The archives of one run of a sharded backup, handled as one archive."""
+
+    def __init__(self, backend, timestamp, fullname, backup_name, shards, count):
+        self.backend = backend
+        self.timestamp = timestamp
+        self.fullname = fullname
+        self.backup_name = backup_name
+        self.shards = sorted(shards, key=lambda archive: archive.shard[0])
+        self.count = count
+
+    @property
+    def complete(self):
+        return len(self.shards) == self.count
+
+    def __str__(self):
+        description = super(ShardedArchive, self).__str__()
+        if not self.complete:
+            description += " (only {} of {} shards)".format(len(self.shards), self.count)
+        return description
+
+    def restore(self, destination, members=None):
+        if not self.complete:
+            raise BackendOperationError("{} is missing shards".format(self))
+        success = True
+        for shard in self.shards:
+            shard_members = members
+            if members:
+                contents = shard.list_contents()
+                shard_members = [member for member in members
+                                 if any(_member_matches(member, name) for name in contents)]
+                if not shard_members:
+                    continue
+            success = shard.restore(destination, shard_members) and success
+        return success
+
+    def list_contents(self):
+        contents = []
+        for shard in self.shards:
+            contents.extend(shard.list_contents())
+        return contents
+
+    def write_tar(self, fileobj):
+        """Write the members of all the shards as one tar stream."""
+        if not self.complete:
+            raise BackendOperationError("{} is missing shards".format(self))
+        with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as out:
+            for shard in self.shards:
+                if not _copy_members(shard, out):
+                    return False
+        return True
+
+    def destroy(self):
+        return self.backend.destroy_archives(self.shards)
+
+def _copy_members(archive, out):
+    """Add the members of archive to the tarfile out, returning success."""
+    read_fd, write_fd = os.pipe()
+    results = []
+    def produce():
+        with open(write_fd, "wb") as pipe:
+            try:
+                results.append(archive.write_tar(pipe))
+            except OSError:
+                results.append(False)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    try:
+        with open(read_fd, "rb") as pipe:
+            try:
+                with tarfile.open(fileobj=pipe, mode="r|") as tar:
+                    for member in tar:
+                        out.addfile(member, tar.extractfile(member) if member.isfile() else None)
+            except tarfile.TarError:
+                results.append(False)
+            # Let the producer finish writing the end of the archive.
+            while pipe.read(1024 * 1024):
+                pass
+    finally:
+        producer.join()
+    return all(results) and bool(results)
+
 def load_backend_types():
     from . import backup_backends
@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import datetime
 import itertools
 import time
+import bisect
+import copy
+import hashlib
+import collections
+import concurrent.futures
 
-import dateutil.tz, dateutil.relativedelta
+import dateutil.tz
 
 from . import package_logger
+from . import error
+from . import logging_handlers
+from . import profiling
+from . import backend_types
 
 WEEKDAYS = [object() for _ in range(7)]
 MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY = WEEKDAYS
@@ -16,46 +26,214 @@ WEEKLY = object()
 
 WEEKDAY_NUMBERS = dict(zip(WEEKDAYS, itertools.count()))
 
-WEEKDAY_RELATIVE_DAY_MAP = [
-    dateutil.relativedelta.MO,
-    dateutil.relativedelta.TU,
-    dateutil.relativedelta.WE,
-    dateutil.relativedelta.TH,
-    dateutil.relativedelta.FR,
-    dateutil.relativedelta.SA,
-    dateutil.relativedelta.SU
-]
+ONE_MINUTE = datetime.timedelta(minutes=1)
+ONE_HOUR = datetime.timedelta(hours=1)
+ONE_DAY = datetime.timedelta(days=1)
 
 LOCAL_TZ = dateutil.tz.tzlocal()
 
+STATE_VERSION = 2
+
 def module_logger():
     return package_logger().getChild("backup")
 
-def next_due_run(timespec, since):
-    def next_due_run_part(part):
-        tgt = None
+def upgrade_state(state):
+    """Convert state in any older format to the current one.
+
+    The current format is {"version": 2, "backups": {name: {"last_run": ts,
+    "backends": {backend name: {"duration": s, "bytes": n, ...}}}}}. The
+    original format mapped backup names straight to their last run.
+    """
+    if (isinstance(state, dict) and state.get("version") == STATE_VERSION
+            and isinstance(state.get("backups"), dict)):
+        return state
+    backups = {}
+    if isinstance(state, dict):
+        for name, stamp in state.items():
+            if isinstance(stamp, (int, float)):
+                backups[name] = {"last_run": stamp}
+    return {"version": STATE_VERSION, "backups": backups}
+
+def apply_journal_record(state, record):
+    """Apply a record made by BackupSet.journal_record to state in place."""
+    entry = state["backups"].setdefault(record["backup"], {})
+    if "last_run" in record:
+        entry["last_run"] = record["last_run"]
+    entry.setdefault("backends", {}).update(record.get("backends", {}))
+
+def schedule_jitter(host, backup_name, window_length):
+    """A delay within window_length that is fixed for each host and backup
+    but spreads many of them evenly over the window."""
+    digest = hashlib.sha256("{}\0{}".format(host, backup_name).encode("utf-8")).digest()
+    fraction = int.from_bytes(digest[:8], "big") / 2 ** 64
+    return datetime.timedelta(seconds=int(fraction * window_length.total_seconds()))
+
+def _midnight(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _next_month_start(dt):
+    if dt.month == 12:
+        return _midnight(dt).replace(year=dt.year + 1, month=1, day=1)
+    return _midnight(dt).replace(month=dt.month + 1, day=1)
+
+def _next_weekday_midnight(weekday, since):
+    # The day after since is the earliest candidate, so a backup that ran on
+    # the selected weekday is not due again until a week later.
+    midnight = _midnight(since) + ONE_DAY
+    return midnight + datetime.timedelta(days=(weekday - midnight.weekday()) % 7)
+
+
+class IntervalSchedule(object):
+    def __init__(self, interval):
+        if interval <= datetime.timedelta(0):
+            raise ValueError("Interval must be positive")
+        self.interval = interval
+
+    def next_fire(self, since):
+        return since + self.interval
+
+    def __repr__(self):
+        return "IntervalSchedule({!r})".format(self.interval)
+
+
+class CronSchedule(object):
+    """A five-field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept "*", numbers, ranges ("a-b"), steps ("*/n", "a-b/n") and
+    comma separated lists of those. As in cron, when both the day-of-month
+    and day-of-week fields are restricted a day matching either one fires.
+    """
+
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    MAX_SEARCH_YEARS = 8
+
+    @classmethod
+    def _parse_field(cls, field, low, high):
+        values = set()
+        for item in field.split(","):
+            step = 1
+            stepped = "/" in item
+            if stepped:
+                item, step_str = item.split("/", 1)
+                step = int(step_str)
+                if step < 1:
+                    raise ValueError("Invalid step in {}".format(field))
+            if item == "*":
+                start, stop = low, high
+            elif "-" in item:
+                start_str, stop_str = item.split("-", 1)
+                start, stop = int(start_str), int(stop_str)
+            else:
+                start = int(item)
+                stop = high if stepped else start
+            if start < low or stop > high or start > stop:
+                raise ValueError("{} out of range in {}".format(item, field))
+            values.update(range(start, stop + 1, step))
+        return values
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Cron expressions have five fields: {}".format(expression))
+        self.expression = expression
+        parsed = [self._parse_field(field, low, high)
+                  for field, (low, high) in zip(fields, self.FIELD_RANGES)]
+        minutes, hours, days, months, cron_weekdays = parsed
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = frozenset(days)
+        self.months = frozenset(months)
+        # cron counts weekdays from Sunday (0 or 7), datetime from Monday (0)
+        self.weekdays = frozenset((day - 1) % 7 for day in cron_weekdays)
+        self.days_restricted = fields[2] != "*"
+        self.weekdays_restricted = fields[4] != "*"
+        # Reject expressions that can never fire, such as February 31st
+        self.next_fire(datetime.datetime(2000, 1, 1))
+
+    def _day_matches(self, dt):
+        day_ok = dt.day in self.days
+        weekday_ok = dt.weekday() in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_fire(self, since):
+        tgt = since.replace(second=0, microsecond=0) + ONE_MINUTE
+        year_limit = tgt.year + self.MAX_SEARCH_YEARS
+        while tgt.year <= year_limit:
+            if tgt.month not in self.months:
+                tgt = _next_month_start(tgt)
+                continue
+            if not self._day_matches(tgt):
+                tgt = _midnight(tgt) + ONE_DAY
+                continue
+            i = bisect.bisect_left(self.hours, tgt.hour)
+            if i == len(self.hours):
+                tgt = _midnight(tgt) + ONE_DAY
+                continue
+            if self.hours[i] != tgt.hour:
+                tgt = tgt.replace(hour=self.hours[i], minute=0)
+            j = bisect.bisect_left(self.minutes, tgt.minute)
+            if j == len(self.minutes):
+                tgt = tgt.replace(minute=0) + ONE_HOUR
+                continue
+            return tgt.replace(minute=self.minutes[j])
+        raise ValueError("Cron expression {} never fires".format(self.expression))
+
+    def __repr__(self):
+        return "CronSchedule({!r})".format(self.expression)
+
+
+def next_due_run(timespec, since, offset=datetime.timedelta(0)):
+    """When a backup that last ran at since is next due.
+
+    The calendar parts of timespec fall due offset after midnight rather
+    than at midnight; interval and cron parts are unaffected.
+    """
+    due = None
+    shifted = since - offset
+    for part in timespec:
         if part is MONTHLY:
-            rel = (dateutil.relativedelta
-                   .relativedelta(months=1, day=1, hour=0, minute=0, second=0,
-                                  microsecond=0))
             # Go to midnight on the first of the next month
-            tgt = since + rel
-        if part is WEEKLY:
-            part = MONDAY
-        if part in WEEKDAYS:
-            # if since is the same weekday as we have selected, "1st <day>"
-            # would just be that day, so we need to also advance one day before
-            # asking for the "1st <day>".
-            relative_cls = WEEKDAY_RELATIVE_DAY_MAP[WEEKDAY_NUMBERS[part]]
-            day = relative_cls(1)
-            rel = (dateutil.relativedelta
-                   .relativedelta(weekday=day, days=+1, hour=0, minute=0,
-                                  second=0, microsecond=0))
-            tgt = since + rel
-
-        assert tgt is not None
-        return tgt
-    return min((next_due_run_part(part) for part in timespec))
+            tgt = _next_month_start(shifted) + offset
+        elif part is WEEKLY:
+            tgt = _next_weekday_midnight(0, shifted) + offset
+        elif part in WEEKDAY_NUMBERS:
+            tgt = _next_weekday_midnight(WEEKDAY_NUMBERS[part], shifted) + offset
+        else:
+            tgt = part.next_fire(since)
+        if due is None or tgt < due:
+            due = tgt
+
+    assert due is not None
+    return due
+
+
+class BackendRun(object):
+    def __init__(self, success, duration, size=None, uploaded=None):
+        self.success = success
+        self.duration = duration
+        self.size = size
+        self.uploaded = uploaded
+
+
+class BackupResult(object):
+    """The outcome of Backup.perform; true if every backend succeeded."""
+
+    def __init__(self):
+        self.backend_runs = collections.OrderedDict()
+        self.success = True
+
+    def add(self, backend, outcome, duration):
+        if isinstance(outcome, backend_types.PerformResult):
+            run = BackendRun(outcome.success, duration, outcome.size, outcome.uploaded)
+        else:
+            run = BackendRun(bool(outcome), duration)
+        self.backend_runs[backend.name] = run
+        self.success = self.success and run.success
+
+    def __bool__(self):
+        return self.success
 
 
 class Backup(object):
@@ -63,29 +241,156 @@ class Backup(object):
     def logger(self):
         return module_logger().getChild("Backup")
 
-    def __init__(self, name, paths, backup_name, timespec, backends):
+    def __init__(self, name, paths, backup_name, timespec, backends, commands=None,
+                 excludes=None, shards=1, shard_subdirectories=False,
+                 schedule_start=datetime.timedelta(0), schedule_jitter=datetime.timedelta(0)):
         self.name = name
         self.paths = paths
+        self.commands = commands or {}
+        self.excludes = excludes
+        self.shards = shards
+        self.shard_subdirectories = shard_subdirectories
         self.backup_name = backup_name
         self.timespec = timespec
         self.backends = backends
+        # Calendar timespecs fall due schedule_start after midnight (negative
+        # for a window opening the evening before), plus this host's jitter.
+        self.schedule_start = schedule_start
+        self.schedule_jitter = schedule_jitter
+
+    @property
+    def schedule_offset(self):
+        return self.schedule_start + self.schedule_jitter
 
     def should_run(self, last_run, now):
-        due = next_due_run(self.timespec, last_run)
+        due = next_due_run(self.timespec, last_run, self.schedule_offset)
         return due < now
 
-    def perform(self, now):
-        success = True
+    def scan_excludes(self):
+        """What our excludes leave out right now, or None without excludes."""
+        if not self.excludes:
+            return None
+        with profiling.span("scan excludes of {}".format(self.name)):
+            scan = self.excludes.scan(self.paths)
+        if scan.measured:
+            self.logger.info("Excludes leave {} entries ({} bytes) out of {}".format(
+                scan.excluded_entries, scan.excluded_bytes, self.name))
+        return scan
+
+    def shard_plan(self):
+        """The shards to split a run into, or None to write one archive.
+
+        Our paths, or with shard_subdirectories the entries directly under
+        them, are dealt out in name order.
+        """
+        if self.shards < 2:
+            return None
+        members = []
+        for path, name in sorted(self.paths.items(), key=lambda item: item[1]):
+            entries = []
+            if self.shard_subdirectories and os.path.isdir(path):
+                try:
+                    entries = sorted(os.listdir(path))
+                except OSError as e:
+                    self.logger.warning("Not splitting {}: {}".format(path, e))
+            members += ["/".join([name, entry]) for entry in entries] or [name]
+        count = min(self.shards, len(members))
+        if count < 2:
+            return None
+        return [backend_types.Shard(i, count, members[i::count]) for i in range(count)]
+
+    def perform_shard(self, backend, now, excludes, shard):
+        with logging_handlers.log_context(backup=self.name, backend=backend.name), \
+                profiling.span("back up {} shard {} to {}".format(
+                    self.name, shard.index + 1, backend.name)):
+            try:
+                return backend.perform(self.paths, self.name, now,
+                                       commands=self.commands if shard.index == 0 else None,
+                                       excludes=excludes, shard=shard)
+            except error.Error as e:
+                self.logger.error("Shard {} of {} on {} failed: {}".format(
+                    shard.index + 1, self.name, backend.name, e))
+                return backend_types.PerformResult(False)
+
+    def perform_shards(self, backend, now, excludes, shards):
+        """Write each shard as its own archive, concurrently where the backend
+        allows, and combine the results.
+
+        If any shard fails the others are destroyed, so that an incomplete
+        group is never taken for a backup.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [logging_handlers.submit_with_context(
+                           executor, self.perform_shard, backend, now, excludes, shard)
+                       for shard in shards]
+            results = [future.result() for future in futures]
+        if all(results):
+            def total(values):
+                return None if None in values else sum(values)
+            return backend_types.PerformResult(True, total([r.size for r in results]),
+                                               total([r.uploaded for r in results]))
+        written = [backend.shard_archive(self.name, now, shard)
+                   for shard, result in zip(shards, results) if result]
+        if written:
+            self.logger.error("Destroying the {} shards of {} that were written".format(
+                len(written), self.name))
+            backend.destroy_archives(written)
+        return backend_types.PerformResult(False)
+
+    def perform_on_backend(self, backend, now, excludes=None, shards=None):
+        with logging_handlers.log_context(backup=self.name, backend=backend.name), \
+                profiling.span("back up {} to {}".format(self.name, backend.name)):
+            start = time.monotonic()
+            try:
+                if shards is None:
+                    outcome = backend.perform(self.paths, self.name, now,
+                                              commands=self.commands, excludes=excludes)
+                else:
+                    outcome = self.perform_shards(backend, now, excludes, shards)
+            except error.Error as e:
+                self.logger.error("Backup of {} to {} failed: {}".format(self.name, backend.name, e))
+                outcome = False
+            return outcome, time.monotonic() - start
+
+    def perform(self, now, backends=None):
+        """Back up to each of backends (default: all of ours) concurrently.
+
+        Every backend runs regardless of the others failing, and each
+        outcome is recorded separately in the result.
+        """
+        if backends is None:
+            backends = self.backends
+        result = BackupResult()
+        if not backends:
+            return result
+        excludes = self.scan_excludes()
+        shards = self.shard_plan()
+        if shards is not None:
+            self.logger.info("Splitting {} into {} archives".format(self.name, len(shards)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            futures = [(backend, logging_handlers.submit_with_context(
+                            executor, self.perform_on_backend, backend, now, excludes, shards))
+                       for backend in backends]
+            for backend, future in futures:
+                outcome, duration = future.result()
+                result.add(backend, outcome, duration)
+        return result
+
+    def estimate_size(self):
+        excludes = self.scan_excludes()
         for backend in self.backends:
-            success = success and backend.perform(self.paths, self.name, now)
-        return success
+            size = backend.estimate_size(self.paths, self.name, excludes=excludes)
+            if size is not None:
+                return size
+        return None
 
     def get_all_archives(self, backends=None, backend_to_primed_list_token_map=None):
         if backends is None:
             backends = self.backends
 
+        owned_backends = set(self.backends)
         for backend in backends:
-            if backend not in self.backends:
+            if backend not in owned_backends:
                 raise Exception("Passed a backend we don't own!?")
 
         pairs = []
@@ -112,33 +417,141 @@ class BackupSet(object):
     def __init__(self, state, configured_backups, config_mtime, state_mtime,
                  now):
         self.configured_backups = configured_backups
+        self.backups_by_name = {backup.name: backup for backup in configured_backups}
         self.config_mtime = config_mtime
         self.state_mtime = state_mtime
         self.state = state
         self.now = now
 
-    def state_after_backups(self, backups):
-        new_state = self.state.copy()
-        for backup in backups:
-            new_state[backup.name] = time.mktime(self.now.timetuple())
+    def state_after_results(self, results, state=None):
+        """The state after the (backup, BackupResult) pairs in results.
+
+        Only the entries of backups in results change; the rest are taken
+        from state, which defaults to the state this set was loaded with.
+        """
+        new_state = copy.deepcopy(self.state if state is None else state)
+        for backup, result in results:
+            apply_journal_record(new_state, self.journal_record(backup, result))
         return new_state
 
+    def journal_record(self, backup, result):
+        """What the BackupResult result changes in the state, as a JSON object."""
+        stamp = time.mktime(self.now.timetuple())
+        record = {"backup": backup.name, "backends": {}}
+        if result:
+            record["last_run"] = stamp
+        for backend_name, run in result.backend_runs.items():
+            if run.success:
+                record["backends"][backend_name] = {
+                    "duration": run.duration,
+                    "bytes": run.size,
+                    "uploaded": run.uploaded,
+                    "last_success": stamp,
+                }
+        return record
+
+    def backup_state(self, backup):
+        return self.state["backups"].get(backup.name, {})
+
     def last_run_of_backup(self, backup):
-        stamp = self.state.get(backup.name, 0)
+        stamp = self.backup_state(backup).get("last_run", 0)
         return datetime.datetime.fromtimestamp(stamp).replace(tzinfo=LOCAL_TZ)
 
-    def backups_due(self):
-        backups_to_run = []
+    def last_success_on_backend(self, backup, backend):
+        entry = self.backup_state(backup)
+        history = entry.get("backends", {}).get(backend.name, {})
+        stamp = history.get("last_success", entry.get("last_run", 0))
+        return datetime.datetime.fromtimestamp(stamp).replace(tzinfo=LOCAL_TZ)
+
+    def config_changed_for(self, backup):
+        """Whether backup should run again for a configuration change.
+
+        It runs once its schedule jitter has passed since the change, so that
+        hosts given a new configuration together don't all run at once.
+        """
+        if self.config_mtime <= self.latest_run(backup):
+            return False
+        changed = datetime.datetime.fromtimestamp(self.config_mtime).replace(tzinfo=LOCAL_TZ)
+        return changed + backup.schedule_jitter <= self.now
+
+    def backends_due(self, backup):
+        """The backends of backup that are due, so that a backend that failed
+        is retried without repeating the ones that succeeded."""
+        if self.config_changed_for(backup):
+            return list(backup.backends)
+        return [backend for backend in backup.backends
+                if backup.should_run(self.last_success_on_backend(backup, backend), self.now)]
+
+    def latest_run(self, backup, state=None):
+        """Timestamp of the latest run of backup on any backend."""
+        state = self.state if state is None else state
+        entry = state["backups"].get(backup.name, {})
+        stamps = [run.get("last_success", 0) for run in entry.get("backends", {}).values()]
+        return max([entry.get("last_run", 0)] + stamps)
+
+    def ran_since_loaded(self, backup, state):
+        """Whether state records a run of backup newer than the one we loaded."""
+        return self.latest_run(backup, state) > self.latest_run(backup)
+
+    def expected_duration(self, backup):
+        """Seconds the last run of backup took, or None without full history.
 
-        if self.config_mtime > self.state_mtime:
-            self.logger.info("Configuration changed. Should run all backups.")
-            return self.configured_backups
+        Backends run concurrently, so this is the slowest backend's time.
+        """
+        history = self.backup_state(backup).get("backends", {})
+        durations = [history.get(backend.name, {}).get("duration") for backend in backup.backends]
+        if not durations or None in durations:
+            return None
+        return max(durations)
 
+    def observed_throughput(self, backend=None):
+        """Uploaded bytes per second over recorded runs, of one backend or
+        all of them."""
+        total_bytes = 0
+        total_duration = 0
+        for entry in self.state["backups"].values():
+            for backend_name, run in entry.get("backends", {}).items():
+                if backend is not None and backend_name != backend.name:
+                    continue
+                if run.get("uploaded") is not None and run.get("duration"):
+                    total_bytes += run["uploaded"]
+                    total_duration += run["duration"]
+        if not total_duration:
+            return None
+        return total_bytes / total_duration
+
+    def order_longest_first(self, backups, estimated_sizes=None):
+        """Order backups by expected duration, longest first.
+
+        Starting the longest jobs first keeps the makespan of a parallel run
+        short. Backups with neither history nor a usable size estimate are
+        assumed to be the longest.
+        """
+        throughput = self.observed_throughput()
+        def expected(backup):
+            duration = self.expected_duration(backup)
+            if duration is None and estimated_sizes and throughput:
+                size = estimated_sizes.get(backup.name)
+                if size is not None:
+                    duration = size / throughput
+            return duration
+        keyed = [(expected(backup), i, backup) for i, backup in enumerate(backups)]
+        keyed.sort(key=lambda x: (x[0] is not None, -(x[0] or 0), x[1]))
+        return [backup for _, _, backup in keyed]
+
+    def backups_due(self):
+        backups_to_run = []
         for backup in self.configured_backups:
-            if backup.should_run(self.last_run_of_backup(backup), self.now):
+            if self.config_changed_for(backup):
+                self.logger.info("Configuration changed. Should run {}.".format(backup.name))
+                backups_to_run.append(backup)
+            elif self.backends_due(backup):
                 backups_to_run.append(backup)
         return backups_to_run
 
     def all_backups(self):
         return self.configured_backups
 
+    def backup_by_name(self, name):
+        return self.backups_by_name.get(name, None)
+
@@ -1,3 +1,4 @@
 #!/usr/bin/env python3
 
 from . import tarsnap
+from . import object_store
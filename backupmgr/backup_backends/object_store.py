@@ -0,0 +1,657 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import hmac
+import base64
+import fnmatch
+import hashlib
+import tarfile
+import datetime
+import threading
+import itertools
+import contextlib
+import http.client
+import urllib.parse
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
+
+from .. import backend_types
+from .. import package_logger
+from .. import command_output
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+# Limits of S3 multipart uploads; only the last part may be smaller.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+DELETE_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 1024 * 1024
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+RETRYABLE_STATUSES = frozenset([500, 502, 503, 504])
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+def module_logger():
+    return package_logger().getChild("object_store")
+
+def _quote(value):
+    return urllib.parse.quote(value, safe="-_.~")
+
+def _quote_path(path):
+    return "/".join(_quote(segment) for segment in path.split("/"))
+
+def _sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _hmac_sha256(key, message):
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+def canonical_query_string(query):
+    return "&".join("{}={}".format(_quote(k), _quote(v)) for k, v in sorted(query.items()))
+
+def sign_request(method, path, query, headers, payload_sha256, access_key,
+                 secret_key, region, now, service="s3"):
+    """Add AWS signature version 4 headers to headers, which must include Host.
+
+    path is the unencoded request path and query a dict of its parameters.
+    """
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    datestamp = now.strftime("%Y%m%d")
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_sha256
+
+    canonical_headers = {name.lower(): " ".join(str(value).split())
+                         for name, value in headers.items()}
+    signed_headers = ";".join(sorted(canonical_headers))
+    canonical_request = "\n".join([
+        method,
+        _quote_path(path),
+        canonical_query_string(query),
+        "".join("{}:{}\n".format(name, canonical_headers[name])
+                for name in sorted(canonical_headers)),
+        signed_headers,
+        payload_sha256,
+    ])
+
+    scope = "{}/{}/{}/aws4_request".format(datestamp, region, service)
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope,
+        _sha256_hex(canonical_request.encode("utf-8"))])
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in [datestamp, region, service, "aws4_request"]:
+        key = _hmac_sha256(key, part)
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (
+        "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}"
+        .format(access_key, scope, signed_headers, signature))
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def _children(element, name):
+    return [child for child in element if _local_name(child.tag) == name]
+
+def _child_text(element, name, default=None):
+    for child in _children(element, name):
+        return child.text or ""
+    return default
+
+def _element(name, text=None):
+    element = ElementTree.Element(name)
+    if text is not None:
+        element.text = text
+    return element
+
+
+class ObjectStoreError(backend_types.BackendOperationError):
+    def __init__(self, msg, status=None, code=None):
+        super(ObjectStoreError, self).__init__(msg)
+        self.status = status
+        self.code = code
+
+
+class ObjectStoreClient(object):
+    """Minimal client for the S3 API, using path-style bucket addressing.
+
+    Connections are kept per thread, so a client can be shared by threads.
+    Server errors and dropped connections are retried with exponential
+    backoff.
+    """
+
+    @property
+    def logger(self):
+        return module_logger().getChild("ObjectStoreClient")
+
+    def __init__(self, endpoint, bucket, region, access_key, secret_key,
+                 retries=3, retry_delay=1, timeout=60):
+        parsed = urllib.parse.urlsplit(endpoint)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            raise backend_types.BackendConfigurationError(
+                "Invalid object store endpoint: {}".format(endpoint))
+        self.secure = parsed.scheme == "https"
+        self.host = parsed.netloc
+        self.base_path = parsed.path.rstrip("/")
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _new_connection(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._new_connection()
+            self._local.connection = connection
+        return connection
+
+    def _discard_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _path(self, key):
+        path = "{}/{}".format(self.base_path, self.bucket)
+        if key:
+            path += "/" + key
+        return path
+
+    def _signed_headers(self, method, path, query, body, headers):
+        headers = dict(headers or {})
+        headers["Host"] = self.host
+        sign_request(method, path, query, headers, _sha256_hex(body),
+                     self.access_key, self.secret_key, self.region,
+                     datetime.datetime.now(datetime.timezone.utc))
+        return headers
+
+    def _url(self, path, query):
+        url = _quote_path(path)
+        if query:
+            url += "?" + canonical_query_string(query)
+        return url
+
+    def _error(self, method, key, status, data):
+        code = message = None
+        try:
+            root = ElementTree.fromstring(data)
+            code = _child_text(root, "Code")
+            message = _child_text(root, "Message")
+        except ElementTree.ParseError:
+            pass
+        return ObjectStoreError("{} {} failed with status {}: {}".format(
+            method, key or self.bucket, status, message or code or "no details"),
+            status, code)
+
+    def request(self, method, key="", query=None, body=b"", headers=None, expected=(200,)):
+        """Send a signed request and return the response and its body."""
+        query = dict(query or {})
+        path = self._path(key)
+        for attempt in itertools.count():
+            signed = self._signed_headers(method, path, query, body, headers)
+            try:
+                connection = self._connection()
+                connection.request(method, self._url(path, query), body=body, headers=signed)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                self._discard_connection()
+                failure = ObjectStoreError("{} {} failed: {}".format(method, key or self.bucket, e))
+            else:
+                if response.status in expected:
+                    return response, data
+                failure = self._error(method, key, response.status, data)
+                if response.status not in RETRYABLE_STATUSES:
+                    raise failure
+            if attempt >= self.retries:
+                raise failure
+            delay = self.retry_delay * 2 ** attempt
+            self.logger.warning("{}; retrying in {} seconds".format(failure, delay))
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def get_object(self, key):
+        """The response for key, to be read as a stream."""
+        path = self._path(key)
+        connection = self._new_connection()
+        try:
+            try:
+                connection.request("GET", self._url(path, {}),
+                                   headers=self._signed_headers("GET", path, {}, b"", None))
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                raise ObjectStoreError("GET {} failed: {}".format(key, e))
+            if response.status != 200:
+                raise self._error("GET", key, response.status, response.read())
+            yield response
+        finally:
+            connection.close()
+
+    def list_objects(self, prefix):
+        """Yield (key, size) for every object under prefix, page by page."""
+        query = {"list-type": "2", "prefix": prefix}
+        while True:
+            _, data = self.request("GET", query=query)
+            root = ElementTree.fromstring(data)
+            for contents in _children(root, "Contents"):
+                yield _child_text(contents, "Key"), int(_child_text(contents, "Size", "0"))
+            if _child_text(root, "IsTruncated") != "true":
+                break
+            query["continuation-token"] = _child_text(root, "NextContinuationToken")
+
+    def create_multipart_upload(self, key):
+        _, data = self.request("POST", key, {"uploads": ""})
+        return _child_text(ElementTree.fromstring(data), "UploadId")
+
+    def upload_part(self, key, upload_id, number, data):
+        response, _ = self.request("PUT", key, {"partNumber": str(number), "uploadId": upload_id},
+                                   body=data)
+        return response.getheader("ETag")
+
+    def list_parts(self, key, upload_id):
+        """Map part numbers already uploaded to their (ETag, size)."""
+        parts = {}
+        query = {"uploadId": upload_id}
+        while True:
+            _, data = self.request("GET", key, query)
+            root = ElementTree.fromstring(data)
+            for part in _children(root, "Part"):
+                parts[int(_child_text(part, "PartNumber"))] = (
+                    _child_text(part, "ETag"), int(_child_text(part, "Size", "0")))
+            if _child_text(root, "IsTruncated") != "true":
+                break
+            query["part-number-marker"] = _child_text(root, "NextPartNumberMarker")
+        return parts
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        root = ElementTree.Element("CompleteMultipartUpload", xmlns=S3_NAMESPACE)
+        for number, etag in sorted(etags.items()):
+            part = ElementTree.SubElement(root, "Part")
+            part.append(_element("PartNumber", str(number)))
+            part.append(_element("ETag", etag))
+        _, data = self.request("POST", key, {"uploadId": upload_id},
+                               body=ElementTree.tostring(root))
+        # Completion can fail after the 200 status has been sent.
+        result = ElementTree.fromstring(data)
+        if _local_name(result.tag) == "Error":
+            raise ObjectStoreError("Completing upload of {} failed: {}".format(
+                key, _child_text(result, "Message")), code=_child_text(result, "Code"))
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request("DELETE", key, {"uploadId": upload_id}, expected=(200, 204))
+
+    def delete_objects(self, keys):
+        """Delete keys in one request, returning {key: message} for failures."""
+        root = ElementTree.Element("Delete", xmlns=S3_NAMESPACE)
+        root.append(_element("Quiet", "true"))
+        for key in keys:
+            obj = ElementTree.SubElement(root, "Object")
+            obj.append(_element("Key", key))
+        body = ElementTree.tostring(root)
+        md5 = base64.b64encode(hashlib.md5(body).digest()).decode("ascii")
+        _, data = self.request("POST", query={"delete": ""}, body=body,
+                               headers={"Content-MD5": md5})
+        return {_child_text(error, "Key"): _child_text(error, "Message")
+                for error in _children(ElementTree.fromstring(data), "Error")}
+
+
+class TooManyPartsError(ObjectStoreError):
+    pass
+
+class MultipartWriter(object):
+    """File object uploading what is written to it as parts of an upload.
+
+    Up to concurrency parts are in flight while the next one fills. A part
+    in known_parts with the same MD5 and size is not uploaded again, which
+    is how an interrupted upload resumes.
+    """
+
+    def __init__(self, client, key, upload_id, part_size, concurrency, known_parts=None):
+        self.client = client
+        self.key = key
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.known_parts = known_parts or {}
+        self.buffer = bytearray()
+        self.next_number = 1
+        self.etags = {}
+        self.size = 0
+        self.uploaded = 0
+        self.failure = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    def _check(self):
+        if self.failure is not None:
+            raise self.failure
+
+    def _upload(self, number, data):
+        try:
+            etag = self.client.upload_part(self.key, self.upload_id, number, data)
+            with self._lock:
+                self.etags[number] = etag
+                self.uploaded += len(data)
+        except ObjectStoreError as e:
+            with self._lock:
+                self.failure = self.failure or e
+        finally:
+            self._slots.release()
+
+    def _submit(self, data):
+        number = self.next_number
+        if number > MAX_PARTS:
+            raise TooManyPartsError(
+                "{} needs more than {} parts of {} bytes; raise part_size".format(
+                    self.key, MAX_PARTS, self.part_size))
+        self.next_number += 1
+        self.size += len(data)
+        known = self.known_parts.get(number)
+        if known is not None:
+            etag, size = known
+            if size == len(data) and etag.strip('"') == hashlib.md5(data).hexdigest():
+                self.etags[number] = etag
+                return
+        self._slots.acquire()
+        self._check()
+        self._executor.submit(self._upload, number, data)
+
+    def write(self, data):
+        self._check()
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def finish(self):
+        """Upload what's left and wait; returns the ETag of each part."""
+        if self.buffer or self.next_number == 1:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._executor.shutdown(wait=True)
+        self._check()
+        return self.etags
+
+    def abandon(self):
+        self._executor.shutdown(wait=True)
+
+
+def _member_selected(name, members):
+    return any(fnmatch.fnmatchcase(name, member)
+               or name.startswith(member.rstrip("/") + "/")
+               for member in members)
+
+# Backups are our own, but still refuse members that would land outside the
+# destination.
+_EXTRACT_OPTIONS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+class ObjectStoreArchive(backend_types.Archive):
+    @property
+    def logger(self):
+        return package_logger().getChild("object_store_archive")
+
+    def __init__(self, backend, timestamp, fullname, backup_name, shard=None):
+        self.fullname = fullname
+        self.backend = backend
+        self.timestamp = timestamp
+        self.backup_name = backup_name
+        self.shard = shard
+
+    def restore(self, destination, members=None):
+        try:
+            with self.backend.client.get_object(self.fullname) as response, \
+                    tarfile.open(fileobj=response, mode="r|") as tar:
+                for info in tar:
+                    if not members or _member_selected(info.name, members):
+                        tar.extract(info, destination, **_EXTRACT_OPTIONS)
+        except (ObjectStoreError, tarfile.TarError, OSError) as e:
+            self.logger.error("Failed to restore {}: {}".format(self.fullname, e))
+            return False
+        return True
+
+    def write_tar(self, fileobj):
+        # Only failures reading are ours; the destination handles its own.
+        with contextlib.ExitStack() as stack:
+            try:
+                response = stack.enter_context(self.backend.client.get_object(self.fullname))
+            except ObjectStoreError as e:
+                self.logger.error(str(e))
+                return False
+            while True:
+                try:
+                    chunk = response.read(STREAM_CHUNK_SIZE)
+                except (OSError, http.client.HTTPException) as e:
+                    self.logger.error("Reading {} failed: {}".format(self.fullname, e))
+                    return False
+                if not chunk:
+                    return True
+                fileobj.write(chunk)
+
+    def list_contents(self):
+        try:
+            with self.backend.client.get_object(self.fullname) as response, \
+                    tarfile.open(fileobj=response, mode="r|") as tar:
+                return [info.name for info in tar]
+        except tarfile.TarError as e:
+            raise ObjectStoreError("Failed to read {}: {}".format(self.fullname, e))
+
+    def destroy(self):
+        return self.backend.destroy_archives([self])
+
+
+class _ObjectStorePrimedListToken(object):
+    def __init__(self, keys):
+        self.keys = keys
+
+    def iterkeys(self):
+        return iter(self.keys)
+
+
+class ObjectStoreBackend(backend_types.BackupBackend):
+    """Archives stored as tar objects PREFIX/BACKUP/TIMESTAMP.tar in a bucket
+    of an S3-compatible object store."""
+
+    NAMES = {"s3", "object_store"}
+
+    @property
+    def logger(self):
+        return package_logger().getChild("object_store_backend")
+
+    def __init__(self, config):
+        super(ObjectStoreBackend, self).__init__(config)
+        self.endpoint = config.pop("endpoint", "https://s3.amazonaws.com")
+        self.bucket = config.pop("bucket", None)
+        if self.bucket is None:
+            raise backend_types.BackendConfigurationError(
+                "Missing bucket for backend {}".format(self.name))
+        self.prefix = config.pop("prefix", "")
+        self.part_size = config.pop("part_size", DEFAULT_PART_SIZE)
+        if (isinstance(self.part_size, bool) or not isinstance(self.part_size, int)
+                or not MIN_PART_SIZE <= self.part_size <= MAX_PART_SIZE):
+            raise backend_types.BackendConfigurationError(
+                "part_size of backend {} must be between {} and {} bytes".format(
+                    self.name, MIN_PART_SIZE, MAX_PART_SIZE))
+        self.upload_concurrency = config.pop("upload_concurrency", 4)
+        self.upload_attempts = config.pop("upload_attempts", 3)
+        access_key = config.pop("access_key_id", os.environ.get("AWS_ACCESS_KEY_ID"))
+        secret_key = config.pop("secret_access_key", os.environ.get("AWS_SECRET_ACCESS_KEY"))
+        if access_key is None or secret_key is None:
+            raise backend_types.BackendConfigurationError(
+                "Missing credentials for backend {}".format(self.name))
+        self.client = ObjectStoreClient(
+            self.endpoint, self.bucket, config.pop("region", "us-east-1"),
+            access_key, secret_key, retries=config.pop("retries", 3),
+            retry_delay=config.pop("retry_delay", 1))
+
+    def __str__(self):
+        addendum = " ({}/{}/{})".format(self.endpoint, self.bucket, self.prefix)
+        return super(ObjectStoreBackend, self).__str__() + addendum
+
+    def key_for(self, backup_name, timestamp, shard=None):
+        return "{}{}/{}{}.tar".format(self.prefix, backup_name, timestamp,
+                                      backend_types.shard_suffix(shard))
+
+    def key_regex(self, backup_name):
+        return re.compile(r"^{}{}/(?P<timestamp>\d+(\.\d+)?){}\.tar$".format(
+            re.escape(self.prefix), re.escape(backup_name), backend_types.SHARD_NAME_PATTERN))
+
+    def _write_archive(self, fileobj, paths, commands, excludes=None, members=None):
+        tar_filter = None if excludes is None else excludes.tar_filter
+        sources = {name: path for path, name in paths.items()}
+        if members is None:
+            members = list(sources)
+        with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for member in members:
+                name, _, subdirectory = member.partition("/")
+                path = os.path.join(sources[name], subdirectory) if subdirectory else sources[name]
+                tar.add(path, arcname=member, filter=tar_filter)
+            if commands:
+                return command_output.add_command_output_members(tar, commands)
+        return True
+
+    def _upload(self, key, upload_id, write, resumable=True):
+        """Stream what write(fileobj) writes into the upload, resuming after
+        failures.
+
+        An upload that isn't resumable, because write won't produce the same
+        stream again, starts over from the first part instead.
+
+        Returns the part ETags, archive size, bytes sent and the result of
+        write.
+        """
+        known_parts = {}
+        uploaded = 0
+        for attempt in itertools.count(1):
+            writer = MultipartWriter(self.client, key, upload_id, self.part_size,
+                                     self.upload_concurrency, known_parts)
+            try:
+                complete = write(writer)
+                etags = writer.finish()
+                return etags, writer.size, uploaded + writer.uploaded, complete
+            except ObjectStoreError as e:
+                writer.abandon()
+                uploaded += writer.uploaded
+                if attempt >= self.upload_attempts or isinstance(e, TooManyPartsError):
+                    raise
+                if resumable:
+                    self.logger.warning("Upload of {} interrupted ({}); resuming".format(key, e))
+                    known_parts = self.client.list_parts(key, upload_id)
+                else:
+                    self.logger.warning("Upload of {} interrupted ({}); starting over".format(key, e))
+
+    def perform(self, paths, backup_name, now_timestamp, commands=None, excludes=None,
+                shard=None):
+        key = self.key_for(backup_name, time.mktime(now_timestamp.timetuple()), shard)
+        members = None if shard is None else list(shard.members)
+        sources = list(paths) if shard is None else list(members)
+        if commands:
+            sources += ["{} (from {})".format(name, argv) for name, argv in commands.items()]
+        self.logger.info("Creating backup \"{}\": {}".format(key, ", ".join(sources)))
+        # Command output differs from one run to the next, so an archive
+        # with commands can't resume from the parts already uploaded.
+        return self._store(key, lambda fileobj: self._write_archive(
+            fileobj, paths, commands, excludes, members), resumable=not commands)
+
+    def store_archive(self, backup_name, timestamp, write_tar):
+        key = self.key_for(backup_name, time.mktime(timestamp.timetuple()))
+        self.logger.info("Creating backup \"{}\" from a stream".format(key))
+        return self._store(key, write_tar)
+
+    def _store(self, key, write, resumable=True):
+        try:
+            upload_id = self.client.create_multipart_upload(key)
+        except ObjectStoreError as e:
+            self.logger.error(str(e))
+            return backend_types.PerformResult(False)
+
+        try:
+            etags, size, uploaded, complete = self._upload(key, upload_id, write, resumable)
+            if not complete:
+                self.logger.error("Archive contents did not complete")
+            else:
+                self.client.complete_multipart_upload(key, upload_id, etags)
+                return backend_types.PerformResult(True, size, uploaded)
+        except (ObjectStoreError, OSError) as e:
+            self.logger.error("Failed to upload {}: {}".format(key, e))
+
+        try:
+            self.client.abort_multipart_upload(key, upload_id)
+        except ObjectStoreError as e:
+            self.logger.warning("Couldn't abort upload of {}: {}".format(key, e))
+        return backend_types.PerformResult(False)
+
+    def archive_for_name(self, backup_name, timestamp, fullname):
+        m = self.key_regex(backup_name).match(fullname)
+        if not m or float(m.group("timestamp")) != timestamp:
+            raise backend_types.BackendOperationError(
+                "{} is not an archive of {} on {}".format(fullname, backup_name, self.name))
+        if m.group("shard") == "*":
+            count = int(m.group("shards"))
+            shards = [self.archive_for_name(backup_name, timestamp, key)
+                      for key in backend_types.shard_group_names(fullname, count)]
+            return backend_types.ShardedArchive(self, timestamp, fullname, backup_name,
+                                                shards, count)
+        return ObjectStoreArchive(self, timestamp, fullname, backup_name,
+                                  backend_types.shard_from_match(m))
+
+    def shard_archive(self, backup_name, timestamp, shard):
+        unixtime = time.mktime(timestamp.timetuple())
+        return ObjectStoreArchive(self, unixtime, self.key_for(backup_name, unixtime, shard),
+                                  backup_name, (shard.index, shard.count))
+
+    def destroy_archives(self, archives):
+        archives = backend_types.expand_shards(archives)
+        success = True
+        for start in range(0, len(archives), DELETE_BATCH_SIZE):
+            batch = archives[start:start + DELETE_BATCH_SIZE]
+            for archive in batch:
+                self.logger.info("destroying {}".format(archive))
+            try:
+                failures = self.client.delete_objects([archive.fullname for archive in batch])
+            except ObjectStoreError as e:
+                self.logger.error(str(e))
+                success = False
+                continue
+            for key, message in failures.items():
+                self.logger.error("Failed to destroy {}: {}".format(key, message))
+                success = False
+        return success
+
+    def existing_archives_for_name(self, backup_name, primed_list_token=None):
+        if primed_list_token is None:
+            primed_list_token = self.get_primed_list_token()
+
+        regex = self.key_regex(backup_name)
+        results = []
+        for key in primed_list_token.iterkeys():
+            m = regex.match(key)
+            if m:
+                results.append(ObjectStoreArchive(self, float(m.group("timestamp")), key, backup_name,
+                                                  backend_types.shard_from_match(m)))
+        return backend_types.group_shards(results)
+
+    def get_primed_list_token(self):
+        return _ObjectStorePrimedListToken(
+            [key for key, _ in self.client.list_objects(self.prefix)])
+
+    def storage_usage(self, archives):
+        """Objects share nothing, so each archive frees all of its size."""
+        archives = list(archives)
+        object_sizes = dict(self.client.list_objects(self.prefix))
+        shard_sizes = {}
+        for archive in backend_types.expand_shards(archives):
+            size = object_sizes.get(archive.fullname)
+            if size is None:
+                raise backend_types.BackendOperationError("{} no longer exists".format(archive.fullname))
+            shard_sizes[archive] = backend_types.ArchiveSize(size, size)
+        total = sum(object_sizes.values())
+        return backend_types.StorageUsage(total, backend_types.group_sizes(archives, shard_sizes))
@@ -11,47 +11,267 @@ import dateutil.tz
 import time
 import re
 import io
+import threading
+import itertools
+import collections
+import contextlib
 
 from .. import backend_types
 from .. import package_logger
+from .. import logging_handlers
+from .. import profiling
+from ..command_output import log_lines, write_command_output_archive
 
 TARSNAP_PATH = "/usr/local/bin/tarsnap"
+STREAM_CHUNK_SIZE = 1024 * 1024
+DESTROY_BATCH_SIZE = 64
+STATS_BATCH_SIZE = 64
+
+def module_logger():
+    return package_logger().getChild("tarsnap")
+
+TRANSIENT_NETWORK = "transient network error"
+SERVER_BUSY = "server busy"
+KEY_ERROR = "key or configuration error"
+CACHE_NEEDS_FSCK = "cache needs fsck"
+UNKNOWN_FAILURE = "unknown failure"
+BACKEND_DOWN = "backend down"
+TIMED_OUT = "timed out"
+STALLED = "stalled"
+
+RETRYABLE_FAILURES = frozenset([TRANSIENT_NETWORK, SERVER_BUSY])
+# Failures that suggest the backend is unreachable, once retries are spent.
+CIRCUIT_BREAKING_FAILURES = RETRYABLE_FAILURES | frozenset([TIMED_OUT, STALLED])
+
+OPERATIONS = frozenset(["default", "create", "estimate", "list", "contents",
+                        "restore", "read", "delete"])
+
+WATCHDOG_PREFIX = "backupmgr watchdog: "
+
+# Checked in order; the first match classifies the failure.
+FAILURE_PATTERNS = [
+    (TIMED_OUT, re.compile(r"^" + WATCHDOG_PREFIX + r"timeout", re.M)),
+    (STALLED, re.compile(r"^" + WATCHDOG_PREFIX + r"no activity", re.M)),
+    (CACHE_NEEDS_FSCK, re.compile(r"--fsck|sequence number mismatch", re.I)),
+    (KEY_ERROR, re.compile(r"key ?file|cannot read key|keys? (?:are|is) (?:missing|not)|"
+                           r"unrecognized option|usage:", re.I)),
+    (SERVER_BUSY, re.compile(r"server (?:is )?(?:too )?busy|try again later", re.I)),
+    (TRANSIENT_NETWORK, re.compile(r"connect|network|timed out|resolv|unreachable|"
+                                   r"reset by peer|broken pipe|"
+                                   r"(?:communicating|communication) with (?:the )?server|"
+                                   r"no response from (?:the )?server", re.I)),
+]
+
+OUTPUT_LINES_KEPT = 50
+
+def classify_failure(code, output):
+    for failure_class, pattern in FAILURE_PATTERNS:
+        if pattern.search(output):
+            return failure_class
+    return UNKNOWN_FAILURE
+
+STATS_LINE_REGEX = re.compile(r"^\s*(?P<row>This archive|New data|All archives)\s+(?P<total>\d+)\s+(?P<compressed>\d+)\s*$",
+                              re.M)
+
+def parse_stats(output):
+    """Map rows of tarsnap --print-stats output to (total, compressed) bytes."""
+    return {m.group("row"): (int(m.group("total")), int(m.group("compressed")))
+            for m in STATS_LINE_REGEX.finditer(output)}
+
+STATS_ROW_REGEX = re.compile(r"^\s*(?P<label>\S.*?)\s+(?P<total>\d+)\s+(?P<compressed>\d+)\s*$")
+
+def parse_archive_stats(output):
+    """Map the rows of --print-stats output to (compressed, unique compressed)
+    bytes, where the unique figure comes from the "(unique data)" row under
+    each labelled row."""
+    rows = {}
+    label = None
+    for line in output.splitlines():
+        m = STATS_ROW_REGEX.match(line)
+        if not m:
+            continue
+        if m.group("label") == "(unique data)":
+            if label is not None:
+                rows[label] = (rows[label][0], int(m.group("compressed")))
+            label = None
+        else:
+            label = m.group("label")
+            rows[label] = (int(m.group("compressed")), None)
+    return rows
+
+def result_from_stats(output):
+    stats = parse_stats(output)
+    return backend_types.PerformResult(
+        True, stats.get("This archive", (None, None))[0],
+        stats.get("New data", (None, None))[1])
+
+class TarsnapError(backend_types.BackendOperationError):
+    def __init__(self, msg, failure_class):
+        super(TarsnapError, self).__init__(msg)
+        self.failure_class = failure_class
 
 def backup_instance_regex(identifier, name):
     return re.compile(
-        r"^(?P<identifier>{})-(?P<timestamp>\d+(.\d+)?)-(?P<name>{})$"
-            .format(re.escape(identifier), re.escape(name)))
+        r"^(?P<identifier>{})-(?P<timestamp>\d+(.\d+)?)-(?P<name>{}){}$"
+            .format(re.escape(identifier), re.escape(name), backend_types.SHARD_NAME_PATTERN))
+
+class Watchdog(object):
+    """Terminates a child that runs too long or shows no sign of progress.
+
+    Progress is output the caller reports through activity() and, where
+    /proc/PID/io exists, any I/O the child does. Use as a context manager
+    around waiting for the child; afterwards failure is a line describing
+    why the child was stopped, or None.
+
+    Processes feeding the child's input are registered with feeding(), and
+    are stopped along with it: otherwise a hung feeder would keep the
+    thread writing the input, and whoever waits for it, blocked forever.
+    """
+    POLL_INTERVAL = 1
+    KILL_GRACE = 10
+
+    @property
+    def logger(self):
+        return module_logger().getChild("Watchdog")
+
+    def __init__(self, proc, description, timeout=None, stall_timeout=None):
+        self.proc = proc
+        self.description = description
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.failure = None
+        self._last_activity = time.monotonic()
+        self._io_counter = None
+        self._done = threading.Event()
+        self._thread = None
+        self._feeders = set()
+        self._feeders_lock = threading.Lock()
+
+    def activity(self):
+        self._last_activity = time.monotonic()
+
+    @contextlib.contextmanager
+    def feeding(self, proc):
+        """Stop proc too if the child is stopped while proc runs."""
+        with self._feeders_lock:
+            stopped = self.failure is not None
+            if not stopped:
+                self._feeders.add(proc)
+        if stopped:
+            proc.terminate()
+        try:
+            yield
+        finally:
+            with self._feeders_lock:
+                self._feeders.discard(proc)
+
+    def _child_io(self):
+        try:
+            with open("/proc/{}/io".format(int(self.proc.pid))) as f:
+                fields = dict(line.split(":", 1) for line in f)
+            return int(fields["rchar"]) + int(fields["wchar"])
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+    def _watch(self):
+        start = time.monotonic()
+        while not self._done.wait(self.POLL_INTERVAL):
+            now = time.monotonic()
+            counter = self._child_io()
+            if counter is not None and counter != self._io_counter:
+                self._io_counter = counter
+                self._last_activity = now
+            if self.timeout is not None and now - start > self.timeout:
+                return self._stop("timeout after {} seconds".format(self.timeout))
+            if self.stall_timeout is not None and now - self._last_activity > self.stall_timeout:
+                return self._stop("no activity for {} seconds".format(self.stall_timeout))
+
+    def _stop(self, reason):
+        with self._feeders_lock:
+            self.failure = WATCHDOG_PREFIX + reason
+            processes = [self.proc] + list(self._feeders)
+        self.logger.error("Terminating tarsnap (pid {}) trying to {}: {}".format(
+            self.proc.pid, self.description, reason))
+        for proc in processes[1:]:
+            self.logger.error("Terminating pid {}, which feeds it".format(proc.pid))
+        for proc in processes:
+            proc.terminate()
+        if not self._done.wait(self.KILL_GRACE):
+            for proc in processes:
+                proc.kill()
+
+    def __enter__(self):
+        if self.timeout is not None or self.stall_timeout is not None:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class _ActivityWriter(object):
+    """Passes writes to fileobj, reporting each to a watchdog."""
+    def __init__(self, fileobj, watchdog):
+        self.fileobj = fileobj
+        self.watchdog = watchdog
+
+    def write(self, data):
+        result = self.fileobj.write(data)
+        self.watchdog.activity()
+        return result
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
 
 class TarsnapArchive(backend_types.Archive):
     @property
     def logger(self):
         return package_logger().getChild("tarsnap_archive")
 
-    def __init__(self, backend, timestamp, fullname, backup_name):
+    def __init__(self, backend, timestamp, fullname, backup_name, shard=None):
         self.fullname = fullname
         self.backend = backend
         self.timestamp = timestamp
         self.backup_name = backup_name
+        self.shard = shard
 
-    def _invoke_tarsnap(self, argv):
-        proc = subprocess.Popen(argv, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        proc_logger = self.logger.getChild("tarsnap_output")
-        for line in proc.stdout:
-            proc_logger.info(line.decode('utf-8').strip())
-        code = proc.wait()
-        if code != 0:
-            self.logger.error("Tarsnap invocation failed with exit code {}".format(code))
+    def _invoke_tarsnap(self, argv, description, operation):
+        try:
+            self.backend.run_logged(argv, description, operation=operation)
+        except TarsnapError as e:
+            self.logger.error(str(e))
             return False
         return True
 
-    def restore(self, destination):
+    def restore(self, destination, members=None):
         argv = [TARSNAP_PATH, "-C", destination, "-x", "-f", self.fullname]
-        return self._invoke_tarsnap(argv)
+        if members:
+            argv += list(members)
+        return self._invoke_tarsnap(argv, "restore {}".format(self.fullname), "restore")
+
+    def write_tar(self, fileobj):
+        argv = [TARSNAP_PATH, "-r", "-f", self.fullname]
+        if self.backend.keyfile is not None:
+            argv += ["--keyfile", self.backend.keyfile]
+        return self.backend.stream_output(argv, "read {}".format(self.fullname), fileobj,
+                                          operation="read")
+
+    def list_contents(self):
+        argv = [TARSNAP_PATH, "-t", "-f", self.fullname]
+        if self.backend.keyfile is not None:
+            argv += ["--keyfile", self.backend.keyfile]
+        output = self.backend.run_captured(argv, "list contents of {}".format(self.fullname),
+                                           operation="contents")
+        return output.decode('utf-8').splitlines()
 
     def destroy(self):
-        self.logger.info("destroying {}".format(self))
-        argv = [TARSNAP_PATH, "-d", "-f", self.fullname]
-        return self._invoke_tarsnap(argv)
+        return self.backend.destroy_archives([self])
 
 class _TarsnapPrimedListToken(object):
     def __init__(self, tarsnap_output):
@@ -72,46 +292,213 @@ class TarsnapBackend(backend_types.BackupBackend):
         super(TarsnapBackend, self).__init__(config)
         self.keyfile = config.pop("keyfile", None)
         self.host = config.pop("host", None)
+        self.retries = config.pop("retries", 3)
+        self.retry_delay = config.pop("retry_delay", 30)
+        self.retry_max_delay = config.pop("retry_max_delay", 600)
+        self.circuit_breaker_threshold = config.pop("circuit_breaker_threshold", 2)
+        self.timeouts = config.pop("timeouts", {})
+        self.stall_timeout = config.pop("stall_timeout", None)
+        if not isinstance(self.timeouts, dict) or not set(self.timeouts) <= OPERATIONS:
+            raise backend_types.BackendConfigurationError(
+                "timeouts of backend {} must map some of {} to seconds".format(
+                    self.name, ", ".join(sorted(OPERATIONS))))
+        self._circuit_lock = threading.Lock()
+        # tarsnap cannot write through one cache directory from several
+        # processes at once, so writes to a backend are serialised.
+        self.write_lock = threading.Lock()
+        self._exhausted_transient_failures = 0
+        self.circuit_open = False
 
     def __str__(self):
         addendum = " ({} with {})".format(self.host, self.keyfile)
         return super(TarsnapBackend, self).__str__() + addendum
 
+    def timeout_for(self, operation):
+        return self.timeouts.get(operation, self.timeouts.get("default"))
+
+    def _watchdog(self, proc, description, operation):
+        return Watchdog(proc, description, self.timeout_for(operation), self.stall_timeout)
+
+    def _attempt_logged(self, argv, description, stdin_writer=None, operation=None):
+        with profiling.span("tarsnap {}: {}".format(self.name, description),
+                            profiling.SUBPROCESS) as span:
+            return self._attempt_logged_in_span(argv, description, stdin_writer, operation, span)
+
+    def _attempt_logged_in_span(self, argv, description, stdin_writer, operation, span):
+        if stdin_writer is None:
+            proc = subprocess.Popen(argv, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        else:
+            proc = subprocess.Popen(argv, stderr=subprocess.STDOUT, stdout=subprocess.PIPE,
+                                    stdin=subprocess.PIPE)
+        watchdog = self._watchdog(proc, description, operation)
+        if stdin_writer is not None:
+            writer_results = []
+            def feed():
+                try:
+                    writer_results.append(stdin_writer(_ActivityWriter(proc.stdin, watchdog)))
+                except BrokenPipeError:
+                    self.logger.error("Tarsnap stopped reading its input")
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        pass
+            feeder = threading.Thread(target=logging_handlers.with_current_context(feed))
+            feeder.start()
+        proc_logger = self.logger.getChild("tarsnap_output")
+        output = collections.deque(maxlen=OUTPUT_LINES_KEPT)
+        with watchdog:
+            for line in proc.stdout:
+                watchdog.activity()
+                span.add_bytes(len(line))
+                line = line.decode('utf-8').strip()
+                proc_logger.info(line)
+                output.append(line)
+            code = proc.wait()
+            writer_result = None
+            if stdin_writer is not None:
+                feeder.join()
+                writer_result = writer_results == [True]
+        if watchdog.failure is not None:
+            output.append(watchdog.failure)
+        output = "\n".join(output)
+        return code, output, (writer_result, output)
+
+    def _attempt_captured(self, argv, description, operation=None):
+        with profiling.span("tarsnap {}: {}".format(self.name, description),
+                            profiling.SUBPROCESS) as span:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            with self._watchdog(proc, description, operation) as watchdog:
+                stdout, stderr = proc.communicate()
+            span.add_bytes(len(stdout) + len(stderr))
+        stderr = stderr.decode('utf-8', 'replace')
+        proc_logger = self.logger.getChild("tarsnap_output")
+        for line in stderr.splitlines():
+            proc_logger.info(line)
+        if watchdog.failure is not None:
+            stderr += "\n" + watchdog.failure
+        return proc.returncode, stderr, stdout
+
+    def retry_delay_for(self, attempt_number):
+        return min(self.retry_max_delay, self.retry_delay * 2 ** attempt_number)
+
+    def _note_exhausted_failure(self):
+        with self._circuit_lock:
+            self._exhausted_transient_failures += 1
+            if (not self.circuit_open and self._exhausted_transient_failures
+                    >= self.circuit_breaker_threshold):
+                self.circuit_open = True
+                self.logger.error("{} appears to be down; skipping it for the rest of this run"
+                                  .format(self.name))
+
+    def run_with_retries(self, description, attempt):
+        """Call attempt() until it succeeds or fails in a way retrying won't fix.
+
+        attempt returns (exit code, output, value); value is returned on
+        success, otherwise a TarsnapError classifying the failure is raised.
+        Transient failures are retried with exponential backoff, and once
+        enough operations have run out of retries the backend is considered
+        down and later operations fail immediately.
+        """
+        if self.circuit_open:
+            raise TarsnapError(
+                "Not attempting to {}: {} is down for the rest of this run"
+                .format(description, self.name), BACKEND_DOWN)
+
+        for attempt_number in itertools.count():
+            code, output, value = attempt()
+            if code == 0:
+                with self._circuit_lock:
+                    self._exhausted_transient_failures = 0
+                return value
+
+            failure_class = classify_failure(code, output)
+            if failure_class in RETRYABLE_FAILURES and attempt_number < self.retries:
+                delay = self.retry_delay_for(attempt_number)
+                self.logger.warning("Failed to {} ({}, exit code {}); retrying in {} seconds"
+                                    .format(description, failure_class, code, delay))
+                time.sleep(delay)
+                continue
+
+            if failure_class in CIRCUIT_BREAKING_FAILURES:
+                self._note_exhausted_failure()
+            raise TarsnapError("Failed to {}: tarsnap exited with code {} ({})"
+                               .format(description, code, failure_class), failure_class)
+
+    def run_logged(self, argv, description, stdin_writer=None, operation=None):
+        """Run tarsnap logging its output.
+
+        Returns the result of stdin_writer, if any, and the last lines of
+        output. operation picks the timeout that applies.
+        """
+        return self.run_with_retries(
+            description, lambda: self._attempt_logged(argv, description, stdin_writer, operation))
+
+    def run_captured(self, argv, description, operation=None):
+        return self.run_with_retries(
+            description, lambda: self._attempt_captured(argv, description, operation))
+
+    def stream_output(self, argv, description, fileobj, operation=None):
+        """Copy the standard output of tarsnap to fileobj, returning success.
+
+        This isn't retried: the output may already have been consumed.
+        Exceptions raised by fileobj stop tarsnap and are passed on.
+        """
+        if self.circuit_open:
+            self.logger.error("Not attempting to {}: {} is down for the rest of this run"
+                              .format(description, self.name))
+            return False
+        with profiling.span("tarsnap {}: {}".format(self.name, description),
+                            profiling.SUBPROCESS) as span:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stderr_thread = threading.Thread(
+                target=logging_handlers.with_current_context(log_lines),
+                args=(proc.stderr, self.logger.getChild("tarsnap_output")))
+            stderr_thread.start()
+            with self._watchdog(proc, description, operation) as watchdog:
+                try:
+                    while True:
+                        chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        watchdog.activity()
+                        span.add_bytes(len(chunk))
+                        fileobj.write(chunk)
+                except:
+                    proc.kill()
+                    raise
+                finally:
+                    proc.stdout.close()
+                    code = proc.wait()
+                    stderr_thread.join()
+        if watchdog.failure is not None:
+            self._note_exhausted_failure()
+            self.logger.error("Failed to {}: {}".format(description, watchdog.failure))
+            return False
+        if code != 0:
+            self.logger.error("Failed to {}: tarsnap exited with code {}".format(description, code))
+            return False
+        return True
+
     def create_backup_identifier(self, backup_name):
         ctx = hashlib.sha1()
         ctx.update(self.name.encode("utf-8"))
         ctx.update(backup_name.encode("utf-8"))
         return ctx.hexdigest()
 
-    def create_backup_instance_name(self, backup_name, timestamp):
+    def create_backup_instance_name(self, backup_name, timestamp, shard=None):
         unixtime = time.mktime(timestamp.timetuple())
-        return "{}-{}-{}".format(self.create_backup_identifier(backup_name),
-                                 unixtime, backup_name)
+        return "{}-{}-{}{}".format(self.create_backup_identifier(backup_name),
+                                   unixtime, backup_name, backend_types.shard_suffix(shard))
 
-    def perform(self, paths, backup_name, now_timestamp):
-        backup_instance_name = self.create_backup_instance_name(backup_name,
-                                                                now_timestamp)
-        self.logger.info("Creating backup \"{}\": {}"
-                            .format(backup_instance_name, ", ".join(paths)))
+    @contextlib.contextmanager
+    def _linked_paths(self, paths):
+        """A directory of symlinks named after paths' names, for tarsnap -C."""
         tmpdir = tempfile.mkdtemp()
         try:
             for path, name in paths.items():
                 os.symlink(path, os.path.join(tmpdir, name))
-            argv = [TARSNAP_PATH, "-C", tmpdir, "-H", "-cf", backup_instance_name]
-            if self.keyfile is not None:
-                argv += ["--keyfile", self.keyfile]
-            argv += list(paths.values())
-            self.logger.info("Invoking tarsnap: {}".format(argv))
-            proc = subprocess.Popen(argv, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-            proc_logger = self.logger.getChild("tarsnap_output")
-            for line in proc.stdout:
-                proc_logger.info(line.decode('utf-8').strip())
-            code = proc.wait()
-            if code != 0:
-                self.logger.error("Tarsnap invocation failed with exit code {}".format(code))
-                return False
-            else:
-                return True
+            yield tmpdir
         finally:
             for path, name in paths.items():
                 path = os.path.join(tmpdir, name)
@@ -122,44 +509,190 @@ class TarsnapBackend(backend_types.BackupBackend):
                         pass
             os.rmdir(tmpdir)
 
-    def existing_archives_for_name(self, backup_name, primed_list_token=None):
-        argv = [TARSNAP_PATH, "--list-archives"]
+    def _exclude_arguments(self, excludes):
+        if excludes is None:
+            return []
+        return [argument for pattern in excludes.tar_patterns()
+                for argument in ["--exclude", pattern]]
+
+    def perform(self, paths, backup_name, now_timestamp, commands=None, excludes=None,
+                shard=None):
+        backup_instance_name = self.create_backup_instance_name(backup_name,
+                                                                now_timestamp, shard)
+        members = list(paths.values()) if shard is None else list(shard.members)
+        sources = list(paths) if shard is None else list(members)
+        if commands:
+            sources += ["{} (from {})".format(name, argv) for name, argv in commands.items()]
+        self.logger.info("Creating backup \"{}\": {}"
+                            .format(backup_instance_name, ", ".join(sources)))
+        with self._linked_paths(paths) as tmpdir:
+            argv = [TARSNAP_PATH, "-C", tmpdir, "-H", "-cf", backup_instance_name]
+            if self.keyfile is not None:
+                argv += ["--keyfile", self.keyfile]
+            argv += ["--print-stats"]
+            argv += self._exclude_arguments(excludes)
+            argv += members
+            if commands:
+                argv += ["@-"]
+            self.logger.info("Invoking tarsnap: {}".format(argv))
+            stdin_writer = None
+            if commands:
+                stdin_writer = lambda f: write_command_output_archive(
+                    commands, f, watch=f.watchdog.feeding)
+            try:
+                with self.write_lock:
+                    commands_succeeded, output = self.run_logged(
+                        argv, "create {}".format(backup_instance_name), stdin_writer,
+                        operation="create")
+            except TarsnapError as e:
+                self.logger.error(str(e))
+                return backend_types.PerformResult(False)
+            if commands and not commands_succeeded:
+                # tarsnap may have committed an archive with truncated
+                # command output; don't leave it looking like a good backup.
+                self.logger.error("Command sources did not complete; destroying {}"
+                                  .format(backup_instance_name))
+                self.destroy_archives([self._created_archive(backup_name, now_timestamp, shard)])
+                return backend_types.PerformResult(False)
+            return result_from_stats(output)
+
+    def _created_archive(self, backup_name, timestamp, shard=None):
+        if shard is not None:
+            return self.shard_archive(backup_name, timestamp, shard)
+        return TarsnapArchive(self, time.mktime(timestamp.timetuple()),
+                              self.create_backup_instance_name(backup_name, timestamp),
+                              backup_name)
+
+    def store_archive(self, backup_name, timestamp, write_tar):
+        backup_instance_name = self.create_backup_instance_name(backup_name, timestamp)
+        argv = [TARSNAP_PATH, "-cf", backup_instance_name]
         if self.keyfile is not None:
             argv += ["--keyfile", self.keyfile]
+        argv += ["--print-stats", "@-"]
+        self.logger.info("Creating backup \"{}\" from a stream".format(backup_instance_name))
+        try:
+            with self.write_lock:
+                complete, output = self.run_logged(
+                    argv, "create {}".format(backup_instance_name), write_tar,
+                    operation="create")
+        except TarsnapError as e:
+            self.logger.error(str(e))
+            return backend_types.PerformResult(False)
+        if not complete:
+            # Don't leave a truncated copy that looks like the real thing.
+            self.logger.error("Archive stream did not complete; destroying {}"
+                              .format(backup_instance_name))
+            self.destroy_archives([self._created_archive(backup_name, timestamp)])
+            return backend_types.PerformResult(False)
+        return result_from_stats(output)
 
-        proc = None
-        f = None
-        if primed_list_token is not None:
-            f = primed_list_token.iterlines()
-        else:
-            proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
-            f = io.TextIOWrapper(proc.stdout, 'utf-8')
+    def estimate_size(self, paths, backup_name, excludes=None):
+        with self._linked_paths(paths) as tmpdir:
+            argv = [TARSNAP_PATH, "--dry-run", "--print-stats", "-C", tmpdir, "-H",
+                    "-cf", "{}-estimate".format(backup_name)]
+            if self.keyfile is not None:
+                argv += ["--keyfile", self.keyfile]
+            argv += self._exclude_arguments(excludes)
+            argv += list(paths.values())
+            try:
+                _, output = self.run_logged(argv, "estimate size of {}".format(backup_name),
+                                            operation="estimate")
+            except TarsnapError as e:
+                self.logger.warning(str(e))
+                return None
+        return parse_stats(output).get("New data", (None, None))[1]
 
+    def archive_for_name(self, backup_name, timestamp, fullname):
         identifier = self.create_backup_identifier(backup_name)
-        regex = backup_instance_regex(identifier, backup_name)
+        m = backup_instance_regex(identifier, backup_name).match(fullname)
+        if not m or float(m.groupdict()["timestamp"]) != timestamp:
+            raise backend_types.BackendOperationError(
+                "{} is not an archive of {} on {}".format(fullname, backup_name, self.name))
+        if m.group("shard") == "*":
+            count = int(m.group("shards"))
+            shards = [self.archive_for_name(backup_name, timestamp, name)
+                      for name in backend_types.shard_group_names(fullname, count)]
+            return backend_types.ShardedArchive(self, timestamp, fullname, backup_name,
+                                                shards, count)
+        return TarsnapArchive(self, timestamp, fullname, backup_name,
+                              backend_types.shard_from_match(m))
 
-        results = []
-        for line in f:
-            m = regex.match(line)
-            if m:
-                ts = float(m.groupdict()["timestamp"])
-                results.append(TarsnapArchive(self, ts, m.group(), backup_name))
+    def shard_archive(self, backup_name, timestamp, shard):
+        return TarsnapArchive(self, time.mktime(timestamp.timetuple()),
+                              self.create_backup_instance_name(backup_name, timestamp, shard),
+                              backup_name, (shard.index, shard.count))
 
-        if proc is not None and proc.wait() != 0:
-            self.logger.error("Tarsnap invocation failed with exit code {}".format(proc.returncode))
+    def destroy_archives(self, archives):
+        archives = backend_types.expand_shards(archives)
+        success = True
+        for start in range(0, len(archives), DESTROY_BATCH_SIZE):
+            batch = archives[start:start + DESTROY_BATCH_SIZE]
+            argv = [TARSNAP_PATH, "-d"]
+            if self.keyfile is not None:
+                argv += ["--keyfile", self.keyfile]
+            for archive in batch:
+                self.logger.info("destroying {}".format(archive))
+                argv += ["-f", archive.fullname]
+            try:
+                with self.write_lock:
+                    self.run_logged(argv, "destroy {} archives".format(len(batch)),
+                                    operation="delete")
+            except TarsnapError as e:
+                self.logger.error(str(e))
+                success = False
+        return success
 
-        return results
+    def storage_usage(self, archives):
+        archives = list(archives)
+        shards = backend_types.expand_shards(archives)
+        rows = {}
+        # Unique sizes are relative to every archive on the backend, so
+        # batches of archives can be measured separately.
+        for start in range(0, len(shards) or 1, STATS_BATCH_SIZE):
+            batch = shards[start:start + STATS_BATCH_SIZE]
+            argv = [TARSNAP_PATH, "--print-stats"]
+            if self.keyfile is not None:
+                argv += ["--keyfile", self.keyfile]
+            for archive in batch:
+                argv += ["-f", archive.fullname]
+            _, output = self.run_logged(argv, "print statistics of {} archives".format(len(batch)),
+                                        operation="list")
+            batch_rows = parse_archive_stats(output)
+            if len(batch) == 1 and "This archive" in batch_rows:
+                batch_rows[batch[0].fullname] = batch_rows.pop("This archive")
+            rows.update(batch_rows)
+        shard_sizes = {}
+        for archive in shards:
+            stored, unique = rows.get(archive.fullname, (None, None))
+            if unique is None:
+                raise TarsnapError("No statistics for {}".format(archive.fullname), UNKNOWN_FAILURE)
+            shard_sizes[archive] = backend_types.ArchiveSize(stored, unique)
+        total = rows.get("All archives", (None, None))[1]
+        return backend_types.StorageUsage(total, backend_types.group_sizes(archives, shard_sizes))
 
-    def get_primed_list_token(self):
+    def list_archives_output(self):
         argv = [TARSNAP_PATH, "--list-archives"]
         if self.keyfile is not None:
             argv += ["--keyfile", self.keyfile]
+        return self.run_captured(argv, "list archives", operation="list")
 
-        proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    def existing_archives_for_name(self, backup_name, primed_list_token=None):
+        if primed_list_token is None:
+            primed_list_token = self.get_primed_list_token()
 
-        token = _TarsnapPrimedListToken(proc.stdout.read())
+        identifier = self.create_backup_identifier(backup_name)
+        regex = backup_instance_regex(identifier, backup_name)
 
-        if proc.wait() != 0:
-            self.logger.error("Tarsnap invocation failed with exit code {}".format(proc.returncode))
+        results = []
+        with profiling.span("match {} archives on {}".format(backup_name, self.name)):
+            for line in primed_list_token.iterlines():
+                m = regex.match(line)
+                if m:
+                    ts = float(m.groupdict()["timestamp"])
+                    results.append(TarsnapArchive(self, ts, m.group(), backup_name,
+                                                  backend_types.shard_from_match(m)))
+
+        return backend_types.group_shards(results)
 
-        return token
+    def get_primed_list_token(self):
+        return _TarsnapPrimedListToken(self.list_archives_output())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import hashlib
+import collections
+
+from . import package_logger
+
+def module_logger():
+    return package_logger().getChild("change_tracking")
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct("iIII")
+
+DaemonSettings = collections.namedtuple(
+    "DaemonSettings", ["debounce", "min_interval", "max_interval", "scan_interval"])
+
+DEFAULT_DAEMON_SETTINGS = DaemonSettings(debounce=300, min_interval=3600,
+                                         max_interval=86400, scan_interval=3600)
+DEFAULT_MAX_WATCHES = 8192
+
+
+class Inotify(object):
+    """Thin ctypes wrapper around the Linux inotify calls."""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._ctypes = ctypes
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        err = self._ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """(wd, mask, name) for each pending event, without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def tree_fingerprint(paths):
+    """Digest of the names, inodes, sizes and mtimes of everything in paths."""
+    ctx = hashlib.sha1()
+    def add(path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return
+        ctx.update("{}\0{}\0{}\0{}\0{}\n".format(
+            path, st.st_ino, st.st_mode, st.st_size, st.st_mtime_ns).encode("utf-8", "surrogateescape"))
+    for top in sorted(paths):
+        add(top)
+        for directory, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                add(os.path.join(directory, name))
+    return ctx.hexdigest()
+
+def _directories(top):
+    yield top
+    for directory, dirnames, _ in os.walk(top):
+        for name in dirnames:
+            yield os.path.join(directory, name)
+
+
+class ChangeTracker(object):
+    """Reports which backups' paths changed.
+
+    Trees are watched with inotify where possible. A backup whose trees
+    would push the total past max_watches, or that hits the kernel's watch
+    limit, is instead fingerprinted every scan_interval seconds.
+    """
+
+    @property
+    def logger(self):
+        return module_logger().getChild("ChangeTracker")
+
+    def __init__(self, backup_paths, scan_intervals, max_watches=DEFAULT_MAX_WATCHES,
+                 clock=time.time):
+        self.backup_paths = backup_paths
+        self.scan_intervals = scan_intervals
+        self.max_watches = max_watches
+        self.clock = clock
+        self.inotify = None
+        self.watch_backups = collections.defaultdict(set)
+        self.watch_paths = {}
+        self.watched_backups = set()
+        self.scanned = {}
+        self.next_scan = {}
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            self.logger.info("Not using inotify ({}); scanning for changes instead".format(e))
+        for name, paths in self.backup_paths.items():
+            if self.inotify is not None and self._watch_backup(name, paths):
+                self.watched_backups.add(name)
+            else:
+                self._start_scanning(name)
+
+    def _start_scanning(self, name):
+        self.scanned[name] = tree_fingerprint(self.backup_paths[name])
+        self.next_scan[name] = self.clock() + self.scan_intervals[name]
+
+    def _add_watch(self, name, path):
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            self.logger.debug("Not watching {}: {}".format(path, e))
+            return
+        self.watch_backups[wd].add(name)
+        self.watch_paths[wd] = path
+
+    def _unwatch_backup(self, name):
+        for wd, names in list(self.watch_backups.items()):
+            names.discard(name)
+            if not names:
+                self.inotify.rm_watch(wd)
+                del self.watch_backups[wd]
+                del self.watch_paths[wd]
+
+    def _watch_tree(self, name, top):
+        directories = list(_directories(top)) if os.path.isdir(top) else [top]
+        if len(self.watch_paths) + len(directories) > self.max_watches:
+            raise OSError(errno.ENOSPC, "more than {} watches needed".format(self.max_watches))
+        for path in directories:
+            self._add_watch(name, path)
+
+    def _watch_backup(self, name, paths):
+        try:
+            for top in paths:
+                self._watch_tree(name, top)
+        except OSError as e:
+            self.logger.info("Scanning {} for changes instead of watching it: {}".format(name, e))
+            self._unwatch_backup(name)
+            return False
+        return True
+
+    def _handle_events(self, changed):
+        for wd, mask, filename in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("Missed change notifications; treating all watched trees as changed")
+                changed.update(self.watched_backups)
+                continue
+            names = set(self.watch_backups.get(wd, ()))
+            changed.update(names)
+            if mask & IN_IGNORED:
+                self.watch_backups.pop(wd, None)
+                self.watch_paths.pop(wd, None)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.watch_paths:
+                new_directory = os.path.join(self.watch_paths[wd], filename)
+                for name in names & self.watched_backups:
+                    try:
+                        self._watch_tree(name, new_directory)
+                    except OSError as e:
+                        self.logger.info("Scanning {} for changes from now on: {}".format(name, e))
+                        self._unwatch_backup(name)
+                        self.watched_backups.discard(name)
+                        self._start_scanning(name)
+
+    def _scan_due(self, changed):
+        now = self.clock()
+        for name, due in list(self.next_scan.items()):
+            if due > now:
+                continue
+            fingerprint = tree_fingerprint(self.backup_paths[name])
+            if fingerprint != self.scanned[name]:
+                self.scanned[name] = fingerprint
+                changed.add(name)
+            self.next_scan[name] = self.clock() + self.scan_intervals[name]
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds; returns the names of changed backups."""
+        changed = set()
+        if self.next_scan:
+            timeout = max(0, min(timeout, min(self.next_scan.values()) - self.clock()))
+        if self.inotify is not None and self.watched_backups:
+            readable, _, _ = select.select([self.inotify], [], [], timeout)
+            if readable:
+                self._handle_events(changed)
+        else:
+            time.sleep(timeout)
+        self._scan_due(changed)
+        return changed
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class BackupTrigger(object):
+    """When a backup should run in daemon mode.
+
+    A changed backup runs once its tree has been quiet for debounce seconds,
+    but never sooner than min_interval after its last run; every backup runs
+    at least every max_interval seconds.
+    """
+
+    def __init__(self, settings, last_run, dirty=True, now=None):
+        self.settings = settings
+        self.last_run = last_run
+        self.last_change = None
+        if dirty:
+            # Nothing was watching before, so changes may have been missed.
+            self.last_change = time.time() if now is None else now
+
+    def note_change(self, now):
+        self.last_change = now
+
+    def note_run(self, now):
+        self.last_run = now
+        self.last_change = None
+
+    def due_at(self):
+        latest = self.last_run + self.settings.max_interval
+        if self.last_change is None:
+            return latest
+        return min(latest, max(self.last_change + self.settings.debounce,
+                               self.last_run + self.settings.min_interval))
+
+    def due(self, now):
+        return self.due_at() <= now
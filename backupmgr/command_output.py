@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import io
+import time
+import tarfile
+import threading
+import itertools
+import contextlib
+import subprocess
+
+from . import package_logger
+from . import logging_handlers
+
+# A tar header needs the size of its member, so each piece of a command's
+# output is read into memory whole; this bounds the memory per command.
+COMMAND_CHUNK_SIZE = 8 * 1024 * 1024
+
+def module_logger():
+    return package_logger().getChild("command_output")
+
+def log_lines(stream, logger):
+    for line in stream:
+        logger.warning(line.decode('utf-8', 'replace').rstrip())
+
+
+def _add_chunks(tar, name, source, chunk_size, mtime):
+    for i in itertools.count():
+        chunk = source.read(chunk_size)
+        if not chunk and i > 0:
+            break
+        info = tarfile.TarInfo("{}/{:06d}".format(name, i))
+        info.size = len(chunk)
+        info.mode = 0o600
+        info.mtime = mtime
+        tar.addfile(info, io.BytesIO(chunk))
+        if len(chunk) < chunk_size:
+            break
+
+def _stream_command(tar, name, argv, chunk_size, mtime, watch):
+    logger = module_logger()
+    logger.info("Streaming output of {} into {}".format(argv, name))
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with watch(proc) if watch is not None else contextlib.nullcontext():
+        stderr_thread = threading.Thread(target=logging_handlers.with_current_context(log_lines),
+                                         args=(proc.stderr, logger.getChild(name)))
+        stderr_thread.start()
+        try:
+            _add_chunks(tar, name, proc.stdout, chunk_size, mtime)
+        finally:
+            proc.stdout.close()
+            code = proc.wait()
+            stderr_thread.join()
+    return code
+
+def add_command_output_members(tar, commands, chunk_size=COMMAND_CHUNK_SIZE, watch=None):
+    """Add the standard output of each command to the open tar stream.
+
+    Tar headers carry the size of their member, so a command's output is
+    stored as a directory NAME holding pieces 000000, 000001, ... of at most
+    chunk_size bytes each; concatenating them in order restores the output.
+
+    watch(proc), if given, is a context manager held while each command
+    runs, for instance to stop it when whatever reads the stream hangs.
+    """
+    logger = module_logger()
+    success = True
+    mtime = time.time()
+    for name, argv in commands.items():
+        dirinfo = tarfile.TarInfo(name)
+        dirinfo.type = tarfile.DIRTYPE
+        dirinfo.mode = 0o700
+        dirinfo.mtime = mtime
+        tar.addfile(dirinfo)
+
+        code = _stream_command(tar, name, argv, chunk_size, mtime, watch)
+        if code != 0:
+            logger.error("{} failed with exit code {}".format(argv, code))
+            success = False
+    return success
+
+def write_command_output_archive(commands, fileobj, chunk_size=COMMAND_CHUNK_SIZE, watch=None):
+    """Write a tar stream of the standard output of each command to fileobj."""
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        return add_command_output_members(tar, commands, chunk_size, watch=watch)
@@ -4,6 +4,7 @@
 import os
 import sys
 import os.path
+import stat
 import json
 import errno
 import time
@@ -12,6 +13,9 @@ import collections
 import itertools
 import socket
 import argparse
+import shlex
+import glob
+import tempfile
 
 import dateutil.parser, dateutil.tz
 
@@ -19,6 +23,9 @@ from . import package_logger
 from . import error
 from . import backend_types
 from . import backup
+from . import locking
+from . import change_tracking
+from . import excludes
 
 from .backup import (MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY,
                      SUNDAY, WEEKLY, MONTHLY)
@@ -27,17 +34,52 @@ LOCAL_TZ = dateutil.tz.tzlocal()
 
 if sys.platform.startswith("darwin"):
     DEFAULT_STATEFILE = "/var/db/backupmgr.state"
+    DEFAULT_INDEX_DIR = "/var/db/backupmgr.index"
 else:
     DEFAULT_STATEFILE = "/var/lib/backupmgr/state"
+    DEFAULT_INDEX_DIR = "/var/lib/backupmgr/index"
 
 CONFIG_LOCATION = "/etc/backupmgr.conf"
 
+ARCHIVE_SPEC_HELP = ("An ordinal, timestamp or date; a range START..END of "
+                     "those (either end optional); or a comma separated list "
+                     "of any of these")
+
 def module_logger():
     return package_logger().getChild("configuration")
 
 def prefix_match(s1, s2, required_length):
     return s1[:required_length] == s2[:required_length]
 
+INTERVAL_UNITS = {
+    "minute": datetime.timedelta(minutes=1),
+    "minutes": datetime.timedelta(minutes=1),
+    "hour": datetime.timedelta(hours=1),
+    "hours": datetime.timedelta(hours=1),
+}
+
+def parse_schedule(item):
+    """Parse an hourly, interval ("every 15 minutes") or cron timespec item."""
+    if item == "hourly":
+        return backup.CronSchedule("0 * * * *")
+    words = item.split()
+    if words and words[0] == "every":
+        if len(words) == 2:
+            words = ["every", "1", words[1]]
+        if len(words) != 3 or words[2] not in INTERVAL_UNITS:
+            raise InvalidConfigError("Invalid interval timespec {}".format(item))
+        try:
+            count = int(words[1])
+            return backup.IntervalSchedule(count * INTERVAL_UNITS[words[2]])
+        except ValueError as e:
+            raise InvalidConfigError("Invalid interval timespec {}: {}".format(item, e))
+    if len(words) == 5:
+        try:
+            return backup.CronSchedule(item)
+        except ValueError as e:
+            raise InvalidConfigError("Invalid cron timespec {}: {}".format(item, e))
+    return None
+
 def validate_timespec(spec):
     if isinstance(spec, str):
         if spec.lower() == "weekly":
@@ -55,7 +97,13 @@ def validate_timespec(spec):
     new_spec = set()
     for item in (item.lower() for item in spec):
         newitem = None
-        if prefix_match(item, "monday", 2):
+        # Match the keywords first: "we" and "mo" would otherwise take them
+        # for Wednesday and Monday.
+        if item == "weekly":
+            newitem = WEEKLY
+        elif item == "monthly":
+            newitem = MONTHLY
+        elif prefix_match(item, "monday", 2):
             newitem = MONDAY
         elif prefix_match(item, "tuesday", 2):
             newitem = TUESDAY
@@ -69,6 +117,10 @@ def validate_timespec(spec):
             newitem = SATURDAY
         elif prefix_match(item, "sunday", 2):
             newitem = SUNDAY
+        else:
+            newitem = parse_schedule(item)
+        if newitem is None:
+            raise InvalidConfigError("Invalid timespec {}".format(item))
         new_spec.add(newitem)
 
     return new_spec
@@ -83,14 +135,167 @@ def validate_paths(paths):
     for path, name in paths.items():
         if not os.path.isabs(path):
             raise InvalidConfigError("{} was not an absolute path".format(path))
-        if not name or '/' in name or '\\' in name or name == '..':
-            raise InvalidConfigError("Invalid name: \"{}\"".format(name))
-        if name in names:
-            raise InvalidConfigError("Name collision: \"{}\"".format(name))
+        validate_source_name(name, names)
         names.add(name)
 
     return paths
 
+def validate_source_name(name, names):
+    if not name or '/' in name or '\\' in name or name == '..':
+        raise InvalidConfigError("Invalid name: \"{}\"".format(name))
+    if name in names:
+        raise InvalidConfigError("Name collision: \"{}\"".format(name))
+
+def validate_commands(commands, paths):
+    if commands is None:
+        return {}
+    if not isinstance(commands, dict) or any((not isinstance(x, str) for x in commands.keys())):
+        raise InvalidConfigError("commands should be a dictionary of names to commands")
+
+    names = set(paths.values())
+    validated = {}
+    for name, argv in commands.items():
+        if isinstance(argv, str):
+            argv = shlex.split(argv)
+        if (not isinstance(argv, list) or not argv
+            or any((not isinstance(x, str) for x in argv))):
+            raise InvalidConfigError("Invalid command for {}: {}".format(name, argv))
+        validate_source_name(name, names)
+        names.add(name)
+        validated[name] = argv
+
+    return validated
+
+def _validate_patterns(patterns, what):
+    if (not isinstance(patterns, list)
+        or any((not isinstance(x, str) or not x for x in patterns))):
+        raise InvalidConfigError("{} should be a list of non-empty strings".format(what))
+    return patterns
+
+def validate_excludes(backup_dict, paths):
+    patterns = _validate_patterns(backup_dict.get("exclude", []), "exclude")
+    markers = _validate_patterns(backup_dict.get("exclude_markers", []), "exclude_markers")
+    if any("/" in marker for marker in markers):
+        raise InvalidConfigError("exclude_markers should be file names")
+    path_patterns = backup_dict.get("path_excludes", {})
+    if not isinstance(path_patterns, dict):
+        raise InvalidConfigError("path_excludes should be a dictionary of paths to patterns")
+    for path, anchored in path_patterns.items():
+        if path not in paths:
+            raise InvalidConfigError("path_excludes for {}, which isn't backed up".format(path))
+        _validate_patterns(anchored, "path_excludes of {}".format(path))
+    measure = backup_dict.get("measure_excludes", False)
+    if not isinstance(measure, bool):
+        raise InvalidConfigError("measure_excludes should be true or false")
+    excluder = excludes.Excludes(patterns, path_patterns, markers, measure)
+    return excluder if excluder else None
+
+def validate_shards(backup_dict):
+    shards = backup_dict.get("shards", 1)
+    if isinstance(shards, bool) or not isinstance(shards, int) or shards < 1:
+        raise InvalidConfigError("shards should be a positive integer")
+    shard_subdirectories = backup_dict.get("shard_subdirectories", False)
+    if not isinstance(shard_subdirectories, bool):
+        raise InvalidConfigError("shard_subdirectories should be true or false")
+    return shards, shard_subdirectories
+
+def _parse_time_of_day(text):
+    hours, colon, minutes = text.partition(":")
+    if not _is_number(hours) or (colon and not _is_number(minutes)):
+        return None
+    hours, minutes = int(hours), int(minutes or 0)
+    if hours > 23 or minutes > 59:
+        return None
+    return datetime.timedelta(hours=hours, minutes=minutes)
+
+def _is_number(text):
+    return text.isascii() and text.isdigit()
+
+def validate_schedule_window(window):
+    """Parse a start window ("01:00-05:00") into its start relative to
+    midnight and its length. A window spanning midnight ("22:00-04:00")
+    starts the evening before."""
+    if window is None:
+        return datetime.timedelta(0), datetime.timedelta(0)
+    if not isinstance(window, str) or window.count("-") != 1:
+        raise InvalidConfigError("Invalid schedule_window {}".format(window))
+    start, end = (_parse_time_of_day(part.strip()) for part in window.split("-"))
+    if start is None or end is None:
+        raise InvalidConfigError("Invalid schedule_window {}".format(window))
+    if end < start:
+        start -= backup.ONE_DAY
+    return start, end - start
+
+def validate_daemon_settings(settings, defaults):
+    if settings is None:
+        return defaults
+    if not isinstance(settings, dict):
+        raise InvalidConfigError("daemon settings should be a dictionary")
+    unknown = set(settings) - set(defaults._fields)
+    if unknown:
+        raise InvalidConfigError("Unknown daemon settings: {}".format(", ".join(sorted(unknown))))
+    for key, value in settings.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise InvalidConfigError("daemon {} should be a non-negative number of seconds".format(key))
+    validated = defaults._replace(**settings)
+    if validated.min_interval > validated.max_interval:
+        raise InvalidConfigError("daemon min_interval is longer than max_interval")
+    if validated.scan_interval <= 0:
+        raise InvalidConfigError("daemon scan_interval should be positive")
+    return validated
+
+def _substitute_template(value, substitutions):
+    if isinstance(value, str):
+        for key, replacement in substitutions.items():
+            value = value.replace(key, replacement)
+        return value
+    if isinstance(value, list):
+        return [_substitute_template(x, substitutions) for x in value]
+    if isinstance(value, dict):
+        return {_substitute_template(k, substitutions): _substitute_template(v, substitutions)
+                for k, v in value.items()}
+    return value
+
+def expand_backup_template(template):
+    """Expand a backup template into one backup dictionary per matched directory.
+
+    The template is an ordinary backup dictionary plus a "glob" key. In every
+    string of it, "{name}" is replaced by the basename of a directory matching
+    the glob and "{path}" by its full path.
+    """
+    if not isinstance(template, dict):
+        raise InvalidConfigError("Expected a dictionary describing the backup template")
+    template = dict(template)
+    pattern = template.pop("glob", None)
+    if not isinstance(pattern, str) or not os.path.isabs(pattern):
+        raise InvalidConfigError("Backup templates need an absolute glob")
+    name = template.get("name")
+    if not isinstance(name, str) or "{name}" not in name:
+        raise InvalidConfigError("Backup template names must contain {name}")
+
+    backup_dicts = []
+    for path in sorted(glob.glob(pattern)):
+        if not os.path.isdir(path):
+            continue
+        path = path.rstrip("/")
+        substitutions = {"{name}": os.path.basename(path), "{path}": path}
+        backup_dicts.append(_substitute_template(template, substitutions))
+    return backup_dicts
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+def add_selection_arguments(parser):
+    parser.add_argument("--backup", dest="backup_filters", action="append",
+                        default=[], metavar="PATTERN",
+                        help="Only consider backups matching this glob (repeatable)")
+    parser.add_argument("--backend", dest="backend_filters", action="append",
+                        default=[], metavar="PATTERN",
+                        help="Only consider backends matching this glob (repeatable)")
+
 def parse_simple_date(datestr):
     try:
         timestamp = float(datestr)
@@ -108,7 +313,9 @@ def parse_simple_date(datestr):
 
 
 BackupPruningConfiguration = collections.namedtuple(
-    "BackupPruningConfiguration", ["backup_name", "daily_count", "weekly_count", "monthly_count"])
+    "BackupPruningConfiguration", ["backup_name", "daily_count", "weekly_count", "monthly_count",
+                                   "max_size", "keep_latest"],
+    defaults=(None, 1))
 
 class PruningConfiguration(object):
     def __init__(self, backup_pruning_configs):
@@ -142,11 +349,25 @@ class Config(object):
                             help="Be quiet on logging to stdout/stderr")
         parser.add_argument("--version", action="store_const", dest="verb",
                         const="version")
+        parser.add_argument("--profile", dest="profile", nargs="?", default=None,
+                            const="backupmgr-profile.txt", metavar="REPORT",
+                            help="Time each phase and tarsnap invocation, writing "
+                            "a report to REPORT (default: %(const)s)")
+        parser.add_argument("--profile-python", dest="profile_python", action="store_true",
+                            help="With --profile, also run cProfile")
+        parser.add_argument("--profile-memory", dest="profile_memory", action="store_true",
+                            help="With --profile, also trace allocations with tracemalloc")
         parser.set_defaults(verb=None)
         subparsers = parser.add_subparsers()
 
         parser_backup = subparsers.add_parser("backup")
         parser_backup.set_defaults(verb="backup")
+        parser_backup.add_argument("-j", "--jobs", dest="jobs", type=positive_int,
+                                   default=1, metavar="N",
+                                   help="Run up to N backups at once, longest first")
+        parser_backup.add_argument("--estimate", dest="estimate", action="store_true",
+                                   help="Estimate the size of backups without history "
+                                   "with a dry run, to order them")
 
         parser_list = subparsers.add_parser("list")
         parser_list.set_defaults(verb="list")
@@ -154,13 +375,42 @@ class Config(object):
                                  type=parse_simple_date)
         parser_list.add_argument("--after", dest="after", default=None,
                                  type=parse_simple_date)
+        add_selection_arguments(parser_list)
+
+        def add_restore_arguments(parser, backend):
+            parser.add_argument("backup", metavar="BACKUPNAME", type=str)
+            if backend:
+                parser.add_argument("backend", metavar="BACKENDNAME", type=str)
+            parser.add_argument("archive_spec", metavar="SPEC", type=str,
+                                help=ARCHIVE_SPEC_HELP)
+            parser.add_argument("destination", metavar="DEST", type=str)
+            parser.add_argument("members", metavar="MEMBER", type=str,
+                                nargs="*",
+                                help="Only restore these paths or glob patterns")
+            parser.add_argument("--all-matches", dest="all_matches",
+                                action="store_true",
+                                help="Restore every matching archive, each into DEST/TIMESTAMP")
 
         parser_restore = subparsers.add_parser("restore")
-        parser_restore.set_defaults(verb="restore")
-        parser_restore.add_argument("backup", metavar="BACKUPNAME", type=str)
-        parser_restore.add_argument("backend", metavar="BACKENDNAME", type=str)
-        parser_restore.add_argument("archive_spec", metavar="SPEC", type=str)
-        parser_restore.add_argument("destination", metavar="DEST", type=str)
+        parser_restore.set_defaults(verb="restore", cheapest=False)
+        add_restore_arguments(parser_restore, backend=True)
+
+        parser_restore_cheapest = subparsers.add_parser(
+            "restore-cheapest",
+            help="Restore from whichever backend holding the archive is cheapest, "
+            "falling back to the others")
+        parser_restore_cheapest.set_defaults(verb="restore", cheapest=True, backend=None)
+        add_restore_arguments(parser_restore_cheapest, backend=False)
+
+        parser_delete = subparsers.add_parser("delete")
+        parser_delete.set_defaults(verb="delete")
+        parser_delete.add_argument("backup", metavar="BACKUPNAME", type=str)
+        parser_delete.add_argument("backend", metavar="BACKENDNAME", type=str)
+        parser_delete.add_argument("archive_spec", metavar="SPEC", type=str,
+                                   help=ARCHIVE_SPEC_HELP)
+        parser_delete.add_argument("-n", "--dry-run", dest="dry_run",
+                                   action="store_true",
+                                   help="Only print the archives that would be deleted")
 
         parser_list_backups = subparsers.add_parser("list-configured-backups")
         parser_list_backups.set_defaults(verb="list-configured-backups")
@@ -170,11 +420,52 @@ class Config(object):
 
         parser_prune = subparsers.add_parser("prune")
         parser_prune.set_defaults(verb="prune")
+        add_selection_arguments(parser_prune)
+        parser_prune.add_argument("--max-concurrent-deletes", dest="max_concurrent_deletes",
+                                  type=positive_int, default=2, metavar="N",
+                                  help="Delete from at most N backends at once")
+        parser_prune.add_argument("-n", "--dry-run", dest="dry_run", action="store_true",
+                                  help="Print what would be pruned without deleting anything")
+        parser_prune.add_argument("--plan-out", dest="plan_out", default=None, metavar="FILE",
+                                  help="Write the prune plan to FILE as JSON")
+        parser_prune.add_argument("--apply", dest="apply", default=None, metavar="FILE",
+                                  help="Prune exactly the archives in a plan written by --plan-out")
+
+        parser_replicate = subparsers.add_parser("replicate")
+        parser_replicate.set_defaults(verb="replicate")
+        parser_replicate.add_argument("source", metavar="SOURCE", type=str,
+                                      help="Backend to copy archives from")
+        parser_replicate.add_argument("target", metavar="TARGET", type=str,
+                                      help="Backend to copy archives to")
+        parser_replicate.add_argument("--backup", dest="backup_filters", action="append",
+                                      default=[], metavar="PATTERN",
+                                      help="Only replicate backups matching this glob (repeatable)")
+        parser_replicate.add_argument("-j", "--jobs", dest="jobs", type=positive_int,
+                                      default=2, metavar="N",
+                                      help="Copy up to N archives at once (default: %(default)s)")
+        parser_replicate.add_argument("-n", "--dry-run", dest="dry_run", action="store_true",
+                                      help="Only print the archives that would be copied")
+
+        parser_daemon = subparsers.add_parser("daemon")
+        parser_daemon.set_defaults(verb="daemon", estimate=False)
+        add_selection_arguments(parser_daemon)
+        parser_daemon.add_argument("-j", "--jobs", dest="jobs", type=positive_int,
+                                   default=1, metavar="N",
+                                   help="Run up to N backups at once, longest first")
+
+        parser_find = subparsers.add_parser("find")
+        parser_find.set_defaults(verb="find")
+        parser_find.add_argument("backup", metavar="BACKUPNAME", type=str)
+        parser_find.add_argument("pattern", metavar="PATTERN", type=str)
+        parser_find.add_argument("--before", dest="before", default=None,
+                                 type=parse_simple_date)
+        parser_find.add_argument("--after", dest="after", default=None,
+                                 type=parse_simple_date)
 
         return parser.parse_args(self.argv)
 
     def default_state(self):
-        return {}
+        return backup.upgrade_state({})
 
     def load_state(self):
         try:
@@ -185,15 +476,115 @@ class Config(object):
             self.logger.warn("Could not read state. Assuming default state.")
             state = self.default_state()
 
+        return self.replay_journal(backup.upgrade_state(state))
+
+    @property
+    def journal_path(self):
+        return self.statefile_path + ".journal"
+
+    def replay_journal(self, state):
+        """Apply the results journaled since the state file was written."""
+        try:
+            with open(self.journal_path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return state
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict) or not isinstance(record.get("backup"), str):
+                # Left by a crash in the middle of an append.
+                self.logger.warning("Ignoring damaged state journal entry: {!r}".format(line))
+                continue
+            backup.apply_journal_record(state, record)
         return state
 
-    def save_state(self, state):
-        with open(self.statefile_path, 'w') as f:
-            json.dump(state, f)
+    def journal_backup_result(self, configured_backup, result):
+        """Durably record the result of one backup as soon as it finishes, so
+        that a crash before save_state_given_results doesn't lose it."""
+        line = json.dumps(self.configured_backups.journal_record(configured_backup, result)) + "\n"
+        with self.state_lock():
+            fd = os.open(self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    line = "\n" + line
+                os.write(fd, line.encode("utf-8"))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if not size:
+                dirfd = os.open(os.path.dirname(os.path.abspath(self.journal_path)), os.O_RDONLY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
 
-    def save_state_given_new_backups(self, backups):
-        new_state = self.configured_backups.state_after_backups(backups)
-        self.save_state(new_state)
+    def discard_journal(self):
+        try:
+            os.unlink(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+    def save_state(self, state):
+        """Replace the state file atomically, so readers never see a partial write."""
+        directory = os.path.dirname(os.path.abspath(self.statefile_path))
+        try:
+            mode = stat.S_IMODE(os.stat(self.statefile_path).st_mode)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            mode = 0o644
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix=".state.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                # mkstemp creates the file 0600; keep the state file's own mode.
+                os.fchmod(f.fileno(), mode)
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, self.statefile_path)
+        except:
+            os.unlink(tmppath)
+            raise
+
+    def state_file_mtime(self):
+        """When the state last changed, counting results in the journal."""
+        mtimes = []
+        for path in [self.statefile_path, self.journal_path]:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return max(mtimes, default=0)
+
+    def refresh_state(self):
+        """Reload the state file, for a process that outlives one run."""
+        self.configured_backups.state_mtime = self.state_file_mtime()
+        self.configured_backups.state = self.load_state()
+        self.configured_backups.now = datetime.datetime.now().replace(tzinfo=LOCAL_TZ)
+
+    def state_lock(self):
+        return locking.exclusive_lock(self.statefile_path + ".lock")
+
+    def backup_locks(self):
+        return locking.BackupLocks(self.statefile_path + ".locks")
+
+    def save_state_given_results(self, results):
+        """Record results on top of the state currently on disk.
+
+        Other processes may have recorded other backups since we loaded the
+        state; re-reading it under the lock keeps their updates. The journal
+        is folded into the state file and discarded.
+        """
+        with self.state_lock():
+            current = self.load_state()
+            new_state = self.configured_backups.state_after_results(results, current)
+            self.save_state(new_state)
+            self.discard_journal()
 
     def all_configured_backups(self):
         return self.configured_backups.all_backups()
@@ -204,19 +595,36 @@ class Config(object):
     def all_configured_backends(self):
         return self.configured_backends.values()
 
+    def configured_backup_by_name(self, name):
+        return self.configured_backups.backup_by_name(name)
+
+    def configured_backend_by_name(self, name):
+        return self.configured_backends.get(name, None)
+
+    def daemon_settings_for(self, backup):
+        return self.daemon_settings.get(backup.name, self.default_daemon_settings)
+
     def _parse_pruning_behavior(self, pruning_info):
         if not isinstance(pruning_info, dict):
             raise InvalidConfigError("Pruning info must be a dictionary")
         parsed_configs = []
         for name, config in pruning_info.items():
-            if name not in [x.name for x in self.all_configured_backups()]:
+            if self.configured_backup_by_name(name) is None:
                 msg = "Attempt to define backup configuration for unknown backup {}".format(name)
                 raise InvalidConfigError(msg)
             inf = float("inf")
             daily = config.get("daily", inf)
             weekly = config.get("weekly", inf)
             monthly = config.get("montly", inf)
-            backup_config = BackupPruningConfiguration(name, daily, weekly, monthly)
+            max_size = config.get("max_size", None)
+            if max_size is not None and (isinstance(max_size, bool) or not isinstance(max_size, int)
+                                         or max_size < 0):
+                raise InvalidConfigError("max_size of {} should be a number of bytes".format(name))
+            keep_latest = config.get("keep_latest", 1)
+            if isinstance(keep_latest, bool) or not isinstance(keep_latest, int) or keep_latest < 0:
+                raise InvalidConfigError("keep_latest of {} should be a number of archives".format(name))
+            backup_config = BackupPruningConfiguration(name, daily, weekly, monthly,
+                                                       max_size, keep_latest)
             parsed_configs.append(backup_config)
         self.pruning_configuration = PruningConfiguration(parsed_configs)
 
@@ -242,6 +650,23 @@ class Config(object):
                 raise
         self.notification_address = config_dict.get("notification_address", "root")
         self.statefile_path = config_dict.get("statefile", DEFAULT_STATEFILE)
+        self.index_dir = config_dict.get("index_dir", DEFAULT_INDEX_DIR)
+        self.log_file = config_dict.get("log_file", None)
+
+        daemon_dict = config_dict.get("daemon", None)
+        if isinstance(daemon_dict, dict):
+            daemon_dict = dict(daemon_dict)
+            self.max_watches = daemon_dict.pop("max_watches", change_tracking.DEFAULT_MAX_WATCHES)
+            if isinstance(self.max_watches, bool) or not isinstance(self.max_watches, int) or self.max_watches < 0:
+                raise InvalidConfigError("daemon max_watches should be a non-negative integer")
+        else:
+            self.max_watches = change_tracking.DEFAULT_MAX_WATCHES
+        self.default_daemon_settings = validate_daemon_settings(
+            daemon_dict, change_tracking.DEFAULT_DAEMON_SETTINGS)
+        self.daemon_settings = {}
+        default_schedule_window = config_dict.get("schedule_window", None)
+        validate_schedule_window(default_schedule_window)
+        hostname = socket.gethostname()
 
         def parse_backend_type(backend_dict):
             if not isinstance(backend_dict, dict):
@@ -266,14 +691,24 @@ class Config(object):
                 raise InvalidConfigError("Expected a dictionary describing the backup")
 
             name  = backup_dict.get("name", None)
-            paths = validate_paths(backup_dict.get("paths", None))
+            default_paths = {} if "commands" in backup_dict else None
+            paths = validate_paths(backup_dict.get("paths", default_paths))
+            commands = validate_commands(backup_dict.get("commands", None), paths)
+            backup_excludes = validate_excludes(backup_dict, paths)
+            shards, shard_subdirectories = validate_shards(backup_dict)
             backup_name = backup_dict.get("backup_name", None)
             timespec = validate_timespec(backup_dict.get("timespec", None))
+            schedule_start, window_length = validate_schedule_window(
+                backup_dict.get("schedule_window", default_schedule_window))
             backends = backup_dict.get("backends", None)
 
             if name is None:
                 raise InvalidConfigError("Backups must have names")
 
+            if "daemon" in backup_dict:
+                self.daemon_settings[name] = validate_daemon_settings(
+                    backup_dict["daemon"], self.default_daemon_settings)
+
             if not isinstance(backends, list) or any([not isinstance(x, str) for x in backends]):
                 raise InvalidConfigError("Expected a list of strings for backends")
             def find_backend(name):
@@ -283,26 +718,31 @@ class Config(object):
                 return backend
             backends = [find_backend(backend_name) for backend_name in backends]
 
-            return backup.Backup(name, paths, backup_name, timespec, backends)
-
-        if not isinstance(config_dict.get("backups", None), list):
+            return backup.Backup(name, paths, backup_name, timespec, backends,
+                                 commands=commands, excludes=backup_excludes,
+                                 shards=shards, shard_subdirectories=shard_subdirectories,
+                                 schedule_start=schedule_start,
+                                 schedule_jitter=backup.schedule_jitter(hostname, name, window_length))
+
+        templates = config_dict.get("backup_templates", [])
+        if not isinstance(templates, list):
+            raise InvalidConfigError("Expected a list of backup templates")
+        plain_backups = config_dict.get("backups", [] if templates else None)
+        if not isinstance(plain_backups, list):
             raise InvalidConfigError("Expected a list of backups")
+        backup_dicts = itertools.chain(
+            plain_backups,
+            itertools.chain.from_iterable(expand_backup_template(template)
+                                          for template in templates))
         configured_backups = [
-            parse_backup(backup_dict) for backup_dict in config_dict["backups"]
+            parse_backup(backup_dict) for backup_dict in backup_dicts
         ]
 
         for name, count in collections.Counter([configured_backup.name for configured_backup in configured_backups]).items():
             if count > 1:
                 raise InvalidConfigError("Duplicate backup \"{}\"".format(name))
 
-        try:
-            state_mtime = os.stat(self.statefile_path).st_mtime
-        except OSError as e:
-            if e.errno == errno.ENOENT:
-                state_mtime = 0
-            else:
-                raise
-
+        state_mtime = self.state_file_mtime()
         state = self.load_state()
 
         self.configured_backups = backup.BackupSet(
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import errno
+import fnmatch
+import hashlib
+import tempfile
+
+from . import package_logger
+
+def module_logger():
+    return package_logger().getChild("contents_index")
+
+def member_matches(member, pattern):
+    pattern = pattern.lstrip("/")
+    return (fnmatch.fnmatchcase(member, pattern)
+            or fnmatch.fnmatchcase(member, "*/" + pattern))
+
+class ContentsIndex(object):
+    """Persistent cache of the member names of each archive.
+
+    Archives never change once written, so an entry is computed the first
+    time it is needed and cached forever, even after the archive is
+    destroyed.
+    """
+
+    @property
+    def logger(self):
+        return module_logger().getChild("ContentsIndex")
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _backend_directory(self, backend):
+        digest = hashlib.sha1(backend.name.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _index_path(self, archive):
+        ctx = hashlib.sha1()
+        ctx.update(archive.backup_name.encode("utf-8"))
+        ctx.update(repr(float(archive.timestamp)).encode("utf-8"))
+        return os.path.join(self._backend_directory(archive.backend),
+                            "{}.gz".format(ctx.hexdigest()))
+
+    def _read(self, path):
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                return [line.rstrip("\n") for line in f]
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _write(self, path, members):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                with gzip.open(raw, "wt", encoding="utf-8") as f:
+                    for member in members:
+                        f.write(member + "\n")
+            os.rename(tmppath, path)
+        except:
+            os.unlink(tmppath)
+            raise
+
+    def members(self, archive):
+        path = self._index_path(archive)
+        members = self._read(path)
+        if members is None:
+            self.logger.info("Indexing contents of {}".format(archive))
+            members = [member.rstrip("/") for member in archive.list_contents()]
+            # A sharded backup still being written keeps its key once
+            # complete, so only cache what won't change.
+            if archive.complete:
+                self._write(path, members)
+        return members
+
+    def search(self, archives, pattern):
+        for archive in archives:
+            matches = [member for member in self.members(archive)
+                       if member_matches(member, pattern)]
+            if matches:
+                yield archive, matches
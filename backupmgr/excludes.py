@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import fnmatch
+
+_GLOB_SPECIAL = re.compile(r"([*?[\\])")
+
+def escape_pattern(path):
+    """A tar pattern matching exactly path."""
+    return _GLOB_SPECIAL.sub(r"\\\1", path)
+
+def _matches(pattern, parts, anchored=False):
+    """Whether pattern matches a run of parts, so that matching a directory
+    also matches everything in it."""
+    starts = [0] if anchored else range(len(parts))
+    return any(fnmatch.fnmatchcase("/".join(parts[i:j]), pattern)
+               for i in starts for j in range(i + 1, len(parts) + 1))
+
+def _tree_size(path):
+    """Bytes and entries under path, without following symlinks."""
+    total = os.lstat(path).st_size
+    count = 1
+    for directory, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                continue
+            count += 1
+    return total, count
+
+
+class Excludes(object):
+    """What to leave out of a backup's archives.
+
+    patterns match anywhere in a tree, against any trailing run of path
+    components ("*.pyc", ".cache"). path_patterns maps a backed-up path to
+    patterns anchored at that path ("build", "logs/*.log"). A directory
+    holding one of the marker files is left out entirely. With measure, a
+    scan also totals the size of everything left out.
+    """
+
+    def __init__(self, patterns=(), path_patterns=None, markers=(), measure=False):
+        self.patterns = list(patterns)
+        self.path_patterns = dict(path_patterns or {})
+        self.markers = list(markers)
+        self.measure = measure
+
+    def __bool__(self):
+        return bool(self.patterns or self.path_patterns or self.markers)
+
+    def scan(self, paths):
+        """Find what the excludes leave out of paths (path -> name).
+
+        Patterns need no scan, so the trees are only walked to find marker
+        files or to measure; excluded trees are only entered to measure.
+        """
+        anchored = {name: self.path_patterns.get(path, []) for path, name in paths.items()}
+        scan = ExcludeScan(self.patterns, anchored, self.measure)
+        if self.markers or self.measure:
+            for path, name in paths.items():
+                self._scan_tree(path, name, scan)
+        return scan
+
+    def _scan_tree(self, top, name, scan):
+        for directory, dirnames, filenames in os.walk(top):
+            relative = os.path.relpath(directory, top)
+            prefix = name if relative == "." else "/".join([name, relative])
+            if any(marker in filenames for marker in self.markers):
+                del dirnames[:]
+                scan.add_marked(prefix, directory)
+                continue
+            if scan.measured:
+                for entry in dirnames + filenames:
+                    if scan.excludes("/".join([prefix, entry])):
+                        scan.add_excluded(os.path.join(directory, entry))
+            dirnames[:] = [d for d in dirnames if not scan.excludes("/".join([prefix, d]))]
+
+
+class ExcludeScan(object):
+    """The result of Excludes.scan, in terms of archive member names."""
+
+    def __init__(self, patterns, anchored_patterns, measured=False):
+        self.patterns = patterns
+        self.anchored_patterns = anchored_patterns
+        self.measured = measured
+        self.marked = []
+        self.excluded_bytes = 0
+        self.excluded_entries = 0
+
+    def add_marked(self, arcname, path):
+        self.marked.append(arcname)
+        if self.measured:
+            self.add_excluded(path)
+
+    def add_excluded(self, path):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                size, count = _tree_size(path)
+            else:
+                size, count = os.lstat(path).st_size, 1
+        except OSError:
+            return
+        self.excluded_bytes += size
+        self.excluded_entries += count
+
+    def excludes(self, arcname):
+        """Whether the member arcname (NAME/relative/path) is left out."""
+        parts = arcname.split("/")
+        if any(_matches(pattern, parts) for pattern in self.patterns):
+            return True
+        if any(_matches(pattern, parts[1:], anchored=True)
+               for pattern in self.anchored_patterns.get(parts[0], ())):
+            return True
+        return any(arcname == marked or arcname.startswith(marked + "/") for marked in self.marked)
+
+    def tar_patterns(self):
+        """--exclude patterns for bsdtar-style tools such as tarsnap."""
+        patterns = list(self.patterns)
+        for name, anchored in sorted(self.anchored_patterns.items()):
+            patterns += ["^{}/{}".format(escape_pattern(name), pattern) for pattern in anchored]
+        patterns += ["^" + escape_pattern(marked) for marked in sorted(self.marked)]
+        return patterns
+
+    def tar_filter(self, tarinfo):
+        """A tarfile.add filter leaving out excluded members."""
+        return None if self.excludes(tarinfo.name) else tarinfo
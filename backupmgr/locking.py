@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import os
+import fcntl
+import threading
+import contextlib
+import urllib.parse
+
+from . import package_logger
+
+def module_logger():
+    return package_logger().getChild("locking")
+
+def _open_lock_file(path):
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+@contextlib.contextmanager
+def exclusive_lock(path):
+    """Hold an exclusive flock on path, waiting for other holders."""
+    fd = _open_lock_file(path)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+class BackupLocks(object):
+    """Per-backup lock files, held until released or the process exits.
+
+    flock locks belong to the open file, so the locks also exclude other
+    BackupLocks in this process.
+    """
+
+    @property
+    def logger(self):
+        return module_logger().getChild("BackupLocks")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.held = {}
+        self._lock = threading.Lock()
+
+    def _path(self, backup_name):
+        filename = "{}.lock".format(urllib.parse.quote(backup_name, safe=""))
+        return os.path.join(self.directory, filename)
+
+    def try_acquire(self, backup_name):
+        """Take the lock for backup_name if nobody holds it."""
+        with self._lock:
+            if backup_name in self.held:
+                return False
+            os.makedirs(self.directory, exist_ok=True)
+            fd = _open_lock_file(self._path(backup_name))
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            self.held[backup_name] = fd
+            return True
+
+    def release(self, backup_name):
+        with self._lock:
+            fd = self.held.pop(backup_name, None)
+            if fd is not None:
+                os.close(fd)
+
+    def release_all(self):
+        for backup_name in list(self.held):
+            self.release(backup_name)
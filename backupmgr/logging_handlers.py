@@ -1,12 +1,108 @@
 #!/usr/bin/env python3
 
 import logging
+import logging.handlers
 import smtplib
 import subprocess
+import threading
+import contextlib
+import datetime
+import json
 from email.mime.text import MIMEText
 
 SENDMAIL_PATH = "/usr/sbin/sendmail"
 
+CONTEXT_FIELDS = ("backup", "backend", "phase")
+
+_context = threading.local()
+
+def current_log_context():
+    return getattr(_context, "fields", {})
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach fields (backup, backend, phase) to records logged by this thread."""
+    previous = current_log_context()
+    _context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+def with_current_context(fn):
+    """Wrap fn to run in this thread's log context, for another thread."""
+    fields = current_log_context()
+    def run(*args, **kwargs):
+        with log_context(**fields):
+            return fn(*args, **kwargs)
+    return run
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """executor.submit, keeping the submitting thread's log context."""
+    return executor.submit(with_current_context(fn), *args, **kwargs)
+
+
+class LogContextFilter(logging.Filter):
+    """Stamp records with the run id and the logging thread's context.
+
+    This must run on the thread that logged the record, i.e. before it is
+    handed to a queue.
+    """
+
+    def __init__(self, run_id):
+        super(LogContextFilter, self).__init__()
+        self.run_id = run_id
+
+    def filter(self, record):
+        record.run_id = self.run_id
+        fields = current_log_context()
+        for field in CONTEXT_FIELDS:
+            setattr(record, field, fields.get(field, None))
+        return True
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queue records with their exception kept apart from the message.
+
+    QueueHandler.prepare folds the traceback into the message and drops
+    exc_info, so both are saved first for JSONLinesFormatter.
+    """
+
+    def prepare(self, record):
+        bare_message = record.getMessage()
+        exception = logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        record = super(ContextQueueHandler, self).prepare(record)
+        record.bare_message = bare_message
+        record.exception = exception
+        return record
+
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        message = getattr(record, "bare_message", None)
+        if message is None:
+            message = record.getMessage()
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": message,
+            "run_id": getattr(record, "run_id", None),
+        }
+        for field in CONTEXT_FIELDS:
+            entry[field] = getattr(record, field, None)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif getattr(record, "exception", None) is not None:
+            entry["exception"] = record.exception
+        return json.dumps(entry, sort_keys=True)
+
+
+class JSONLinesFileHandler(logging.FileHandler):
+    def __init__(self, filename):
+        super(JSONLinesFileHandler, self).__init__(filename, mode="a", encoding="utf-8")
+        self.formatter = JSONLinesFormatter()
+
 class EmailHandler(logging.Handler):
     def __init__(self, toaddr, fromaddr):
         super(EmailHandler, self).__init__()
@@ -22,7 +118,13 @@ class EmailHandler(logging.Handler):
             self.release()
 
     def finalize(self):
-        m = MIMEText(self.body)
+        """Mail everything logged so far and start a new body."""
+        self.acquire()
+        try:
+            body, self.body = self.body, ""
+        finally:
+            self.release()
+        m = MIMEText(body)
         m["Subject"] = "backupmgr: backup results"
         m["From"] = self.fromaddr
         m["To"] = self.toaddr
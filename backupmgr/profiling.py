@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import io
+import time
+import resource
+import threading
+import contextlib
+import collections
+import cProfile
+import pstats
+import tracemalloc
+
+from . import package_logger
+
+def module_logger():
+    return package_logger().getChild("profiling")
+
+PHASE = "phase"
+SUBPROCESS = "subprocess"
+
+_active_profiler = None
+
+def activate(profiler):
+    global _active_profiler
+    _active_profiler = profiler
+
+def active_profiler():
+    return _active_profiler
+
+def _children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span(object):
+    def __init__(self, name, category, thread_name, start):
+        self.name = name
+        self.category = category
+        self.thread_name = thread_name
+        self.start = start
+        self.wall = None
+        self.cpu = None
+        self.child_cpu = None
+        self.bytes_read = None
+
+    def add_bytes(self, count):
+        self.bytes_read = (self.bytes_read or 0) + count
+
+
+class _NullSpan(object):
+    def add_bytes(self, count):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+@contextlib.contextmanager
+def span(name, category=PHASE):
+    """Time the enclosed block if profiling is active; yields the span.
+
+    CPU time is that of the calling thread only. Child CPU time comes from
+    the process-wide RUSAGE_CHILDREN counters, so it is only exact for
+    subprocesses that don't overlap with others.
+    """
+    profiler = _active_profiler
+    if profiler is None:
+        yield _NULL_SPAN
+        return
+    current = Span(name, category, threading.current_thread().name,
+                   time.monotonic() - profiler.started)
+    cpu_start = time.thread_time()
+    child_cpu_start = _children_cpu_time()
+    try:
+        yield current
+    finally:
+        current.wall = time.monotonic() - profiler.started - current.start
+        current.cpu = time.thread_time() - cpu_start
+        if category == SUBPROCESS:
+            current.child_cpu = _children_cpu_time() - child_cpu_start
+        profiler.add_span(current)
+
+
+class Profiler(object):
+    @property
+    def logger(self):
+        return module_logger().getChild("Profiler")
+
+    def __init__(self, use_cprofile=False, use_tracemalloc=False, started=None):
+        self.started = time.monotonic() if started is None else started
+        self.spans = []
+        self._lock = threading.Lock()
+        self.cprofile = cProfile.Profile() if use_cprofile else None
+        self.use_tracemalloc = use_tracemalloc
+        self.memory_snapshot = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        if self.use_tracemalloc:
+            tracemalloc.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.use_tracemalloc:
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def record(self, name, start, wall, category=PHASE):
+        """Record a span that was timed before the profiler existed."""
+        recorded = Span(name, category, threading.current_thread().name,
+                        start - self.started)
+        recorded.wall = wall
+        self.add_span(recorded)
+
+    def aggregates(self):
+        totals = collections.OrderedDict()
+        for s in sorted(self.spans, key=lambda s: s.start):
+            key = (s.category, s.name)
+            count, wall, cpu, child_cpu, bytes_read = totals.get(key, (0, 0.0, 0.0, 0.0, 0))
+            totals[key] = (count + 1, wall + s.wall, cpu + (s.cpu or 0),
+                           child_cpu + (s.child_cpu or 0), bytes_read + (s.bytes_read or 0))
+        return totals
+
+    def summary_lines(self, limit=15):
+        totals = sorted(self.aggregates().items(), key=lambda item: item[1][1], reverse=True)
+        lines = ["{:>9} {:>9} {:>9} {:>12} {:>5}  {}".format(
+            "wall(s)", "cpu(s)", "child(s)", "bytes", "count", "span")]
+        for (category, name), (count, wall, cpu, child_cpu, bytes_read) in totals[:limit]:
+            lines.append("{:9.3f} {:9.3f} {:9.3f} {:12d} {:5d}  {}: {}".format(
+                wall, cpu, child_cpu, bytes_read, count, category, name))
+        return lines
+
+    def report(self):
+        out = io.StringIO()
+        out.write("Summary\n")
+        for line in self.summary_lines(limit=None):
+            out.write(line + "\n")
+
+        out.write("\nSpans\n")
+        for s in sorted(self.spans, key=lambda s: s.start):
+            out.write("{:10.3f} +{:9.3f}s cpu {} child {} bytes {} [{}] {}: {}\n".format(
+                s.start, s.wall,
+                "-" if s.cpu is None else "{:.3f}s".format(s.cpu),
+                "-" if s.child_cpu is None else "{:.3f}s".format(s.child_cpu),
+                "-" if s.bytes_read is None else s.bytes_read,
+                s.thread_name, s.category, s.name))
+
+        if self.cprofile is not None:
+            out.write("\ncProfile (by cumulative time, main thread only)\n")
+            stats = pstats.Stats(self.cprofile, stream=out)
+            stats.sort_stats("cumulative").print_stats(40)
+
+        if self.memory_snapshot is not None:
+            out.write("\ntracemalloc (top allocation sites)\n")
+            for stat in self.memory_snapshot.statistics("lineno")[:25]:
+                out.write("{}\n".format(stat))
+
+        return out.getvalue()
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            f.write(self.report())
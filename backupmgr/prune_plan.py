@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import json
+import collections
+import datetime
+
+from . import error
+
+PLAN_VERSION = 1
+
+PrunePlanEntry = collections.namedtuple(
+    "PrunePlanEntry", ["backend", "backup", "archive", "timestamp", "reason"])
+
+def entry_for_archive(archive, reason):
+    return PrunePlanEntry(archive.backend.name, archive.backup_name,
+                          archive.fullname, archive.timestamp, reason)
+
+class InvalidPlanError(error.Error):
+    def __init__(self, path, msg):
+        super(InvalidPlanError, self).__init__("Invalid prune plan {}: {}".format(path, msg))
+
+def write_plan(path, entries, run_id):
+    plan = {
+        "version": PLAN_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "run_id": run_id,
+        "archives": [entry._asdict() for entry in entries],
+    }
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def read_plan(path):
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (IOError, ValueError) as e:
+        raise InvalidPlanError(path, e)
+
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise InvalidPlanError(path, "unsupported plan version")
+    if not isinstance(plan.get("archives"), list):
+        raise InvalidPlanError(path, "expected a list of archives")
+
+    entries = []
+    for item in plan["archives"]:
+        try:
+            entry = PrunePlanEntry(**item)
+        except TypeError as e:
+            raise InvalidPlanError(path, e)
+        if (not all(isinstance(x, str) for x in (entry.backend, entry.backup, entry.archive))
+                or not isinstance(entry.timestamp, (int, float))):
+            raise InvalidPlanError(path, "malformed entry {}".format(item))
+        entries.append(entry)
+    return entries
@@ -1,10 +1,60 @@
 #!/usr/bin/env python3
 
 import itertools
+import collections
 
 from . import time_utilities
 from . import package_logger
 
+def footprint(archives, sizes):
+    """Estimated bytes archives of one backup take together: all of the
+    newest, plus the data only each of the others references."""
+    if not archives:
+        return 0
+    newest = max(archives, key=lambda x: x.datetime)
+    return sizes[newest].stored + sum(sizes[a].unique for a in archives if a is not newest)
+
+def _hole(timeline, index):
+    """Seconds of history lost by deleting timeline[index]: the gap it
+    leaves between its neighbours, or the span it alone covers at an end."""
+    times = [a.timestamp for a in timeline]
+    if index == 0:
+        return times[1] - times[0] if len(times) > 1 else float("inf")
+    if index == len(times) - 1:
+        return times[index] - times[index - 1]
+    return times[index + 1] - times[index - 1]
+
+def choose_for_budget(timelines, sizes, excess, protected):
+    """Choose archives to free at least excess bytes.
+
+    timelines holds the archives of each backup. Archives not in protected
+    are taken one at a time, each time the one leaving the smallest hole in
+    its backup's history per byte it frees, so that the history kept stays
+    as evenly spread as possible. Unique sizes don't add up exactly, since
+    deleting two archives also frees what only they share; this errs on the
+    side of deleting more.
+    """
+    timelines = [sorted(t, key=lambda x: x.timestamp) for t in timelines]
+    chosen = []
+    freed = 0
+    while freed < excess:
+        best = None
+        for timeline in timelines:
+            for index, archive in enumerate(timeline):
+                if archive in protected:
+                    continue
+                cost = _hole(timeline, index) / max(sizes[archive].unique, 1)
+                if best is None or cost < best[0]:
+                    best = (cost, timeline, index)
+        if best is None:
+            break
+        _, timeline, index = best
+        archive = timeline.pop(index)
+        chosen.append(archive)
+        freed += sizes[archive].unique
+    return chosen
+
+
 class PruningEngine(object):
     @property
     def logger(self):
@@ -13,11 +63,23 @@ class PruningEngine(object):
     def __init__(self, pruning_config):
         self.pruning_config = pruning_config
 
-    def prunable_archives(self, archives):
+    def prunable_archives_with_reasons(self, archives):
+        """Return (archive, reason) pairs for the archives the policy doesn't keep.
+
+        Sharded backups missing shards can't be restored, so they never count
+        towards retention; they're pruned unless newer than every complete
+        archive, when they may still be being written.
+        """
+        complete = [archive for archive in archives if archive.complete]
+        newest = max((archive.datetime for archive in complete), default=None)
+        broken = [archive for archive in archives if not archive.complete
+                  and newest is not None and archive.datetime < newest]
+        archives = complete
         fresh = []
         daily_saved = {}
         weekly_saved = {}
         monthly_saved = {}
+        periods = {}
 
         sorted_archives = sorted(archives, key=lambda x: x.datetime, reverse=True)
 
@@ -25,6 +87,7 @@ class PruningEngine(object):
             archive_day = time_utilities.day(archive.datetime)
             archive_week = time_utilities.week(archive.datetime)
             archive_month = time_utilities.month(archive.datetime)
+            periods[archive] = (archive_day, archive_week, archive_month)
 
             since = time_utilities.local_timestamp() - archive.datetime
 
@@ -42,15 +105,61 @@ class PruningEngine(object):
                 self.logger.info("Retaining {} as a monthly backup".format(archive))
                 monthly_saved[archive_month] = archive
 
-        prunable = []
         saved_archives = set()
         for saved_archive in itertools.chain(fresh, daily_saved.values(),
                                              weekly_saved.values(),
                                              monthly_saved.values()):
             saved_archives.add(saved_archive)
 
-        return [archive for archive in sorted_archives if archive not in saved_archives]
+        prunable = []
+        for archive in sorted_archives:
+            if archive in saved_archives:
+                continue
+            archive_day, archive_week, archive_month = periods[archive]
+            if archive_day in daily_saved:
+                reason = "a newer archive is kept for the same day"
+            elif archive_week in weekly_saved:
+                reason = "a newer archive is kept for the same week"
+            elif archive_month in monthly_saved:
+                reason = "a newer archive is kept for the same month"
+            else:
+                reason = "beyond retention of {} daily, {} weekly and {} monthly archives".format(
+                    self.pruning_config.daily_count, self.pruning_config.weekly_count,
+                    self.pruning_config.monthly_count)
+            prunable.append((archive, reason))
+        prunable += [(archive, "it is missing shards") for archive in broken]
+        return prunable
+
+    def protected_archives(self, archives):
+        """The newest archives, which no storage budget deletes."""
+        keep = self.pruning_config.keep_latest
+        return set(sorted(archives, key=lambda x: x.datetime, reverse=True)[:keep])
+
+    def budget_prunable_with_reasons(self, archives, sizes):
+        """(archive, reason) pairs to delete from archives, which the count
+        policy keeps, to fit them within the backup's max_size."""
+        budget = self.pruning_config.max_size
+        if budget is None or not archives:
+            return []
+        used = footprint(archives, sizes)
+        if used <= budget:
+            return []
+        reason = "the backup's {} bytes exceed its budget of {}".format(used, budget)
+        chosen = choose_for_budget([archives], sizes, used - budget,
+                                   self.protected_archives(archives))
+        if footprint([a for a in archives if a not in chosen], sizes) > budget:
+            self.logger.warning("Can't fit {} within {} bytes without deleting its newest archives"
+                                .format(self.pruning_config.backup_name, budget))
+        return [(archive, reason) for archive in chosen]
+
+    def prunable_archives(self, archives):
+        return [archive for archive, _ in self.prunable_archives_with_reasons(archives)]
 
     def prune_archives(self, archives):
+        by_backend = collections.OrderedDict()
         for archive in archives:
-            archive.destroy()
+            by_backend.setdefault(archive.backend, []).append(archive)
+        success = True
+        for backend, backend_archives in by_backend.items():
+            success = backend.destroy_archives(backend_archives) and success
+        return success
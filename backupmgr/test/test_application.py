@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import argparse
+import threading
+import tempfile
+import shutil
+import json
+import time
+import os
+
+import mock
+
+from .. import application
+from .. import backup
+from .. import error
+from .. import backend_types
+from .. import configuration
+
+DAY = 24 * 60 * 60
+
+def make_archive(backend, backup_name, timestamp):
+    archive = backend_types.Archive()
+    archive.backend = backend
+    archive.backup_name = backup_name
+    archive.timestamp = timestamp
+    archive.fullname = "{}-{}".format(backup_name, timestamp)
+    return archive
+
+def make_incomplete_group(backend, backup_name, timestamp):
+    shard = make_archive(backend, backup_name, timestamp)
+    shard.shard = (0, 2)
+    return backend_types.ShardedArchive(backend, timestamp, shard.fullname + ".part*of2",
+                                        backup_name, [shard], 2)
+
+def make_backend(name):
+    backend = mock.NonCallableMagicMock()
+    backend.name = name
+    return backend
+
+class ApplicationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backends = {name: make_backend(name) for name in ["local", "offsite-a", "offsite-b"]}
+        self.backups = [
+            backup.Backup("etc", {"/etc": "etc"}, None, [backup.MONDAY],
+                          [self.backends["local"], self.backends["offsite-a"]]),
+            backup.Backup("home", {"/home": "home"}, None, [backup.MONDAY],
+                          [self.backends["offsite-b"]]),
+        ]
+        self.app = application.Application([])
+        self.app.config = mock.NonCallableMagicMock()
+        self.app.config.all_configured_backups.return_value = self.backups
+        self.app.config.config_options = argparse.Namespace(
+            backup_filters=[], backend_filters=[])
+
+    def options(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self.app.config.config_options, key, value)
+
+
+class SelectionTests(ApplicationTestCase):
+    def selection(self):
+        return [(b.name, [backend.name for backend in backends])
+                for b, backends in self.app.get_selected_backups_and_backends()]
+
+    def test_no_filters_selects_everything(self):
+        self.assertEqual(self.selection(),
+                         [("etc", ["local", "offsite-a"]), ("home", ["offsite-b"])])
+
+    def test_backup_filter(self):
+        self.options(backup_filters=["h*"])
+        self.assertEqual(self.selection(), [("home", ["offsite-b"])])
+
+    def test_backend_filter(self):
+        self.options(backend_filters=["offsite-*"])
+        self.assertEqual(self.selection(),
+                         [("etc", ["offsite-a"]), ("home", ["offsite-b"])])
+        self.options(backend_filters=["local"])
+        self.assertEqual(self.selection(), [("etc", ["local"])])
+
+    def test_repeated_filters(self):
+        self.options(backup_filters=["etc", "home"], backend_filters=["local", "offsite-b"])
+        self.assertEqual(self.selection(), [("etc", ["local"]), ("home", ["offsite-b"])])
+
+    def test_only_selected_backends_listed(self):
+        self.options(backup_filters=["home"])
+        selection = self.app.get_selected_backups_and_backends()
+        self.app.get_backend_to_primed_list_token_map(selection)
+        self.assertEqual(self.backends["offsite-b"].get_primed_list_token.call_count, 1)
+        self.assertEqual(self.backends["local"].get_primed_list_token.call_count, 0)
+
+    def test_unmatched_filter_is_an_error(self):
+        self.options(backup_filters=["nothing"])
+        with self.assertRaises(error.Error):
+            self.app.get_selected_backups_and_backends()
+
+
+class PruneTests(ApplicationTestCase):
+    def setUp(self):
+        super(PruneTests, self).setUp()
+        self.options(max_concurrent_deletes=1, apply=None, dry_run=False, plan_out=None)
+        self.app.config.pruning_configuration = configuration.PruningConfiguration([
+            configuration.BackupPruningConfiguration(name, 1, 0, 0) for name in ["etc", "home"]])
+        self.active_deletes = 0
+        self.max_active_deletes = 0
+        self.lock = threading.Lock()
+        for backend in self.backends.values():
+            archives = {name: [make_archive(backend, name, 1416279400 + i * DAY) for i in range(3)]
+                        for name in ["etc", "home"]}
+            backend.existing_archives_for_name.side_effect = (
+                lambda name, primed_list_token, archives=archives: archives[name])
+            backend.destroy_archives.side_effect = self.destroy
+            backend.max_size = None
+
+    def destroy(self, archives):
+        with self.lock:
+            self.active_deletes += 1
+            self.max_active_deletes = max(self.max_active_deletes, self.active_deletes)
+        time.sleep(0.01)
+        with self.lock:
+            self.active_deletes -= 1
+        return True
+
+    def test_prunes_every_backend(self):
+        self.assertTrue(self.app.prune_archives())
+        for backend in self.backends.values():
+            self.assertEqual(backend.get_primed_list_token.call_count, 1)
+            pruned, = backend.destroy_archives.call_args[0]
+            self.assertEqual(len(pruned), 2)
+        self.assertEqual(self.max_active_deletes, 1)
+
+    def test_failed_backend_does_not_stop_others(self):
+        self.backends["local"].get_primed_list_token.side_effect = \
+            backend_types.BackendOperationError("down")
+        self.assertFalse(self.app.prune_archives())
+        self.assertEqual(self.backends["offsite-a"].destroy_archives.call_count, 1)
+        self.assertEqual(self.backends["offsite-b"].destroy_archives.call_count, 1)
+
+    def test_summary_counts_pruned_before_failure(self):
+        backend = self.backends["offsite-a"]
+        self.backups[1].backends.append(backend)
+        backend.destroy_archives.side_effect = lambda archives: archives[0].backup_name == "etc"
+        with self.assertLogs("backupmgr.application", "INFO") as logs:
+            self.assertFalse(self.app.prune_archives())
+        summary = logs.output[-1]
+        self.assertIn("Pruned 6 archives (failed on offsite-a)", summary)
+        self.assertIn("etc from offsite-a: 2", summary)
+        self.assertNotIn("home from offsite-a", summary)
+
+    def test_incomplete_shard_groups_are_not_retained(self):
+        self.app.config.pruning_configuration = configuration.PruningConfiguration([
+            configuration.BackupPruningConfiguration("etc", 2, 0, 0)])
+        backend = self.backends["offsite-a"]
+        archives = [make_archive(backend, "etc", 1416279400),
+                    make_incomplete_group(backend, "etc", 1416279400 + DAY),
+                    make_archive(backend, "etc", 1416279400 + 2 * DAY),
+                    make_incomplete_group(backend, "etc", 1416279400 + 3 * DAY)]
+        backend.existing_archives_for_name.side_effect = (
+            lambda name, primed_list_token: archives if name == "etc" else [])
+        self.options(backup_filters=["etc"], backend_filters=["offsite-a"])
+        self.assertTrue(self.app.prune_archives())
+        pruned, = backend.destroy_archives.call_args[0]
+        self.assertEqual(pruned, [archives[1]])
+
+    def budget_backend(self, days, total=None):
+        """Give offsite-a one archive of etc on each of days, each holding 10
+        unique bytes of 100, and no archives of home."""
+        backend = self.backends["offsite-a"]
+        archives = [make_archive(backend, "etc", 1416279400 + day * DAY) for day in days]
+        backend.existing_archives_for_name.side_effect = (
+            lambda name, primed_list_token: archives if name == "etc" else [])
+        backend.storage_usage.side_effect = lambda listed: backend_types.StorageUsage(
+            total, {archive: backend_types.ArchiveSize(100, 10) for archive in listed})
+        self.options(backup_filters=["etc"], backend_filters=["offsite-a"])
+        return backend, archives
+
+    def test_backup_budget_thins_densest_history(self):
+        inf = float("inf")
+        self.app.config.pruning_configuration = configuration.PruningConfiguration([
+            configuration.BackupPruningConfiguration("etc", inf, inf, inf, max_size=135)])
+        backend, archives = self.budget_backend([0, 5, 6, 7, 10])
+        self.assertTrue(self.app.prune_archives())
+        pruned, = backend.destroy_archives.call_args[0]
+        self.assertEqual(pruned, [archives[2]])
+
+    def test_backend_budget_keeps_newest(self):
+        inf = float("inf")
+        self.app.config.pruning_configuration = configuration.PruningConfiguration([
+            configuration.BackupPruningConfiguration("etc", inf, inf, inf, keep_latest=2)])
+        backend, archives = self.budget_backend([0, 1, 2, 3], total=1000)
+        backend.max_size = 900
+        self.assertTrue(self.app.prune_archives())
+        pruned, = backend.destroy_archives.call_args[0]
+        self.assertEqual(sorted(a.timestamp for a in pruned),
+                         [archives[0].timestamp, archives[1].timestamp])
+
+    def test_dry_run_plan_out_then_apply(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        plan_path = os.path.join(directory, "plan.json")
+        self.options(dry_run=True, plan_out=plan_path)
+        with mock.patch("sys.stdout"):
+            self.assertTrue(self.app.prune_archives())
+        for backend in self.backends.values():
+            self.assertEqual(backend.destroy_archives.call_count, 0)
+
+        with open(plan_path) as f:
+            plan = json.load(f)
+        self.assertEqual(len(plan["archives"]), 6)
+        entry = plan["archives"][0]
+        self.assertEqual(set(entry), {"backend", "backup", "archive", "timestamp", "reason"})
+
+        for backend in self.backends.values():
+            backend.get_primed_list_token.reset_mock()
+            backend.archive_for_name.side_effect = (
+                lambda backup_name, timestamp, fullname, backend=backend:
+                make_archive(backend, backup_name, timestamp))
+        self.app.config.configured_backend_by_name.side_effect = self.backends.get
+        self.options(dry_run=False, plan_out=None, apply=plan_path)
+        self.assertTrue(self.app.prune_archives())
+        for backend in self.backends.values():
+            self.assertEqual(backend.get_primed_list_token.call_count, 0)
+            pruned, = backend.destroy_archives.call_args[0]
+            self.assertEqual(len(pruned), 2)
+
+
+class ClaimBackupsTests(ApplicationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.locks = mock.NonCallableMagicMock()
+        self.locks.try_acquire.side_effect = lambda name: name != "home"
+        loaded = backup.upgrade_state({"etc": 100.0})
+        self.app.config.configured_backup_set.return_value = backup.BackupSet(
+            loaded, self.backups, 0, 1, None)
+
+    def test_skips_locked_backups(self):
+        self.app.config.load_state.return_value = backup.upgrade_state({"etc": 100.0})
+        claimed = self.app.claim_backups(self.backups, self.locks)
+        self.assertEqual([b.name for b in claimed], ["etc"])
+        self.assertEqual(self.locks.release.call_count, 0)
+
+    def test_skips_backups_run_since_state_loaded(self):
+        self.app.config.load_state.return_value = backup.upgrade_state({"etc": 200.0})
+        self.assertEqual(self.app.claim_backups(self.backups, self.locks), [])
+        self.locks.release.assert_called_once_with("etc")
+
+
+class RestoreCheapestTests(ApplicationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.etc = self.backups[0]
+        self.app.get_backup_by_name = lambda name: self.etc
+        self.options(backup="etc", archive_spec="1000.0", destination="/restore", members=[],
+                     all_matches=False, cheapest=True)
+        for backend in self.backends.values():
+            backend.restore_cost = None
+        self.archives = {}
+        for name in ["local", "offsite-a"]:
+            backend = self.backends[name]
+            archives = [make_archive(backend, "etc", ts) for ts in [1000.0, 2000.0]]
+            for archive in archives:
+                archive.restore = mock.Mock(return_value=True)
+            backend.existing_archives_for_name.return_value = archives
+            self.archives[name] = archives
+
+    def backup_set(self, throughputs):
+        state = backup.upgrade_state({"version": backup.STATE_VERSION, "backups": {"etc": {
+            "backends": {name: {"uploaded": rate, "duration": 1}
+                         for name, rate in throughputs.items()}}}})
+        self.app.config.configured_backup_set.return_value = backup.BackupSet(
+            state, self.backups, 0, 1, None)
+
+    def test_ranks_by_cost_then_throughput(self):
+        self.backup_set({"local": 10, "offsite-a": 1000})
+        self.assertTrue(self.app.restore_backup())
+        self.archives["offsite-a"][0].restore.assert_called_once_with("/restore", [])
+        self.assertEqual(self.archives["local"][0].restore.call_count, 0)
+
+        self.backends["local"].restore_cost = 1
+        self.assertTrue(self.app.restore_backup())
+        self.archives["local"][0].restore.assert_called_once_with("/restore", [])
+
+    def test_falls_back_to_next_source(self):
+        self.backup_set({"local": 1000, "offsite-a": 10})
+        self.archives["local"][0].restore.return_value = False
+        self.assertTrue(self.app.restore_backup())
+        self.archives["offsite-a"][0].restore.assert_called_once_with("/restore", [])
+
+    def test_ordinals_rejected(self):
+        self.backup_set({})
+        self.options(archive_spec="-1")
+        with self.assertRaises(error.Error):
+            self.app.restore_backup()
+
+    def test_incomplete_shard_group_not_restored(self):
+        self.backup_set({"local": 1000, "offsite-a": 10})
+        broken = make_incomplete_group(self.backends["local"], "etc", 1000.0)
+        broken.restore = mock.Mock(return_value=True)
+        self.backends["local"].existing_archives_for_name.return_value = (
+            [broken] + self.archives["local"][1:])
+        self.assertTrue(self.app.restore_backup())
+        self.assertEqual(broken.restore.call_count, 0)
+        self.archives["offsite-a"][0].restore.assert_called_once_with("/restore", [])
+
+    def test_archive_only_on_one_backend(self):
+        self.backup_set({})
+        self.backends["local"].existing_archives_for_name.return_value = self.archives["local"][1:]
+        self.assertTrue(self.app.restore_backup())
+        self.archives["offsite-a"][0].restore.assert_called_once_with("/restore", [])
+
+
+class FindTests(ApplicationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        self.app.config.index_dir = self.index_dir
+        self.app.config.configured_backup_by_name.return_value = self.backups[0]
+        self.options(backup="etc", pattern="hosts", before=None, after=None)
+        self.backends["offsite-a"].existing_archives_for_name.return_value = []
+
+    def test_incomplete_shard_groups_skipped(self):
+        backend = self.backends["local"]
+        group = make_incomplete_group(backend, "etc", 2000.0)
+        group.shards[0].list_contents = mock.Mock(return_value=["etc/hosts"])
+        backend.existing_archives_for_name.return_value = [group]
+        with mock.patch("sys.stdout"):
+            self.assertFalse(self.app.find_in_archives())
+        self.assertEqual(group.shards[0].list_contents.call_count, 0)
+        self.assertEqual(os.listdir(self.index_dir), [])
+
+
+class ReplicateTests(ApplicationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.get_backend_by_name = self.backends.get
+        self.options(source="local", target="offsite-a", jobs=2, dry_run=False)
+        source, target = self.backends["local"], self.backends["offsite-a"]
+        self.source_archives = [make_archive(source, "etc", ts) for ts in [1000.0, 2000.0, 3000.0]]
+        for archive in self.source_archives:
+            archive.write_tar = mock.Mock(return_value=True)
+        source.existing_archives_for_name.return_value = self.source_archives
+        target.existing_archives_for_name.return_value = [make_archive(target, "etc", 2000.0)]
+        target.store_archive.return_value = backend_types.PerformResult(True)
+
+    def test_copies_missing_archives(self):
+        self.assertTrue(self.app.replicate_archives())
+        stored = sorted(call[0][1].timestamp() for call in
+                        self.backends["offsite-a"].store_archive.call_args_list)
+        self.assertEqual(stored, [1000.0, 3000.0])
+        name, _, write_tar = self.backends["offsite-a"].store_archive.call_args[0]
+        self.assertEqual(name, "etc")
+        self.assertIn(write_tar, [a.write_tar for a in self.source_archives])
+
+    def test_dry_run(self):
+        self.options(dry_run=True)
+        with mock.patch("sys.stdout"):
+            self.assertTrue(self.app.replicate_archives())
+        self.assertEqual(self.backends["offsite-a"].store_archive.call_count, 0)
+
+    def test_needs_backups_on_both(self):
+        self.options(target="offsite-b")
+        with self.assertRaises(error.Error):
+            self.app.replicate_archives()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import datetime
+
+import dateutil.tz
+
+from .. import archive_specifiers
+from .. import backend_types
+
+def make_archive(*args):
+    archive = backend_types.Archive()
+    dt = datetime.datetime(*args, tzinfo=dateutil.tz.tzlocal())
+    archive.timestamp = dt.timestamp()
+    return archive
+
+class ArchiveSpecifierTests(unittest.TestCase):
+    def setUp(self):
+        self.archives = [
+            make_archive(2014, 2, 27, 1),
+            make_archive(2014, 3, 1, 1),
+            make_archive(2014, 3, 15, 1),
+            make_archive(2014, 3, 31, 23),
+            make_archive(2014, 4, 1, 1),
+        ]
+
+    def select(self, spec_str):
+        spec = archive_specifiers.ArchiveSpecifier(spec_str)
+        return [self.archives.index(a) for a in spec.select(self.archives)]
+
+    def test_dispatch(self):
+        cases = [
+            ("3", archive_specifiers.OrdinalArchiveSpecifier),
+            ("1416279400", archive_specifiers.TimestampArchiveSpecifier),
+            ("Nov 17, 2014", archive_specifiers.FuzzyDatetimeArchiveSpecifier),
+            ("10..20", archive_specifiers.RangeArchiveSpecifier),
+            ("2014-03-01..2014-03-31", archive_specifiers.RangeArchiveSpecifier),
+            ("1,5,7", archive_specifiers.MultiArchiveSpecifier),
+            ("3..5,10", archive_specifiers.MultiArchiveSpecifier),
+        ]
+        for spec_str, expected in cases:
+            self.assertIsInstance(archive_specifiers.ArchiveSpecifier(spec_str),
+                                  expected, spec_str)
+
+    def test_uses_ordinals(self):
+        for spec_str, expected in [("3", True), ("1416279400", False), ("2014-03-01..-1", True),
+                                   ("1416279400,2014-03-01..", False), ("1416279400,2", True)]:
+            self.assertEqual(archive_specifiers.ArchiveSpecifier(spec_str).uses_ordinals,
+                             expected, spec_str)
+
+    def test_single(self):
+        self.assertEqual(self.select("2"), [2])
+        self.assertEqual(self.select("2014-03-15"), [2])
+
+    def test_ordinal_ranges(self):
+        self.assertEqual(self.select("1..3"), [1, 2, 3])
+        self.assertEqual(self.select("..1"), [0, 1])
+        self.assertEqual(self.select("3.."), [3, 4])
+
+    def test_date_range_covers_whole_end_day(self):
+        self.assertEqual(self.select("2014-03-01..2014-03-31"), [1, 2, 3])
+
+    def test_timestamp_range(self):
+        spec_str = "{}..{}".format(self.archives[1].timestamp, self.archives[2].timestamp)
+        self.assertEqual(self.select(spec_str), [1, 2])
+
+    def test_multi(self):
+        self.assertEqual(self.select("0,4"), [0, 4])
+        self.assertEqual(self.select("0, 2..3"), [0, 2, 3])
+
+    def test_no_match(self):
+        with self.assertRaises(ValueError):
+            archive_specifiers.ArchiveSpecifier("not a spec at all")
@@ -29,6 +29,16 @@ class TestBackupBackendName(unittest.TestCase):
         self.assertEqual(str(MyBackend({"name":"foo"})), "MyBackend: foo")
         backend_types.unregister_backend_type("mytype")
 
+    def test_archive_for_name_unsupported(self):
+        class MyBackend(backend_types.BackupBackend):
+            NAMES = ("mytype",)
+        try:
+            with self.assertRaisesRegex(backend_types.BackendOperationError,
+                                        "foo can't look up archives by name"):
+                MyBackend({"name":"foo"}).archive_for_name("bar", 1416279400, "bar-1416279400")
+        finally:
+            backend_types.unregister_backend_type("mytype")
+
 class TestArchiveBasics(unittest.TestCase):
     def test_archive_datetime_property(self):
         arch = backend_types.Archive()
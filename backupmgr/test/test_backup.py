@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 import datetime
+import threading
+import collections
+import time
 
 import mock
 import dateutil
 import dateutil.tz
 
 from .. import backup
+from .. import backend_types
 
 class NextDueRunTests(unittest.TestCase):
     specmonthly = [backup.MONTHLY]
@@ -118,6 +123,102 @@ class NextDueRunTests(unittest.TestCase):
 
     del mk_closure, tst, spec, time, tgt, name
 
+class ScheduleTests(unittest.TestCase):
+    def dt(self, *args):
+        return datetime.datetime(*args, tzinfo=dateutil.tz.tzlocal())
+
+    def test_interval(self):
+        spec = [backup.IntervalSchedule(datetime.timedelta(minutes=15))]
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 17, 10, 7)),
+                         self.dt(2014, 11, 17, 10, 22))
+
+    def test_cron_hourly(self):
+        spec = [backup.CronSchedule("0 * * * *")]
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 17, 10, 0)),
+                         self.dt(2014, 11, 17, 11, 0))
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 17, 23, 30)),
+                         self.dt(2014, 11, 18, 0, 0))
+
+    def test_cron_steps_and_ranges(self):
+        spec = [backup.CronSchedule("*/20 9-17 * * 1-5")]
+        # Friday evening rolls over to Monday morning
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 21, 17, 45)),
+                         self.dt(2014, 11, 24, 9, 0))
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 24, 9, 0)),
+                         self.dt(2014, 11, 24, 9, 20))
+
+    def test_cron_day_of_month_or_weekday(self):
+        spec = [backup.CronSchedule("30 2 1 * 0")]
+        # the 1st of December or any Sunday, whichever comes first
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 24)),
+                         self.dt(2014, 11, 30, 2, 30))
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 30, 3)),
+                         self.dt(2014, 12, 1, 2, 30))
+
+    def test_cron_month_rollover(self):
+        spec = [backup.CronSchedule("0 0 29 2 *")]
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 3, 1)),
+                         self.dt(2016, 2, 29, 0, 0))
+
+    def test_cron_invalid(self):
+        for expression in ["* * * *", "60 * * * *", "* * 31 2 *", "*/0 * * * *"]:
+            with self.assertRaises(ValueError):
+                backup.CronSchedule(expression)
+
+    def test_mixed_with_calendar_parts(self):
+        spec = [backup.MONTHLY, backup.CronSchedule("0 12 * * *")]
+        self.assertEqual(backup.next_due_run(spec, self.dt(2014, 11, 30, 13)),
+                         self.dt(2014, 12, 1, 0, 0))
+
+    def test_offset_keeps_daily_cadence(self):
+        offset = datetime.timedelta(hours=2, minutes=30)
+        self.assertEqual(backup.next_due_run(backup.WEEKDAYS, self.dt(2014, 11, 17, 1), offset),
+                         self.dt(2014, 11, 17, 2, 30))
+        self.assertEqual(backup.next_due_run(backup.WEEKDAYS, self.dt(2014, 11, 17, 2, 31), offset),
+                         self.dt(2014, 11, 18, 2, 30))
+        evening = -datetime.timedelta(hours=2)
+        self.assertEqual(backup.next_due_run([backup.MONTHLY], self.dt(2014, 11, 30, 21), evening),
+                         self.dt(2014, 11, 30, 22))
+
+    def test_jitter_is_stable_and_spread(self):
+        window = datetime.timedelta(hours=4)
+        jitters = [backup.schedule_jitter("host{}".format(i), "etc", window) for i in range(200)]
+        self.assertEqual(jitters[0], backup.schedule_jitter("host0", "etc", window))
+        self.assertTrue(all(datetime.timedelta(0) <= j < window for j in jitters))
+        hours = collections.Counter(int(j.total_seconds() // 3600) for j in jitters)
+        self.assertEqual(sorted(hours), [0, 1, 2, 3])
+        self.assertGreater(min(hours.values()), 25)
+
+
+@unittest.skipUnless(os.environ.get("BACKUPMGR_BENCHMARKS"),
+                     "timing-dependent; set BACKUPMGR_BENCHMARKS=1 to run")
+class NextDueRunBenchmarks(unittest.TestCase):
+    ITERATIONS = 10000
+    # Generous bound: thousands of backups must be checkable every tick
+    MAX_SECONDS = 1.0
+
+    def bench(self, spec):
+        since = datetime.datetime(2014, 11, 17, 10, 7, tzinfo=dateutil.tz.tzlocal())
+        start = time.perf_counter()
+        for _ in range(self.ITERATIONS):
+            backup.next_due_run(spec, since)
+        return time.perf_counter() - start
+
+    def test_bench_daily(self):
+        self.assertLess(self.bench(backup.WEEKDAYS), self.MAX_SECONDS)
+
+    def test_bench_complex(self):
+        self.assertLess(self.bench(NextDueRunTests.speccomplex), self.MAX_SECONDS)
+
+    def test_bench_interval(self):
+        spec = [backup.IntervalSchedule(datetime.timedelta(minutes=5))]
+        self.assertLess(self.bench(spec), self.MAX_SECONDS)
+
+    def test_bench_cron(self):
+        spec = [backup.CronSchedule("*/15 1-5 * * 1-5")]
+        self.assertLess(self.bench(spec), self.MAX_SECONDS)
+
+
 class BackupTests(unittest.TestCase):
     def setUp(self):
         self.backends = [mock.NonCallableMagicMock() for _ in range(3)]
@@ -132,3 +233,124 @@ class BackupTests(unittest.TestCase):
 
     def test_get_backends(self):
         self.assertEqual(set(self.backends), set(self.backup.get_backends()))
+
+    def test_perform_runs_backends_concurrently(self):
+        for i, backend in enumerate(self.backends):
+            backend.name = "backend{}".format(i)
+        barrier = threading.Barrier(len(self.backends), timeout=5)
+        def perform(paths, name, now, commands=None, excludes=None):
+            barrier.wait()
+            return True
+        for backend in self.backends:
+            backend.perform.side_effect = perform
+        self.backends[0].perform.side_effect = lambda *args, **kwargs: barrier.wait() and False
+        result = self.backup.perform(None)
+        self.assertFalse(result)
+        self.assertEqual([run.success for run in result.backend_runs.values()],
+                         [False, True, True])
+
+    def test_perform_subset(self):
+        result = self.backup.perform(None, self.backends[1:2])
+        self.assertTrue(result)
+        self.assertEqual(self.backends[0].perform.call_count, 0)
+        self.assertEqual(self.backends[1].perform.call_count, 1)
+
+    def test_shard_plan(self):
+        self.assertIsNone(self.backup.shard_plan())
+        self.backup.shards = 3
+        self.assertEqual([shard.members for shard in self.backup.shard_plan()],
+                         [["one"], ["two"]])
+
+    def test_failed_shard_destroys_the_rest(self):
+        self.backup.shards = 2
+        backend = self.backends[0]
+        backend.name = "backend0"
+        def perform(paths, name, now, commands=None, excludes=None, shard=None):
+            return backend_types.PerformResult(shard.index == 0, 10, 5)
+        backend.perform.side_effect = perform
+        result = self.backup.perform(None, [backend])
+        self.assertFalse(result)
+        calls = sorted(backend.perform.call_args_list, key=lambda call: call[1]["shard"].index)
+        self.assertEqual(sorted(call[1]["shard"].members for call in calls), [["one"], ["two"]])
+        self.assertEqual([call[1]["commands"] is None for call in calls], [False, True])
+        backend.shard_archive.assert_called_once_with(self.name, None, calls[0][1]["shard"])
+        backend.destroy_archives.assert_called_once_with([backend.shard_archive.return_value])
+
+
+class BackupStateTests(unittest.TestCase):
+    def setUp(self):
+        self.backends = [mock.NonCallableMagicMock() for _ in range(2)]
+        for i, backend in enumerate(self.backends):
+            backend.name = "backend{}".format(i)
+        self.backups = [backup.Backup(name, {"/" + name: name}, None, [backup.MONDAY],
+                                      self.backends)
+                        for name in ["small", "new", "big", "estimated"]]
+        self.now = datetime.datetime(2014, 11, 17, tzinfo=dateutil.tz.tzlocal())
+
+    def backup_set(self, state):
+        return backup.BackupSet(backup.upgrade_state(state), self.backups, 0, 1, self.now)
+
+    def history(self, *durations):
+        return {"backends": {"backend{}".format(i): {"duration": d, "bytes": d * 1000,
+                                                     "uploaded": d * 100}
+                             for i, d in enumerate(durations)}}
+
+    def test_upgrade_legacy_state(self):
+        state = backup.upgrade_state({"small": 1416279400.0})
+        self.assertEqual(state, {"version": backup.STATE_VERSION,
+                                 "backups": {"small": {"last_run": 1416279400.0}}})
+        self.assertIs(backup.upgrade_state(state), state)
+        backup_set = self.backup_set({"small": 1416279400.0})
+        self.assertEqual(backup_set.last_run_of_backup(self.backups[0]).timestamp(),
+                         1416279400.0)
+
+    def test_longest_first(self):
+        backup_set = self.backup_set({"version": backup.STATE_VERSION, "backups": {
+            "small": self.history(1, 2),
+            "big": self.history(50, 60),
+            "estimated": {},
+        }})
+        ordered = backup_set.order_longest_first(self.backups, {"estimated": 500})
+        self.assertEqual([b.name for b in ordered], ["new", "big", "estimated", "small"])
+
+    def test_throughput_counts_uploaded_bytes(self):
+        backup_set = self.backup_set({"version": backup.STATE_VERSION, "backups": {
+            "small": self.history(1, 3),
+            "big": {"backends": {"backend0": {"duration": 10, "bytes": 5000}}},
+        }})
+        self.assertEqual(backup_set.observed_throughput(), 100)
+        self.assertEqual(backup_set.observed_throughput(self.backends[1]), 100)
+
+    def test_results_recorded(self):
+        backup_set = self.backup_set({})
+        result = backup.BackupResult()
+        result.add(self.backends[0], backend_types.PerformResult(True, 100, 10), 2.5)
+        result.add(self.backends[1], False, 1.0)
+        state = backup_set.state_after_results([(self.backups[0], result)])
+        entry = state["backups"]["small"]
+        self.assertNotIn("last_run", entry)
+        self.assertEqual(entry["backends"]["backend0"]["bytes"], 100)
+        self.assertEqual(entry["backends"]["backend0"]["duration"], 2.5)
+        self.assertNotIn("backend1", entry["backends"])
+        self.assertEqual(backup_set.state, backup.upgrade_state({}))
+
+        later = backup.BackupSet(state, self.backups, 0, 1, self.now + datetime.timedelta(hours=1))
+        self.assertEqual(later.backends_due(self.backups[0]), [self.backends[1]])
+        self.assertIn(self.backups[0], later.backups_due())
+
+    def test_config_change_waits_for_jitter(self):
+        small = self.backups[0]
+        small.schedule_jitter = datetime.timedelta(hours=2)
+        state = {"small": self.now.timestamp() - 60}
+        changed = self.now.timestamp()
+        soon = backup.BackupSet(backup.upgrade_state(state), self.backups, changed, 0,
+                                self.now + datetime.timedelta(hours=1))
+        self.assertEqual(soon.backends_due(small), [])
+        self.assertNotIn(small, soon.backups_due())
+        later = backup.BackupSet(backup.upgrade_state(state), self.backups, changed, 0,
+                                 self.now + datetime.timedelta(hours=3))
+        self.assertEqual(later.backends_due(small), self.backends)
+        with self.assertLogs("backupmgr.BackupSet", "INFO") as logs:
+            self.assertIn(small, later.backups_due())
+        self.assertIn("INFO:backupmgr.BackupSet:Configuration changed. Should run small.",
+                      logs.output)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from .. import change_tracking
+
+SETTINGS = change_tracking.DaemonSettings(debounce=60, min_interval=3600,
+                                          max_interval=86400, scan_interval=10)
+
+class BackupTriggerTests(unittest.TestCase):
+    def test_clean_backup_waits_for_max_interval(self):
+        trigger = change_tracking.BackupTrigger(SETTINGS, last_run=1000, dirty=False)
+        self.assertEqual(trigger.due_at(), 1000 + 86400)
+        self.assertFalse(trigger.due(50000))
+
+    def test_change_debounced_and_rate_limited(self):
+        trigger = change_tracking.BackupTrigger(SETTINGS, last_run=50000, dirty=False)
+        trigger.note_change(100000)
+        self.assertEqual(trigger.due_at(), 100060)
+        trigger.note_run(100060)
+        trigger.note_change(100100)
+        self.assertEqual(trigger.due_at(), 100060 + 3600)
+        trigger.note_change(100060 + 3590)
+        self.assertEqual(trigger.due_at(), 100060 + 3650)
+
+    def test_dirty_at_startup(self):
+        trigger = change_tracking.BackupTrigger(SETTINGS, last_run=0, now=500)
+        self.assertEqual(trigger.due_at(), 3600)
+
+
+class ChangeTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.trees = {}
+        for name in ["etc", "home"]:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.join(path, "sub"))
+            self.trees[name] = path
+        self.now = 0
+
+    def tracker(self, max_watches):
+        tracker = change_tracking.ChangeTracker(
+            {name: [path] for name, path in self.trees.items()},
+            {name: 10 for name in self.trees}, max_watches, clock=lambda: self.now)
+        tracker.start()
+        self.addCleanup(tracker.close)
+        return tracker
+
+    def write(self, *components):
+        with open(os.path.join(self.directory, *components), "w") as f:
+            f.write("changed")
+
+    def test_watches_nested_and_new_directories(self):
+        tracker = self.tracker(max_watches=100)
+        if not tracker.watched_backups:
+            self.skipTest("inotify unavailable")
+        self.assertEqual(tracker.wait(0), set())
+        self.write("home", "sub", "file")
+        self.assertEqual(tracker.wait(1), {"home"})
+        os.makedirs(os.path.join(self.trees["etc"], "new"))
+        self.assertEqual(tracker.wait(1), {"etc"})
+        self.write("etc", "new", "file")
+        self.assertEqual(tracker.wait(1), {"etc"})
+
+    def test_scans_trees_over_watch_budget(self):
+        tracker = self.tracker(max_watches=2)
+        self.assertEqual(tracker.watched_backups & {"home"}, set())
+        self.write("home", "sub", "file")
+        self.assertEqual(tracker.wait(0) & {"home"}, set())
+        self.now = 10
+        self.assertIn("home", tracker.wait(0))
+        self.now = 20
+        self.assertEqual(tracker.wait(0) & {"home"}, set())
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import tarfile
+import io
+
+from .. import command_output
+
+class CommandOutputArchiveTests(unittest.TestCase):
+    def test_output_is_chunked(self):
+        out = io.BytesIO()
+        self.assertTrue(command_output.write_command_output_archive(
+            {"db.sql": ["printf", "0123456789"]}, out, chunk_size=4))
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            members = [m for m in tar.getmembers() if m.isfile()]
+            self.assertEqual([m.name for m in members],
+                             ["db.sql/000000", "db.sql/000001", "db.sql/000002"])
+            data = b"".join(tar.extractfile(m).read() for m in members)
+        self.assertEqual(data, b"0123456789")
+
+    def test_empty_output_still_has_member(self):
+        out = io.BytesIO()
+        self.assertTrue(command_output.write_command_output_archive(
+            {"empty": ["true"]}, out, chunk_size=4))
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            self.assertEqual(tar.getnames(), ["empty", "empty/000000"])
+
+    def test_command_failure_reported(self):
+        with self.assertLogs("backupmgr", level="ERROR") as logs:
+            self.assertFalse(command_output.write_command_output_archive(
+                {"fail": ["false"]}, io.BytesIO()))
+        self.assertIn("failed with exit code 1", logs.output[0])
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import datetime
+import tempfile
+import shutil
+import json
+import time
+import os
+
+import mock
+
+from .. import configuration
+from .. import backup
+from .. import backend_types
+
+class ValidateTimespecTests(unittest.TestCase):
+    def test_calendar_specs(self):
+        self.assertEqual(configuration.validate_timespec("weekly"), [backup.WEEKLY])
+        self.assertEqual(configuration.validate_timespec(["Mon", "fr"]),
+                         {backup.MONDAY, backup.FRIDAY})
+        self.assertEqual(configuration.validate_timespec(["weekly", "Monthly", "wed"]),
+                         {backup.WEEKLY, backup.MONTHLY, backup.WEDNESDAY})
+
+    def test_hourly(self):
+        part, = configuration.validate_timespec("hourly")
+        self.assertIsInstance(part, backup.CronSchedule)
+        self.assertEqual(part.minutes, [0])
+
+    def test_intervals(self):
+        part, = configuration.validate_timespec("every 15 minutes")
+        self.assertEqual(part.interval, datetime.timedelta(minutes=15))
+        part, = configuration.validate_timespec(["every hour"])
+        self.assertEqual(part.interval, datetime.timedelta(hours=1))
+
+    def test_cron(self):
+        parts = configuration.validate_timespec(["*/10 * * * *", "sunday"])
+        self.assertIn(backup.SUNDAY, parts)
+        self.assertEqual(len(parts), 2)
+
+    def test_invalid(self):
+        for spec in ["fortnightly", "every 0 minutes", "every 5 fortnights",
+                     "61 * * * *", [3]]:
+            with self.assertRaises(configuration.InvalidConfigError):
+                configuration.validate_timespec(spec)
+
+class ValidateCommandsTests(unittest.TestCase):
+    def test_string_commands_split(self):
+        commands = configuration.validate_commands(
+            {"db.sql": "pg_dump --clean mydb"}, {"/etc": "etc"})
+        self.assertEqual(commands, {"db.sql": ["pg_dump", "--clean", "mydb"]})
+
+    def test_missing_commands(self):
+        self.assertEqual(configuration.validate_commands(None, {}), {})
+
+    def test_name_collision_with_paths(self):
+        with self.assertRaises(configuration.InvalidConfigError):
+            configuration.validate_commands({"etc": ["true"]}, {"/etc": "etc"})
+
+    def test_invalid_names_and_commands(self):
+        for commands in [{"a/b": ["true"]}, {"..": ["true"]}, {"x": []},
+                         {"x": [1]}, ["true"]]:
+            with self.assertRaises(configuration.InvalidConfigError):
+                configuration.validate_commands(commands, {})
+
+class ConfigFileTestCase(unittest.TestCase):
+    def setUp(self):
+        backend_types.load_backend_types()
+        self.directory = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.directory, "backupmgr.conf")
+        self.state_path = os.path.join(self.directory, "state")
+        with open(self.state_path, "w") as f:
+            json.dump({}, f)
+        patcher = mock.patch.object(configuration, "CONFIG_LOCATION", self.config_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, config_dict, argv=("list-configured-backups",)):
+        config_dict = dict(config_dict, statefile=self.state_path)
+        config_dict.setdefault("backends", [{"type": "tarsnap", "name": "offsite"}])
+        with open(self.config_path, "w") as f:
+            json.dump(config_dict, f)
+        return configuration.Config(list(argv), "backupmgr")
+
+
+class ConfigLoadingTests(ConfigFileTestCase):
+    def test_template_expansion(self):
+        customers = os.path.join(self.directory, "customers")
+        for name in ["acme", "globex"]:
+            os.makedirs(os.path.join(customers, name))
+        open(os.path.join(customers, "not-a-directory"), "w").close()
+        config = self.load({
+            "backups": [{"name": "etc", "paths": {"/etc": "etc"},
+                         "timespec": "daily", "backends": ["offsite"]}],
+            "backup_templates": [{
+                "glob": os.path.join(customers, "*"),
+                "name": "customer-{name}",
+                "paths": {"{path}": "{name}"},
+                "timespec": "daily",
+                "backends": ["offsite"]}]})
+        self.assertEqual([b.name for b in config.all_configured_backups()],
+                         ["etc", "customer-acme", "customer-globex"])
+        acme = config.configured_backup_by_name("customer-acme")
+        self.assertEqual(acme.paths, {os.path.join(customers, "acme"): "acme"})
+        self.assertIsNone(config.configured_backup_by_name("customer-initech"))
+
+    def test_template_requires_name_placeholder(self):
+        for name in ["fixed", 5, None]:
+            with self.assertRaises(configuration.InvalidConfigError):
+                self.load({"backup_templates": [{
+                    "glob": os.path.join(self.directory, "*"), "name": name,
+                    "paths": {"{path}": "data"}, "timespec": "daily",
+                    "backends": ["offsite"]}]})
+
+    def test_restore_arguments(self):
+        options = self.load({"backups": []}, ["restore-cheapest", "etc", "1416279400.0",
+                                              "/dest", "etc/passwd"]).config_options
+        self.assertEqual((options.verb, options.cheapest, options.backend, options.archive_spec,
+                          options.destination, options.members),
+                         ("restore", True, None, "1416279400.0", "/dest", ["etc/passwd"]))
+        options = self.load({"backups": []}, ["restore", "etc", "offsite", "-1",
+                                              "/dest"]).config_options
+        self.assertEqual((options.cheapest, options.backend, options.archive_spec),
+                         (False, "offsite", "-1"))
+
+    def test_load_many_backups_quickly(self):
+        count = 10000
+        backups = [{"name": "customer-{}".format(i),
+                    "paths": {"/data/customer-{}".format(i): "data"},
+                    "timespec": "daily",
+                    "backends": ["offsite"]} for i in range(count)]
+        pruning = {"customer-{}".format(i): {"daily": 7} for i in range(count)}
+        start = time.perf_counter()
+        config = self.load({"backups": backups, "pruning": pruning})
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(config.all_configured_backups()), count)
+        self.assertEqual(config.configured_backup_by_name("customer-9999").name,
+                         "customer-9999")
+        self.assertLess(elapsed, 1.0)
+
+    def test_excludes(self):
+        config = self.load({"backups": [
+            {"name": "home", "paths": {"/home": "home"}, "timespec": "daily",
+             "backends": ["offsite"], "exclude": ["*.pyc"],
+             "path_excludes": {"/home": ["build"]}, "exclude_markers": [".nobackup"]},
+            {"name": "etc", "paths": {"/etc": "etc"}, "timespec": "daily",
+             "backends": ["offsite"]}]})
+        home = config.configured_backup_by_name("home")
+        self.assertEqual(home.excludes.patterns, ["*.pyc"])
+        self.assertEqual(home.excludes.path_patterns, {"/home": ["build"]})
+        self.assertFalse(home.excludes.measure)
+        self.assertIsNone(config.configured_backup_by_name("etc").excludes)
+        for bad in [{"exclude": "*.pyc"}, {"path_excludes": {"/var": ["x"]}},
+                    {"exclude_markers": ["a/.nobackup"]},
+                    {"exclude": ["*.pyc"], "measure_excludes": "yes"}]:
+            with self.assertRaises(configuration.InvalidConfigError):
+                self.load({"backups": [dict({"name": "home", "paths": {"/home": "home"},
+                                             "timespec": "daily", "backends": ["offsite"]},
+                                            **bad)]})
+
+    def test_daemon_settings(self):
+        config = self.load({
+            "daemon": {"debounce": 60, "max_watches": 100},
+            "backups": [{"name": "etc", "paths": {"/etc": "etc"}, "timespec": "daily",
+                         "backends": ["offsite"], "daemon": {"min_interval": 600}},
+                        {"name": "home", "paths": {"/home": "home"}, "timespec": "daily",
+                         "backends": ["offsite"]}]})
+        self.assertEqual(config.max_watches, 100)
+        etc = config.daemon_settings_for(config.configured_backup_by_name("etc"))
+        self.assertEqual((etc.debounce, etc.min_interval), (60, 600))
+        home = config.daemon_settings_for(config.configured_backup_by_name("home"))
+        self.assertEqual((home.debounce, home.min_interval), (60, 3600))
+        for settings in [{"min_interval": 10, "max_interval": 5}, {"debounce": "soon"},
+                         {"every": 5}, {"scan_interval": 0}]:
+            with self.assertRaises(configuration.InvalidConfigError):
+                self.load({"daemon": settings, "backups": []})
+
+    def test_schedule_window(self):
+        config = self.load({
+            "schedule_window": "22:00-04:00",
+            "backups": [{"name": "etc", "paths": {"/etc": "etc"}, "timespec": "daily",
+                         "backends": ["offsite"], "schedule_window": "01:30-01:30"},
+                        {"name": "home", "paths": {"/home": "home"}, "timespec": "daily",
+                         "backends": ["offsite"]}]})
+        etc = config.configured_backup_by_name("etc")
+        self.assertEqual(etc.schedule_offset, datetime.timedelta(hours=1, minutes=30))
+        home = config.configured_backup_by_name("home")
+        self.assertEqual(home.schedule_start, -datetime.timedelta(hours=2))
+        self.assertLess(home.schedule_jitter, datetime.timedelta(hours=6))
+        for window in ["01:00", "25:00-02:00", "1:00-2:xx", 3600, "01:75-02:00", ":30-02:00",
+                       "01:-02:00", "+1:00-02:00"]:
+            with self.assertRaises(configuration.InvalidConfigError):
+                self.load({"schedule_window": window, "backups": []})
+
+
+class StateFileTests(ConfigFileTestCase):
+    def config(self):
+        return self.load({"backups": [
+            {"name": name, "paths": {"/" + name: name}, "timespec": "daily",
+             "backends": ["offsite"]} for name in ["etc", "home"]]})
+
+    def result(self, config):
+        result = backup.BackupResult()
+        backend = config.configured_backend_by_name("offsite")
+        result.add(backend, backend_types.PerformResult(True, 10, 1), 1.0)
+        return result
+
+    def test_concurrent_runs_merge(self):
+        first, second = self.config(), self.config()
+        first.save_state_given_results(
+            [(first.configured_backup_by_name("etc"), self.result(first))])
+        second.save_state_given_results(
+            [(second.configured_backup_by_name("home"), self.result(second))])
+        state = self.config().load_state()
+        self.assertEqual(set(state["backups"]), {"etc", "home"})
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["backupmgr.conf", "state", "state.lock"])
+
+    def test_save_keeps_mode(self):
+        config = self.config()
+        os.chmod(self.state_path, 0o640)
+        config.save_state({})
+        self.assertEqual(os.stat(self.state_path).st_mode & 0o777, 0o640)
+        os.unlink(self.state_path)
+        config.save_state({})
+        self.assertEqual(os.stat(self.state_path).st_mode & 0o777, 0o644)
+
+    def test_journaled_results_survive_until_saved(self):
+        first = self.config()
+        first.journal_backup_result(first.configured_backup_by_name("etc"), self.result(first))
+        with open(first.journal_path, "a") as f:
+            f.write('{"backup": "ho')
+        first.journal_backup_result(first.configured_backup_by_name("home"), self.result(first))
+        state = self.config().load_state()
+        self.assertEqual(set(state["backups"]), {"etc", "home"})
+        self.assertEqual(state["backups"]["etc"]["backends"]["offsite"]["bytes"], 10)
+
+        second = self.config()
+        second.save_state_given_results([])
+        self.assertFalse(os.path.exists(second.journal_path))
+        self.assertEqual(set(self.config().load_state()["backups"]), {"etc", "home"})
+
+    def test_backup_locks_exclusive(self):
+        config = self.config()
+        first, second = config.backup_locks(), config.backup_locks()
+        self.assertTrue(first.try_acquire("etc"))
+        self.assertFalse(second.try_acquire("etc"))
+        self.assertTrue(second.try_acquire("home"))
+        first.release_all()
+        self.assertTrue(second.try_acquire("etc"))
+        second.release_all()
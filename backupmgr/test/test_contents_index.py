@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import mock
+
+from .. import contents_index
+
+class ContentsIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = contents_index.ContentsIndex(self.directory)
+        self.backend = mock.NonCallableMock()
+        self.backend.name = "test backend"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_archive(self, timestamp, members):
+        archive = mock.NonCallableMock()
+        archive.backend = self.backend
+        archive.backup_name = "mrgl"
+        archive.timestamp = timestamp
+        archive.complete = True
+        archive.list_contents = mock.MagicMock(return_value=members)
+        return archive
+
+    def test_members_cached(self):
+        archive = self.make_archive(1416279400.0, ["etc/", "etc/nginx/site.conf"])
+        self.assertEqual(self.index.members(archive), ["etc", "etc/nginx/site.conf"])
+        self.assertEqual(self.index.members(archive), ["etc", "etc/nginx/site.conf"])
+        self.assertEqual(archive.list_contents.call_count, 1)
+
+        fresh_index = contents_index.ContentsIndex(self.directory)
+        self.assertEqual(fresh_index.members(archive), ["etc", "etc/nginx/site.conf"])
+        self.assertEqual(archive.list_contents.call_count, 1)
+
+    def test_incomplete_archive_not_cached(self):
+        archive = self.make_archive(1416279400.0, ["etc/hosts"])
+        archive.complete = False
+        self.assertEqual(self.index.members(archive), ["etc/hosts"])
+        archive.complete = True
+        archive.list_contents.return_value = ["etc/hosts", "home/a/.bashrc"]
+        self.assertEqual(self.index.members(archive), ["etc/hosts", "home/a/.bashrc"])
+        self.assertEqual(archive.list_contents.call_count, 2)
+
+    def test_search(self):
+        old = self.make_archive(1416279400.0, ["etc/nginx/site.conf", "etc/hosts"])
+        new = self.make_archive(1416369139.0, ["etc/hosts"])
+        results = list(self.index.search([old, new], "/etc/nginx/site.conf"))
+        self.assertEqual(results, [(old, ["etc/nginx/site.conf"])])
+        results = list(self.index.search([old, new], "hosts"))
+        self.assertEqual(results, [(old, ["etc/hosts"]), (new, ["etc/hosts"])])
+
+    def test_member_matches(self):
+        self.assertTrue(contents_index.member_matches("home/a/.bashrc", "*.bashrc"))
+        self.assertTrue(contents_index.member_matches("home/a/.bashrc", "a/.bashrc"))
+        self.assertFalse(contents_index.member_matches("home/a/.bashrc", "b/.bashrc"))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import tarfile
+import shutil
+import io
+import os
+
+import mock
+
+from .. import excludes
+
+class ExcludesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.home = os.path.join(self.directory, "home")
+        for relative, size in [("notes.txt", 10), ("mod.pyc", 100), ("src/mod.pyc", 200),
+                               ("build/out.o", 300), ("src/build/keep.c", 40),
+                               ("scratch/.nobackup", 0), ("scratch/big", 1000),
+                               ("weird[1]/.nobackup", 0)]:
+            path = os.path.join(self.home, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+        self.excludes = excludes.Excludes(["*.pyc"], {self.home: ["build"]}, [".nobackup"],
+                                          measure=True)
+
+    def test_scan(self):
+        scan = self.excludes.scan({self.home: "home"})
+        for arcname in ["home/mod.pyc", "home/src/mod.pyc", "home/build", "home/build/out.o",
+                        "home/scratch", "home/scratch/big", "home/weird[1]"]:
+            self.assertTrue(scan.excludes(arcname), arcname)
+        for arcname in ["home", "home/notes.txt", "home/src/build/keep.c", "home/scratchpad"]:
+            self.assertFalse(scan.excludes(arcname), arcname)
+        self.assertEqual(sorted(scan.marked), ["home/scratch", "home/weird[1]"])
+        self.assertEqual(scan.excluded_entries, 9)
+        self.assertGreaterEqual(scan.excluded_bytes, 1600)
+        self.assertEqual(scan.tar_patterns(), ["*.pyc", "^home/build", "^home/scratch",
+                                               "^home/weird\\[1]"])
+
+    def test_patterns_need_no_walk(self):
+        with mock.patch("os.walk") as walk:
+            scan = excludes.Excludes(["*.pyc"], {self.home: ["build"]}).scan({self.home: "home"})
+        self.assertEqual(walk.call_count, 0)
+        self.assertFalse(scan.measured)
+        self.assertTrue(scan.excludes("home/build/out.o"))
+        self.assertEqual(scan.tar_patterns(), ["*.pyc", "^home/build"])
+
+    def test_markers_found_without_measuring(self):
+        with mock.patch.object(excludes, "_tree_size") as tree_size:
+            scan = excludes.Excludes(["*.pyc"], {}, [".nobackup"]).scan({self.home: "home"})
+        self.assertEqual(tree_size.call_count, 0)
+        self.assertEqual(sorted(scan.marked), ["home/scratch", "home/weird[1]"])
+        self.assertEqual(scan.excluded_bytes, 0)
+
+    def test_tar_filter(self):
+        scan = self.excludes.scan({self.home: "home"})
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            tar.add(self.home, arcname="home", filter=scan.tar_filter)
+        buf.seek(0)
+        with tarfile.open(fileobj=buf) as tar:
+            self.assertEqual(sorted(tar.getnames()), ["home", "home/notes.txt", "home/src",
+                                                      "home/src/build", "home/src/build/keep.c"])
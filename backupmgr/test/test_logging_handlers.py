@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import logging
+import logging.handlers
+import tempfile
+import shutil
+import queue
+import json
+import os
+import concurrent.futures
+
+from .. import logging_handlers
+
+class LogPipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "log.jsonl")
+        self.logger = logging.getLogger("backupmgr_test_logging")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        log_queue = queue.Queue()
+        self.queue_handler = logging_handlers.ContextQueueHandler(log_queue)
+        self.queue_handler.addFilter(logging_handlers.LogContextFilter("run1"))
+        self.logger.addHandler(self.queue_handler)
+        self.file_handler = logging_handlers.JSONLinesFileHandler(self.path)
+        self.listener = logging.handlers.QueueListener(
+            log_queue, self.file_handler, respect_handler_level=True)
+        self.listener.start()
+        self.listening = True
+
+    def stop_listener(self):
+        if self.listening:
+            self.listener.stop()
+            self.listening = False
+
+    def tearDown(self):
+        self.stop_listener()
+        self.logger.removeHandler(self.queue_handler)
+        self.file_handler.close()
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        self.stop_listener()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_context_fields_recorded(self):
+        with logging_handlers.log_context(phase="backup"):
+            self.logger.info("starting %s", "up")
+            with logging_handlers.log_context(backup="etc", backend="offsite"):
+                self.logger.warning("uploading")
+        first, second = self.entries()
+        self.assertEqual(first["message"], "starting up")
+        self.assertEqual(first["run_id"], "run1")
+        self.assertEqual(first["phase"], "backup")
+        self.assertIsNone(first["backup"])
+        self.assertEqual(second["level"], "WARNING")
+        self.assertEqual((second["backup"], second["backend"], second["phase"]),
+                         ("etc", "offsite", "backup"))
+
+    def test_exception_recorded(self):
+        try:
+            raise ValueError("bad archive")
+        except ValueError:
+            self.logger.exception("upload failed")
+        entry, = self.entries()
+        self.assertEqual(entry["message"], "upload failed")
+        self.assertIn("ValueError: bad archive", entry["exception"])
+        self.assertIn("Traceback", entry["exception"])
+
+    def test_context_carried_to_workers(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            with logging_handlers.log_context(phase="backup"):
+                future = logging_handlers.submit_with_context(
+                    executor, self.logger.info, "from %s", "worker")
+            future.result()
+            executor.submit(self.logger.info, "unmarked").result()
+        marked, unmarked = self.entries()
+        self.assertEqual((marked["message"], marked["phase"]), ("from worker", "backup"))
+        self.assertIsNone(unmarked["phase"])
+
+    def test_context_restored(self):
+        with logging_handlers.log_context(backup="etc"):
+            pass
+        self.assertEqual(logging_handlers.current_log_context(), {})
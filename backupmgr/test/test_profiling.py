@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import subprocess
+import tempfile
+import shutil
+import threading
+import time
+import os
+
+from .. import profiling
+
+class ProfilingTests(unittest.TestCase):
+    def setUp(self):
+        self.profiler = profiling.Profiler(use_cprofile=True, use_tracemalloc=True)
+        self.profiler.start()
+        profiling.activate(self.profiler)
+
+    def tearDown(self):
+        profiling.activate(None)
+        self.profiler.stop()
+
+    def test_spans_not_recorded_when_inactive(self):
+        profiling.activate(None)
+        with profiling.span("idle") as span:
+            span.add_bytes(10)
+        self.assertEqual(self.profiler.spans, [])
+
+    def test_subprocess_span(self):
+        with profiling.span("child", profiling.SUBPROCESS) as span:
+            output = subprocess.check_output(["echo", "hello"])
+            span.add_bytes(len(output))
+        [recorded] = self.profiler.spans
+        self.assertEqual(recorded.name, "child")
+        self.assertEqual(recorded.bytes_read, 6)
+        self.assertGreaterEqual(recorded.wall, 0)
+        self.assertIsNotNone(recorded.child_cpu)
+
+    def test_span_cpu_excludes_other_threads(self):
+        def spin():
+            deadline = time.monotonic() + 0.3
+            while time.monotonic() < deadline:
+                pass
+        worker = threading.Thread(target=spin)
+        with profiling.span("wait"):
+            worker.start()
+            worker.join()
+        [recorded] = self.profiler.spans
+        self.assertLess(recorded.cpu, 0.1)
+
+    def test_aggregates_and_report(self):
+        for _ in range(3):
+            with profiling.span("list"):
+                pass
+        self.profiler.record("load config", self.profiler.started, 0.5)
+        self.profiler.stop()
+
+        totals = self.profiler.aggregates()
+        self.assertEqual(totals[(profiling.PHASE, "list")][0], 3)
+        self.assertEqual(totals[(profiling.PHASE, "load config")][1], 0.5)
+        summary = self.profiler.summary_lines()
+        self.assertIn("load config", summary[1])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "report.txt")
+            self.profiler.write_report(path)
+            with open(path) as f:
+                report = f.read()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertIn("phase: list", report)
+        self.assertIn("cProfile (by cumulative time, main thread only)", report)
+        self.assertIn("tracemalloc", report)
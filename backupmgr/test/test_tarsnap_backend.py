@@ -7,12 +7,16 @@ import subprocess
 import io
 import os
 import sys
+import tarfile
+import time
 
 import mock
 import dateutil
 
 from ..backup_backends import tarsnap
 from .. import backend_types
+from .. import command_output
+from .. import excludes
 
 class TarasnapBackendClassTests(unittest.TestCase):
     def test_is_registered(self):
@@ -62,11 +66,11 @@ class TarsnapBackendTests(unittest.TestCase):
         self.assertEqual(len(mock_popen.call_args[0]), 1)
         self.assertEqual(mock_popen.call_args[0][0][:2], ["/usr/local/bin/tarsnap",
                                                            "-C"])
-        self.assertEqual(mock_popen.call_args[0][0][3:8],
+        self.assertEqual(mock_popen.call_args[0][0][3:9],
                           ["-H", "-cf",
                            "712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl",
-                           "--keyfile", "/root/theKey.key"])
-        self.assertEqual(sorted(mock_popen.call_args[0][0][8:]),
+                           "--keyfile", "/root/theKey.key", "--print-stats"])
+        self.assertEqual(sorted(mock_popen.call_args[0][0][9:]),
                          sorted(["one", "two", "three"]))
         self.assertEqual(mock_popen.call_args[1]["stderr"], subprocess.STDOUT)
         self.assertEqual(mock_popen.call_args[1]["stdout"], subprocess.PIPE)
@@ -83,18 +87,130 @@ class TarsnapBackendTests(unittest.TestCase):
             print("abnormal tarsnap exit is expected here", file=sys.stderr)
             self.assertFalse(self.backend.perform({"/foo" : "bar"}, "mrgl", self.ts))
 
+    def test_perform_reports_stats(self):
+        instance_mock = mock.NonCallableMock()
+        instance_mock.stdout = io.BytesIO(
+            b"                                       Total size  Compressed size\n"
+            b"All archives                             1000000           500000\n"
+            b"  (unique data)                           900000           450000\n"
+            b"This archive                               12345             6789\n"
+            b"New data                                    2345             1234\n")
+        instance_mock.wait = lambda: 0
+        with mock.patch("subprocess.Popen", return_value=instance_mock):
+            result = self.backend.perform({"/foo" : "bar"}, "mrgl", self.ts)
+        self.assertTrue(result)
+        self.assertEqual(result.size, 12345)
+        self.assertEqual(result.uploaded, 1234)
+
+    def test_perform_passes_excludes(self):
+        instance_mock = mock.NonCallableMock()
+        instance_mock.stdout = io.BytesIO(b"")
+        instance_mock.wait = lambda: 0
+        scan = excludes.ExcludeScan(["*.pyc"], {"bar": ["build"]})
+        scan.marked.append("bar/scratch")
+        with mock.patch("subprocess.Popen", return_value=instance_mock) as mock_popen:
+            self.assertTrue(self.backend.perform({"/foo": "bar"}, "mrgl", self.ts, excludes=scan))
+        self.assertEqual(mock_popen.call_args[0][0][-7:],
+                         ["--exclude", "*.pyc", "--exclude", "^bar/build",
+                          "--exclude", "^bar/scratch", "bar"])
+
+    def test_estimate_size(self):
+        instance_mock = mock.NonCallableMock()
+        instance_mock.stdout = io.BytesIO(b"This archive   4242   2121\n"
+                                          b"New data       1212    606\n")
+        instance_mock.wait = lambda: 0
+        with mock.patch("subprocess.Popen", return_value=instance_mock) as mock_popen:
+            self.assertEqual(self.backend.estimate_size({"/foo": "bar"}, "mrgl"), 606)
+        self.assertEqual(mock_popen.call_args[0][0][1:3], ["--dry-run", "--print-stats"])
+
+    def test_perform_streams_commands(self):
+        class RecordingStdin(io.BytesIO):
+            def close(self):
+                self.recorded = self.getvalue()
+                super(RecordingStdin, self).close()
+        instance_mock = mock.NonCallableMock()
+        instance_mock.stdout = io.BytesIO(b"")
+        instance_mock.stdin = RecordingStdin()
+        instance_mock.wait = lambda: 0
+        commands = {"hello.txt": ["printf", "hello"]}
+        real_popen = subprocess.Popen
+        with mock.patch("subprocess.Popen") as mock_popen:
+            mock_popen.side_effect = lambda argv, **kwargs: (
+                instance_mock if argv[0] == tarsnap.TARSNAP_PATH
+                else real_popen(argv, **kwargs))
+            self.assertTrue(self.backend.perform({"/foo": "bar"}, "mrgl", self.ts,
+                                                 commands=commands))
+        tarsnap_argv = mock_popen.call_args_list[0][0][0]
+        self.assertEqual(tarsnap_argv[-2:], ["bar", "@-"])
+        with tarfile.open(fileobj=io.BytesIO(instance_mock.stdin.recorded)) as tar:
+            self.assertEqual(tar.getnames(), ["hello.txt", "hello.txt/000000"])
+            self.assertEqual(tar.extractfile("hello.txt/000000").read(), b"hello")
+
+    def test_failed_command_destroys_archive(self):
+        def tarsnap_process():
+            instance_mock = mock.NonCallableMock()
+            instance_mock.stdout = io.BytesIO(b"")
+            instance_mock.stdin = io.BytesIO()
+            instance_mock.wait = lambda: 0
+            return instance_mock
+        real_popen = subprocess.Popen
+        with mock.patch("subprocess.Popen") as mock_popen:
+            mock_popen.side_effect = lambda argv, **kwargs: (
+                tarsnap_process() if argv[0] == tarsnap.TARSNAP_PATH
+                else real_popen(argv, **kwargs))
+            with self.assertLogs("backupmgr", level="ERROR"):
+                self.assertFalse(self.backend.perform({"/foo": "bar"}, "mrgl", self.ts,
+                                                      commands={"fail": ["false"]}))
+        tarsnap_calls = [call[0][0] for call in mock_popen.call_args_list
+                         if call[0][0][0] == tarsnap.TARSNAP_PATH]
+        self.assertEqual(tarsnap_calls[-1],
+                         [tarsnap.TARSNAP_PATH, "-d", "--keyfile", "/root/theKey.key", "-f",
+                          "712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl"])
+
+    def test_replicate_stream(self):
+        source = mock.NonCallableMock()
+        source.stdout = io.BytesIO(b"tar bytes")
+        source.stderr = io.BytesIO(b"")
+        source.wait = lambda: 0
+        archive = tarsnap.TarsnapArchive(self.backend, 1416279400.0, "src", "mrgl")
+        written = io.BytesIO()
+        with mock.patch("subprocess.Popen", return_value=source) as mock_popen:
+            self.assertTrue(archive.write_tar(written))
+        self.assertEqual(mock_popen.call_args[0][0][1:4], ["-r", "-f", "src"])
+        self.assertEqual(written.getvalue(), b"tar bytes")
+
+        target = mock.NonCallableMock()
+        target.stdout = io.BytesIO(b"This archive   42   21\n")
+        target.stdin = io.BytesIO()
+        target.wait = lambda: 0
+        with mock.patch("subprocess.Popen", return_value=target) as mock_popen:
+            result = self.backend.store_archive("mrgl", self.ts, lambda f: True)
+        self.assertTrue(result)
+        self.assertEqual(result.size, 42)
+        argv = mock_popen.call_args[0][0]
+        self.assertEqual(argv[1:3], ["-cf", self.backend.create_backup_instance_name("mrgl", self.ts)])
+        self.assertEqual(argv[-1], "@-")
+
+    def test_incomplete_replica_destroyed(self):
+        target = mock.NonCallableMock()
+        target.stdout = io.BytesIO(b"")
+        target.stdin = io.BytesIO()
+        target.wait = lambda: 0
+        with mock.patch("subprocess.Popen", return_value=target) as mock_popen:
+            self.assertFalse(self.backend.store_archive("mrgl", self.ts, lambda f: False))
+        self.assertEqual(mock_popen.call_args[0][0][1], "-d")
+
     def test_archive_listing_calls_correctly(self):
         instance_mock = mock.NonCallableMagicMock()
-        fake_output = io.BytesIO(b'')
-        instance_mock.stdout = fake_output
-        instance_mock.wait = mock.MagicMock(return_value=0)
+        instance_mock.communicate = mock.MagicMock(return_value=(b'', b''))
+        instance_mock.returncode = 0
         with mock.patch("subprocess.Popen",
                         return_value=instance_mock) as mock_popen:
             self.backend.existing_archives_for_name("nomatter")
             mock_popen.assert_called_once_with(
                 ["/usr/local/bin/tarsnap", "--list-archives", "--keyfile",
                  "/root/theKey.key"],
-                stdout=subprocess.PIPE)
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     def test_archive_listing_parses_correctly_basics(self):
         instance_mock = mock.NonCallableMagicMock()
@@ -103,8 +219,8 @@ class TarsnapBackendTests(unittest.TestCase):
             b"712fded485ebd593f5954e38acb78ea437c1599f-1416280000.0-brgl",
             b"712fded485ebd593f5954e38acb78ea437c15997-1416369139.0-mrgl"
         ]
-        instance_mock.stdout = io.BytesIO(b"\n".join(lines))
-        instance_mock.wait = lambda: 0
+        instance_mock.communicate = mock.MagicMock(return_value=(b"\n".join(lines), b""))
+        instance_mock.returncode = 0
         with mock.patch("subprocess.Popen",
                         return_value=instance_mock) as mock_popen:
             results = self.backend.existing_archives_for_name("mrgl")
@@ -119,6 +235,98 @@ class TarsnapBackendTests(unittest.TestCase):
         for archive, time in zip(results, [1416279400, 1416369139]):
             self.assertEqual(archive.timestamp, time)
 
+    def test_archive_listing_groups_shards(self):
+        instance_mock = mock.NonCallableMagicMock()
+        lines = [
+            b"712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl",
+            b"712fded485ebd593f5954e38acb78ea437c15997-1416369139.0-mrgl.part2of2",
+            b"712fded485ebd593f5954e38acb78ea437c15997-1416369139.0-mrgl.part1of2",
+        ]
+        instance_mock.communicate = mock.MagicMock(return_value=(b"\n".join(lines), b""))
+        instance_mock.returncode = 0
+        with mock.patch("subprocess.Popen", return_value=instance_mock):
+            plain, sharded = self.backend.existing_archives_for_name("mrgl")
+        self.assertIsNone(plain.shard)
+        group_name = "712fded485ebd593f5954e38acb78ea437c15997-1416369139.0-mrgl.part*of2"
+        self.assertEqual(sharded.fullname, group_name)
+        self.assertEqual([shard.fullname for shard in sharded.shards],
+                         [lines[2].decode("utf-8"), lines[1].decode("utf-8")])
+        again = self.backend.archive_for_name("mrgl", 1416369139.0, group_name)
+        self.assertEqual([shard.fullname for shard in again.shards],
+                         [shard.fullname for shard in sharded.shards])
+
+    def test_archive_listing_failure_raises(self):
+        instance_mock = mock.NonCallableMagicMock()
+        instance_mock.communicate = mock.MagicMock(
+            return_value=(b"partial", b"tarsnap: Cannot read key file: /root/theKey.key"))
+        instance_mock.returncode = 1
+        with mock.patch("subprocess.Popen", return_value=instance_mock):
+            with self.assertRaises(tarsnap.TarsnapError) as cm:
+                self.backend.existing_archives_for_name("mrgl")
+        self.assertEqual(cm.exception.failure_class, tarsnap.KEY_ERROR)
+
+
+class TarsnapFailureHandlingTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = tarsnap.TarsnapBackend({"name": "test backend",
+                                               "retries": 2,
+                                               "retry_delay": 1,
+                                               "circuit_breaker_threshold": 2})
+        self.sleep_patcher = mock.patch("time.sleep")
+        self.sleep = self.sleep_patcher.start()
+        self.addCleanup(self.sleep_patcher.stop)
+
+    def test_classification(self):
+        cases = [
+            ("tarsnap: Sequence number mismatch: Run --fsck", tarsnap.CACHE_NEEDS_FSCK),
+            ("tarsnap: Cannot read key file: /root/tarsnap.key", tarsnap.KEY_ERROR),
+            ("tarsnap: Server is busy, try again later", tarsnap.SERVER_BUSY),
+            ("tarsnap: Error connecting to v1-0-0-server.tarsnap.com", tarsnap.TRANSIENT_NETWORK),
+            ("tarsnap: Connection lost, waiting 2 seconds", tarsnap.TRANSIENT_NETWORK),
+            ("tarsnap: Error communicating with server", tarsnap.TRANSIENT_NETWORK),
+            ("tarsnap: Archive does not exist on the server", tarsnap.UNKNOWN_FAILURE),
+            ("tarsnap: An archive already exists with the name", tarsnap.UNKNOWN_FAILURE),
+        ]
+        for output, expected in cases:
+            self.assertEqual(tarsnap.classify_failure(1, output), expected, output)
+
+    def test_transient_failures_retried_with_backoff(self):
+        attempt = mock.MagicMock(side_effect=[
+            (1, "Error connecting to server", None),
+            (1, "Server is busy", None),
+            (0, "", "listing")])
+        self.assertEqual(self.backend.run_with_retries("list", attempt), "listing")
+        self.assertEqual(attempt.call_count, 3)
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list], [1, 2])
+
+    def test_permanent_failures_not_retried(self):
+        attempt = mock.MagicMock(return_value=(1, "Run --fsck", None))
+        with self.assertRaises(tarsnap.TarsnapError) as cm:
+            self.backend.run_with_retries("list", attempt)
+        self.assertEqual(cm.exception.failure_class, tarsnap.CACHE_NEEDS_FSCK)
+        self.assertEqual(attempt.call_count, 1)
+
+    def test_circuit_breaker_opens(self):
+        attempt = mock.MagicMock(return_value=(1, "Network is unreachable", None))
+        for _ in range(2):
+            with self.assertRaises(tarsnap.TarsnapError):
+                self.backend.run_with_retries("list", attempt)
+        self.assertTrue(self.backend.circuit_open)
+        self.assertEqual(attempt.call_count, 6)
+        with self.assertRaises(tarsnap.TarsnapError) as cm:
+            self.backend.run_with_retries("list", attempt)
+        self.assertEqual(cm.exception.failure_class, tarsnap.BACKEND_DOWN)
+        self.assertEqual(attempt.call_count, 6)
+
+    def test_success_resets_breaker(self):
+        failing = mock.MagicMock(return_value=(1, "Network is unreachable", None))
+        with self.assertRaises(tarsnap.TarsnapError):
+            self.backend.run_with_retries("list", failing)
+        self.backend.run_with_retries("list", lambda: (0, "", None))
+        with self.assertRaises(tarsnap.TarsnapError):
+            self.backend.run_with_retries("list", failing)
+        self.assertFalse(self.backend.circuit_open)
+
 class TestTarsnapArchive(unittest.TestCase):
     def setUp(self):
         self.backend = tarsnap.TarsnapBackend({"keyfile": "/root/theKey.key",
@@ -141,3 +349,137 @@ class TestTarsnapArchive(unittest.TestCase):
                 ["/usr/local/bin/tarsnap", "-C", "/tmp/nothing", "-x", "-f",
                  "712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl"],
                 stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+
+    def test_partial_restore_passes_members(self):
+        instance_mock = mock.NonCallableMagicMock()
+        instance_mock.wait = lambda: 0
+        with mock.patch("subprocess.Popen",
+                        return_value=instance_mock) as mock_popen:
+            self.archive.restore("/tmp/nothing", ["home/a/.bashrc", "etc/*.conf"])
+            mock_popen.assert_called_once_with(
+                ["/usr/local/bin/tarsnap", "-C", "/tmp/nothing", "-x", "-f",
+                 "712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl",
+                 "home/a/.bashrc", "etc/*.conf"],
+                stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+
+    def test_archive_for_name(self):
+        fullname = "712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl"
+        archive = self.backend.archive_for_name("mrgl", 1416279400.0, fullname)
+        self.assertEqual(archive.fullname, fullname)
+        with self.assertRaises(backend_types.BackendOperationError):
+            self.backend.archive_for_name("brgl", 1416279400.0, fullname)
+        with self.assertRaises(backend_types.BackendOperationError):
+            self.backend.archive_for_name("mrgl", 1416279401.0, fullname)
+
+    def test_destroy_archives_batches(self):
+        archives = [tarsnap.TarsnapArchive(self.backend, 1416279400.0 + i,
+                                           "archive-{}".format(i), "mrgl")
+                    for i in range(tarsnap.DESTROY_BATCH_SIZE + 1)]
+        instance_mock = mock.NonCallableMagicMock()
+        instance_mock.stdout = io.BytesIO(b"")
+        instance_mock.wait = lambda: 0
+        with mock.patch("subprocess.Popen",
+                        return_value=instance_mock) as mock_popen:
+            self.assertTrue(self.backend.destroy_archives(archives))
+        self.assertEqual(mock_popen.call_count, 2)
+        first_argv = mock_popen.call_args_list[0][0][0]
+        self.assertEqual(first_argv[:4], ["/usr/local/bin/tarsnap", "-d",
+                                          "--keyfile", "/root/theKey.key"])
+        self.assertEqual(first_argv.count("-f"), tarsnap.DESTROY_BATCH_SIZE)
+        self.assertEqual(mock_popen.call_args_list[1][0][0][4:],
+                         ["-f", "archive-{}".format(tarsnap.DESTROY_BATCH_SIZE)])
+
+    def test_parse_archive_stats(self):
+        output = ("                                       Total size  Compressed size\n"
+                  "All archives                                 5000             3000\n"
+                  "  (unique data)                              2000             1200\n"
+                  "host-1416279400.0-mrgl                       2500             1500\n"
+                  "  (unique data)                               700              400\n")
+        self.assertEqual(tarsnap.parse_archive_stats(output),
+                         {"All archives": (3000, 1200),
+                          "host-1416279400.0-mrgl": (1500, 400)})
+
+    def test_storage_usage_in_batches(self):
+        archives = [tarsnap.TarsnapArchive(self.backend, 1416279400.0 + i,
+                                           "host-{}-mrgl".format(1416279400.0 + i), "mrgl")
+                    for i in range(3)]
+        header = ("                                       Total size  Compressed size\n"
+                  "All archives                                 5000             3000\n"
+                  "  (unique data)                              2000             1200\n")
+        outputs = [header + "".join("{}   2500   1500\n  (unique data)   700   {}\n".format(
+                                        archive.fullname, 400 + i)
+                                    for i, archive in enumerate(archives[:2])),
+                   header + "This archive   2500   1500\n  (unique data)   700   402\n"]
+        with mock.patch.object(tarsnap, "STATS_BATCH_SIZE", 2), \
+                mock.patch.object(self.backend, "run_logged",
+                                  side_effect=[(True, output) for output in outputs]) as run:
+            usage = self.backend.storage_usage(archives)
+        self.assertEqual([call[0][0].count("-f") for call in run.call_args_list], [2, 1])
+        self.assertEqual(usage.total, 1200)
+        self.assertEqual([usage.sizes[archive] for archive in archives],
+                         [backend_types.ArchiveSize(1500, 400 + i) for i in range(3)])
+
+    def test_list_contents_invokes_tarsnap_correctly(self):
+        instance_mock = mock.NonCallableMagicMock()
+        instance_mock.communicate = mock.MagicMock(return_value=(b"mrgl/\nmrgl/file\n", b""))
+        instance_mock.returncode = 0
+        with mock.patch("subprocess.Popen",
+                        return_value=instance_mock) as mock_popen:
+            members = self.archive.list_contents()
+            mock_popen.assert_called_once_with(
+                ["/usr/local/bin/tarsnap", "-t", "-f",
+                 "712fded485ebd593f5954e38acb78ea437c15997-1416279400.0-mrgl",
+                 "--keyfile", "/root/theKey.key"],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(members, ["mrgl/", "mrgl/file"])
+
+
+class TarsnapWatchdogTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = tarsnap.TarsnapBackend({"name": "test backend",
+                                               "retries": 0,
+                                               "timeouts": {"list": 0.5},
+                                               "stall_timeout": 0.5})
+        patcher = mock.patch.object(tarsnap.Watchdog, "POLL_INTERVAL", 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def python(self, code):
+        return [sys.executable, "-c", code]
+
+    def test_timeout(self):
+        with self.assertRaises(tarsnap.TarsnapError) as cm:
+            self.backend.run_captured(self.python("import time; time.sleep(30)"),
+                                      "hang", operation="list")
+        self.assertEqual(cm.exception.failure_class, tarsnap.TIMED_OUT)
+
+    def test_stall(self):
+        with self.assertRaises(tarsnap.TarsnapError) as cm:
+            self.backend.run_logged(self.python("print('started', flush=True)\n"
+                                                "import time; time.sleep(30)"),
+                                    "stall", operation="create")
+        self.assertEqual(cm.exception.failure_class, tarsnap.STALLED)
+
+    def test_stall_stops_hung_command_source(self):
+        hang = {"hang": self.python("import time; time.sleep(30)")}
+        start = time.monotonic()
+        with self.assertRaises(tarsnap.TarsnapError) as cm:
+            self.backend.run_logged(
+                self.python("import sys; sys.stdin.buffer.read()"), "stall", lambda f: (
+                    command_output.write_command_output_archive(
+                        hang, f, watch=f.watchdog.feeding)),
+                operation="create")
+        self.assertEqual(cm.exception.failure_class, tarsnap.STALLED)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_progress_is_not_a_stall(self):
+        _, output = self.backend.run_logged(
+            self.python("import time\n"
+                        "for i in range(8):\n"
+                        "    print(i, flush=True); time.sleep(0.15)"),
+            "progress", operation="create")
+        self.assertTrue(output.endswith("7"))
+
+    def test_unknown_operation_rejected(self):
+        with self.assertRaises(backend_types.BackendConfigurationError):
+            tarsnap.TarsnapBackend({"name": "x", "timeouts": {"craete": 10}})